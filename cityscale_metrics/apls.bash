@@ -9,10 +9,13 @@ echo $dir
 # now loop through the above array
 for i in "${arr[@]}"   
 do
-    if test -f "../${dir}/graph/${i}.p"; then
+    # the .graph output of the inferencer, or the .p pickle
+    prop="../${dir}/graph/${i}.graph"
+    if ! test -f "$prop"; then prop="../${dir}/graph/${i}.p"; fi
+    if test -f "$prop"; then
         echo "========================$i======================"
         python3 ./apls/convert.py "/mnt/data/datasets/cityscale/20cities/region_${i}_refine_gt_graph.p" gt.json
-        python3 ./apls/convert.py "../${dir}/graph/${i}.p" prop.json
+        python3 ./apls/convert.py "$prop" prop.json
           ( cd ./apls && go run . ../gt.json ../prop.json "../../${dir}/results/apls/${i}.txt" cityscale )
     fi
 done
@@ -6,6 +6,9 @@ import graph as splfy
 import topo as topo
 #import TOPORender
 import os
+# graph_io of the repo root reads the .graph outputs of the inferencer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import graph_io
 
 import argparse
 parser = argparse.ArgumentParser()
@@ -39,7 +42,8 @@ max_lon = -71.0
 
 for tile_idx in [8, 9, 19, 28, 29, 39, 48, 49, 59, 68, 69, 79, 88, 89, 99, 108, 109, 119, 128, 129, 139, 148, 149, 159, 168, 169, 179]:
 
-    graph_prop = '../%s/graph/%s.p'%(args.savedir,tile_idx)
+    # .graph, or the .p pickle
+    graph_prop = '../%s/graph/%s'%(args.savedir,tile_idx)
     graph_gt = '../cityscale/20cities/region_%s_graph_gt.pickle'%tile_idx
     # TODO(congrui): why modify args? 
     args.output = '../%s/results/topo/%s.txt'%(args.savedir,tile_idx)
@@ -50,7 +54,7 @@ for tile_idx in [8, 9, 19, 28, 29, 39, 48, 49, 59, 68, 69, 79, 88, 89, 99, 108,
     
 
     map1 = pickle.load(open(graph_gt, "rb"))
-    map2 = pickle.load(open(graph_prop, "rb"))
+    map2 = graph_io.load_sat2graph(graph_prop)
 
 
     def xy2latlon(x,y):
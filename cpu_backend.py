@@ -0,0 +1,181 @@
+import contextlib
+import copy
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import scipy
+import torch
+from torch import nn
+
+from utils import load_config
+from dataset import read_rgb_img
+
+
+def configure_cpu_threads(intra_op_threads=None, inter_op_threads=None):
+    # 0 or None keeps torch's default.
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # can only be set once, before any inter-op parallel work
+            print(f'Cannot set inter-op threads: {e}')
+
+
+def to_channels_last(module, args):
+    # forward pre-hook, feeds NHWC tensors to the convs
+    return tuple(
+        x.contiguous(memory_format=torch.channels_last) if isinstance(x, torch.Tensor) and x.dim() == 4 else x
+        for x in args
+    )
+
+
+class CpuInferenceBackend:
+    """Wraps an eval SAMRoad with CPU inference optimizations.
+
+    Exposes device, infer_masks_and_img_features and infer_toponet like SAMRoad, so
+    it can be passed to infer_one_img as the net. Outputs are always float32.
+
+    - bf16: runs the encoder and mask decoder under bf16 autocast. TopoNet stays
+      fp32, it is cheap and the fused TransformerEncoderLayer path needs one dtype.
+    - channels_last: NHWC layout for the convs of map_decoder.
+    - quantize_int8: dynamic int8 quantization of the Linear layers of the image
+      encoder blocks and the TopoNet projections. Modifies the wrapped net in place. Quantized
+      linears take fp32 inputs, so it can't be combined with bf16.
+    """
+
+    def __init__(self, net, bf16=False, channels_last=True, quantize_int8=False):
+        assert not (bf16 and quantize_int8), 'bf16 autocast and int8 dynamic quantization are exclusive'
+        self.net = net
+        self.device = torch.device('cpu')
+        self.bf16 = bf16
+        net.to(self.device)
+        net.eval()
+
+        if channels_last and hasattr(net, 'map_decoder'):
+            net.map_decoder.to(memory_format=torch.channels_last)
+            net.map_decoder.register_forward_pre_hook(to_channels_last)
+        if quantize_int8:
+            quantize = torch.ao.quantization.quantize_dynamic
+            for block_index, block in enumerate(net.image_encoder.blocks):
+                net.image_encoder.blocks[block_index] = quantize(block, {nn.Linear}, dtype=torch.qint8)
+            # the fused TransformerEncoderLayer kernels need float weights, only
+            # the projections around the transformer are quantized
+            topo_linears = {
+                name for name, module in net.topo_net.named_modules()
+                if isinstance(module, nn.Linear) and not name.startswith('transformer_encoder.')
+            }
+            net.topo_net = quantize(net.topo_net, topo_linears, dtype=torch.qint8)
+
+    def autocast(self):
+        if self.bf16:
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def infer_masks_and_img_features(self, rgb):
+        with torch.no_grad(), self.autocast():
+            mask_scores, image_embeddings = self.net.infer_masks_and_img_features(rgb)
+        return mask_scores.float().contiguous(), image_embeddings.float().contiguous()
+
+    def infer_toponet(self, image_embeddings, graph_points, pairs, valid):
+        with torch.no_grad():
+            topo_scores = self.net.infer_toponet(image_embeddings, graph_points, pairs, valid)
+        return topo_scores.float()
+
+
+def build_cpu_backend(net, config):
+    # CPU_* configs select the optimizations, see CpuInferenceBackend.
+    configure_cpu_threads(config.get('CPU_INTRA_OP_THREADS', 0), config.get('CPU_INTER_OP_THREADS', 0))
+    return CpuInferenceBackend(
+        net,
+        bf16=config.get('CPU_BF16', False),
+        channels_last=config.get('CPU_CHANNELS_LAST', True),
+        quantize_int8=config.get('CPU_QUANTIZE_INT8', False),
+    )
+
+
+def mask_iou(mask_a, mask_b, threshold):
+    # masks are uint8 0-255, threshold in 0-1 like the configs
+    a, b = mask_a > threshold * 255, mask_b > threshold * 255
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / union if union > 0 else 1.0
+
+
+def match_nodes(nodes, ref_nodes, tolerance):
+    # Index of the nearest ref node within tolerance pixels for each node, -1 if none.
+    if nodes.shape[0] == 0 or ref_nodes.shape[0] == 0:
+        return -np.ones((nodes.shape[0], ), dtype=np.int64)
+    dists, indices = scipy.spatial.KDTree(ref_nodes).query(nodes, k=1, distance_upper_bound=tolerance)
+    return np.where(np.isfinite(dists), indices, -1)
+
+
+def edge_precision(nodes, edges, ref_nodes, ref_edges, tolerance):
+    # Fraction of edges whose endpoints match the endpoints of a ref edge.
+    if len(edges) == 0:
+        return 1.0
+    node_matches = match_nodes(np.asarray(nodes, dtype=np.float64), np.asarray(ref_nodes, dtype=np.float64), tolerance)
+    ref_edge_set = {tuple(sorted(edge)) for edge in np.asarray(ref_edges).tolist()}
+    matched = [
+        node_matches[src] >= 0 and node_matches[tgt] >= 0
+        and tuple(sorted((node_matches[src], node_matches[tgt]))) in ref_edge_set
+        for src, tgt in np.asarray(edges).tolist()
+    ]
+    return float(np.mean(matched))
+
+
+def compare_inference_results(reference, result, config, tolerance=4.0):
+    # reference, result: outputs of infer_one_img.
+    # Returns mask IoUs, and node / edge agreement as the F1 of matches within tolerance pixels.
+    ref_nodes, ref_edges, ref_itsc_mask, ref_road_mask = reference
+    nodes, edges, itsc_mask, road_mask = result
+    node_precision = np.mean(match_nodes(nodes, ref_nodes, tolerance) >= 0) if len(nodes) else 1.0
+    node_recall = np.mean(match_nodes(ref_nodes, nodes, tolerance) >= 0) if len(ref_nodes) else 1.0
+    precision = edge_precision(nodes, edges, ref_nodes, ref_edges, tolerance)
+    recall = edge_precision(ref_nodes, ref_edges, nodes, edges, tolerance)
+    return {
+        'itsc_mask_iou': mask_iou(ref_itsc_mask, itsc_mask, config.ITSC_THRESHOLD),
+        'road_mask_iou': mask_iou(ref_road_mask, road_mask, config.ROAD_THRESHOLD),
+        'node_agreement': 2 * node_precision * node_recall / max(node_precision + node_recall, 1e-6),
+        'edge_agreement': 2 * precision * recall / max(precision + recall, 1e-6),
+    }
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model to test."
+)
+parser.add_argument(
+    "--config", default=None, help="model config, CPU_* keys select the optimizations."
+)
+parser.add_argument("--images", nargs='+', default=[], help="images to check the accuracy on.")
+parser.add_argument("--tolerance", default=4.0, type=float, help="max distance in pixels of matching nodes.")
+
+
+if __name__ == "__main__":
+    # Accuracy check: compares the optimized CPU backend against fp32 eager inference.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    from infer_utils import load_model
+    from inferencer import infer_one_img
+
+    device = torch.device('cpu')
+    reference_net = load_model(config, args.checkpoint, device)
+    backend = build_cpu_backend(copy.deepcopy(reference_net), config)
+
+    all_metrics = []
+    for path in args.images:
+        img = read_rgb_img(path)
+        start_seconds = time.time()
+        reference = infer_one_img(reference_net, img, config)
+        reference_seconds = time.time() - start_seconds
+        start_seconds = time.time()
+        result = infer_one_img(backend, img, config)
+        backend_seconds = time.time() - start_seconds
+        metrics = compare_inference_results(reference, result, config, tolerance=args.tolerance)
+        metrics['speedup'] = reference_seconds / max(backend_seconds, 1e-6)
+        print(path, ', '.join(f'{k}={v:.4f}' for k, v in metrics.items()))
+        all_metrics.append(metrics)
+    if all_metrics:
+        print('mean', ', '.join(f'{k}={np.mean([m[k] for m in all_metrics]):.4f}' for k in all_metrics[0]))
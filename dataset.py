@@ -53,12 +53,17 @@ def spacenet_data_partition():
     return train_list, val_list, test_list
 
 
+def get_patch_grid(length, sample_margin, patch_size, patch_num):
+    # Begin coords of patch_num evenly spaced patches along one image axis.
+    sample_min = sample_margin
+    sample_max = length - (patch_size + sample_margin)
+    eval_samples = np.linspace(start=sample_min, stop=sample_max, num=patch_num)
+    return [round(x) for x in eval_samples]
+
+
 def get_patch_info_one_img(image_index, image_size, sample_margin, patch_size, patches_per_edge):
     patch_info = []
-    sample_min = sample_margin
-    sample_max = image_size - (patch_size + sample_margin)
-    eval_samples = np.linspace(start=sample_min, stop=sample_max, num=patches_per_edge)
-    eval_samples = [round(x) for x in eval_samples]
+    eval_samples = get_patch_grid(image_size, sample_margin, patch_size, patches_per_edge)
     for x in eval_samples:
         for y in eval_samples:
             patch_info.append(
@@ -0,0 +1,221 @@
+import glob
+import os
+import time
+import unittest
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils import load_config
+
+
+# Torch implementation of graph_extraction.extract_graph_points, selected with
+# POINT_EXTRACTION: torch. It runs on POINT_EXTRACTION_DEVICE (default: cuda if
+# available) and only the final points come back to the host.
+#
+# The numpy path gives NMS the uint8 mask values as scores. These are all above the
+# forced-keep score 1.0, so every pixel above ITSC_THRESHOLD / ROAD_THRESHOLD reaches
+# the final NMS: a ROAD_NMS_RADIUS greedy NMS where intersection pixels go first.
+# Here that greedy NMS is done in parallel rounds over the peaks of
+# POINT_EXTRACTION_BLOCK x POINT_EXTRACTION_BLOCK pixel blocks:
+#   1. max-pool peak picking keeps the strongest pixel above threshold of each block,
+#      for the intersection and the road mask.
+#   2. priorities: intersection peaks before road peaks, then by mask value, then by
+#      pixel index.
+#   3. each round keeps the peaks with no alive higher priority peak within the
+#      radius, and drops the alive peaks within the radius of a kept one. This ends
+#      in the same points as the greedy NMS in priority order.
+# Both paths keep every candidate pixel within ROAD_NMS_RADIUS of a point, so their
+# points agree within about ROAD_NMS_RADIUS + block size. With a block of 1 and the
+# same priorities, the points are the same. Run this file to compare on masks.
+
+
+def get_block_peaks(mask, threshold, block_size):
+    # mask: [H, W] float. Returns (x, y) [N, 2] and values [N, ] of the max pixel above
+    # threshold of each block, and their block (col, row) [N, 2].
+    masked = torch.where(mask > threshold, mask, torch.full_like(mask, -1.0))
+    pooled, indices = F.max_pool2d(
+        masked[None, None], block_size, stride=block_size, ceil_mode=True, return_indices=True)
+    pooled, indices = pooled[0, 0], indices[0, 0]
+    block_rows, block_cols = torch.nonzero(pooled > threshold, as_tuple=True)
+    pixel_indices = indices[block_rows, block_cols]
+    width = mask.shape[1]
+    points = torch.stack([pixel_indices % width, pixel_indices // width], dim=1)
+    return points, pooled[block_rows, block_cols], torch.stack([block_cols, block_rows], dim=1)
+
+
+def get_dominator_pairs(points, blocks, priorities, radius, block_size, grid_shape):
+    # Pairs (i, j) of peaks within radius where j has the higher priority, [N_pairs, 2].
+    # Peaks are looked up through a per-layer raster of block -> peak index, layers
+    # being the intersection and the road peaks.
+    layer_num = int(blocks[:, 2].max()) + 1 if blocks.shape[0] > 0 else 0
+    index_map = torch.full((layer_num, ) + grid_shape, -1, dtype=torch.int64, device=points.device)
+    index_map[blocks[:, 2], blocks[:, 1], blocks[:, 0]] = torch.arange(points.shape[0], device=points.device)
+    # blocks k > 0 apart hold pixels at least (k - 1) * block_size + 1 apart
+    reach = (int(radius) - 1) // block_size + 1 if radius >= 1 else 0
+    all_pairs = []
+    for dy in range(-reach, reach + 1):
+        for dx in range(-reach, reach + 1):
+            gap_x = max(abs(dx) - 1, 0) * block_size + min(abs(dx), 1)
+            gap_y = max(abs(dy) - 1, 0) * block_size + min(abs(dy), 1)
+            if gap_x * gap_x + gap_y * gap_y > radius * radius:
+                continue
+            rows, cols = blocks[:, 1] + dy, blocks[:, 0] + dx
+            inside = (rows >= 0) & (rows < grid_shape[0]) & (cols >= 0) & (cols < grid_shape[1])
+            src = torch.nonzero(inside, as_tuple=True)[0]
+            for layer in range(layer_num):
+                dst = index_map[layer, rows[src], cols[src]]
+                found = dst >= 0
+                pair_src, pair_dst = src[found], dst[found]
+                offsets = points[pair_dst] - points[pair_src]
+                near = offsets[:, 0] * offsets[:, 0] + offsets[:, 1] * offsets[:, 1] <= radius * radius
+                dominated = near & (priorities[pair_dst] > priorities[pair_src])
+                all_pairs.append(torch.stack([pair_src[dominated], pair_dst[dominated]], dim=1))
+    return torch.cat(all_pairs, dim=0) if all_pairs else torch.zeros((0, 2), dtype=torch.int64, device=points.device)
+
+
+def parallel_greedy_nms(priorities, pairs):
+    # priorities: [N, ] unique, pairs: [N_pairs, 2] (i, j) within radius with j ranked
+    # higher. Returns the kept mask [N, ] of the greedy NMS in descending priority.
+    point_num = priorities.shape[0]
+    alive = torch.ones((point_num, ), dtype=torch.bool, device=priorities.device)
+    kept = torch.zeros((point_num, ), dtype=torch.bool, device=priorities.device)
+    src, dst = pairs[:, 0], pairs[:, 1]
+    while bool(alive.any()):
+        # alive peaks with an alive higher ranked neighbor wait for it
+        blocked = torch.zeros((point_num, ), dtype=torch.int32, device=priorities.device)
+        blocked.index_add_(0, src, (alive[dst] & alive[src]).to(torch.int32))
+        new_kept = alive & (blocked == 0)
+        kept |= new_kept
+        # a kept peak outranks all its alive neighbors, they are dropped
+        suppressed = torch.zeros((point_num, ), dtype=torch.int32, device=priorities.device)
+        suppressed.index_add_(0, src, new_kept[dst].to(torch.int32))
+        alive &= ~new_kept & (suppressed == 0)
+    return kept
+
+
+def to_device_mask(mask, device):
+    if isinstance(mask, torch.Tensor):
+        return mask.to(device, dtype=torch.float32)
+    return torch.from_numpy(np.ascontiguousarray(mask)).to(device, dtype=torch.float32)
+
+
+def get_device(config):
+    device = config.get('POINT_EXTRACTION_DEVICE', None)
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def extract_graph_points(keypoint_mask, road_mask, config):
+    # keypoint_mask, road_mask: [H, W] uint8 0-255 masks, numpy or torch on any device.
+    # Returns [N_points, 2] (x, y) int64 graph points on the host, by descending priority.
+    device = get_device(config)
+    block_size = config.get('POINT_EXTRACTION_BLOCK', 4)
+    radius = float(config.ROAD_NMS_RADIUS)
+    with torch.no_grad():
+        all_points, all_values, all_blocks = [], [], []
+        for layer, (mask, threshold) in enumerate([
+            (keypoint_mask, config.ITSC_THRESHOLD * 255), (road_mask, config.ROAD_THRESHOLD * 255)
+        ]):
+            mask = to_device_mask(mask, device)
+            points, values, blocks = get_block_peaks(mask, threshold, block_size)
+            all_points.append(points)
+            all_values.append(values)
+            all_blocks.append(torch.cat([blocks, torch.full_like(blocks[:, :1], layer)], dim=1))
+        height, width = mask.shape
+        points, values, blocks = torch.cat(all_points), torch.cat(all_values), torch.cat(all_blocks)
+        # intersection layer first, then mask value, then lower pixel index
+        pixel_indices = points[:, 1] * width + points[:, 0]
+        priorities = (
+            (1 - blocks[:, 2]) * (256 * height * width)
+            + values.round().to(torch.int64) * (height * width)
+            + (height * width - 1 - pixel_indices)
+        )
+        grid_shape = ((height + block_size - 1) // block_size, (width + block_size - 1) // block_size)
+        pairs = get_dominator_pairs(points, blocks, priorities, radius, block_size, grid_shape)
+        kept = parallel_greedy_nms(priorities, pairs)
+        kept_indices = torch.nonzero(kept, as_tuple=True)[0]
+        kept_indices = kept_indices[torch.argsort(priorities[kept_indices], descending=True)]
+        return points[kept_indices].cpu().numpy().astype(np.int64)
+
+
+class TestDevicePoints(unittest.TestCase):
+    def test_same_as_greedy_nms(self):
+        from addict import Dict
+        from graph_utils import nms_points
+        rng = np.random.default_rng(0)
+        height, width = 40, 50
+        keypoint_mask = (rng.random((height, width)) * 255 * (rng.random((height, width)) < 0.2)).astype(np.uint8)
+        road_mask = (rng.random((height, width)) * 255).astype(np.uint8)
+        config = Dict(
+            ITSC_THRESHOLD=0.3, ROAD_THRESHOLD=0.4, ROAD_NMS_RADIUS=5.0,
+            POINT_EXTRACTION_BLOCK=1, POINT_EXTRACTION_DEVICE='cpu')
+        points = extract_graph_points(keypoint_mask, road_mask, config)
+        # greedy NMS of all pixels above threshold, in the same priority order
+        all_candidates, all_priorities = [], []
+        for layer, (mask, threshold) in enumerate([(keypoint_mask, 0.3 * 255), (road_mask, 0.4 * 255)]):
+            rows, cols = np.nonzero(mask > threshold)
+            all_candidates.append(np.stack([cols, rows], axis=1))
+            all_priorities.append(
+                (1 - layer) * 256 * height * width + mask[rows, cols].astype(np.int64) * height * width
+                + (height * width - 1 - (rows * width + cols)))
+        priorities = np.concatenate(all_priorities).astype(np.float64)
+        gt_points = nms_points(np.concatenate(all_candidates), priorities / (priorities.max() + 1), 5.0)
+        np.testing.assert_array_equal(points, gt_points)
+
+        # blocks keep every candidate within the radius + block size of a point
+        config.POINT_EXTRACTION_BLOCK = 4
+        block_points = extract_graph_points(keypoint_mask, road_mask, config)
+        dists = np.linalg.norm(gt_points[:, np.newaxis, :] - block_points[np.newaxis, :, :], axis=-1)
+        self.assertLessEqual(dists.min(axis=1).max(), 5.0 + 4)
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="model config, POINT_EXTRACTION_* keys set the device and block size."
+)
+parser.add_argument("--mask_dir", default=None, help="mask dir of an inference output, with <id>_itsc.png and <id>_road.png.")
+parser.add_argument("--tolerance", default=None, type=float, help="max distance in pixels of matching points, defaults to ROAD_NMS_RADIUS + block size.")
+
+
+if __name__ == "__main__":
+    # Compares the torch points against the numpy extract_graph_points.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    import graph_extraction
+    from nms_prefilter import compare_points
+
+    numpy_config = config.copy()
+    numpy_config.POINT_EXTRACTION = 'numpy'
+    numpy_config.NMS_PREFILTER = False
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = config.ROAD_NMS_RADIUS + config.get('POINT_EXTRACTION_BLOCK', 4)
+    device = get_device(config)
+
+    all_metrics = []
+    for road_path in sorted(glob.glob(os.path.join(args.mask_dir, '*_road.png'))):
+        name = os.path.basename(road_path)[:-len('_road.png')]
+        road_mask = cv2.imread(road_path, cv2.IMREAD_GRAYSCALE)
+        keypoint_mask = cv2.imread(os.path.join(args.mask_dir, f'{name}_itsc.png'), cv2.IMREAD_GRAYSCALE)
+        start_seconds = time.time()
+        ref_points = graph_extraction.extract_graph_points(keypoint_mask, road_mask, numpy_config)
+        numpy_seconds = time.time() - start_seconds
+        # masks already on the device, like after the encoder
+        keypoint_tensor, road_tensor = to_device_mask(keypoint_mask, device), to_device_mask(road_mask, device)
+        extract_graph_points(keypoint_tensor, road_tensor, config)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_seconds = time.time()
+        points = extract_graph_points(keypoint_tensor, road_tensor, config)
+        torch_seconds = time.time() - start_seconds
+        metrics = compare_points(points, ref_points, tolerance)
+        metrics['speedup'] = numpy_seconds / max(torch_seconds, 1e-6)
+        print(name, ', '.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
+        all_metrics.append(metrics)
+    if all_metrics:
+        print('mean', ', '.join(f'{k}={np.mean([m[k] for m in all_metrics]):.4f}' for k in all_metrics[0]))
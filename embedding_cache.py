@@ -0,0 +1,215 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+
+# On-disk cache of the pass 1 outputs of inferencer.infer_imgs_masks: fused masks,
+# patch grid and the per-batch img embeddings. Entries are keyed by a hash of the img
+# bytes, the checkpoint and the configs shaping pass 1, so re-runs only changing
+# post-processing configs (thresholds, NMS radii, ...) skip the encoder.
+#
+# Configs: INFER_CACHE_DIR enables it, INFER_CACHE_MAX_GB bounds its size on disk,
+# least recently used entries are evicted first.
+
+
+# configs changing the outputs of pass 1: the encoder architecture, the patch grid and the backend
+PASS1_CONFIG_KEYS = [
+    'NO_SAM', 'SAM_VERSION', 'USE_SAM_DECODER', 'ENCODER_LORA', 'LORA_RANK',
+    'PATCH_SIZE', 'SAMPLE_MARGIN', 'INFER_PATCHES_PER_EDGE', 'INFER_BATCH_SIZE',
+    'INFER_BACKEND', 'CPU_BF16', 'CPU_QUANTIZE_INT8', 'INFER_FEATURE_STORE',
+    'INFER_PREFILTER', 'PREFILTER_SCALE', 'PREFILTER_THRESHOLD',
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_checkpoint_fingerprint(checkpoint_path):
+    # Content hash of a checkpoint file, or of all files of a dir (onnx backend).
+    if checkpoint_path is None:
+        return 'none'
+    if os.path.isdir(checkpoint_path):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(checkpoint_path) for name in names
+        )
+    else:
+        paths = [checkpoint_path]
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(os.path.relpath(path, checkpoint_path).encode())
+        digest.update(_hash_file(path, stat.st_size, stat.st_mtime).encode())
+    return digest.hexdigest()
+
+
+class CachedFeatures:
+    """FeatureStore-like view of the embeddings of a cache entry, loaded into host memory
+    by EmbeddingCache.get so evicting the entry can't pull them away, returns a batch as
+    float32 on device."""
+
+    def __init__(self, arrays, device):
+        self.arrays = arrays
+        self.device = device
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.arrays[index]).to(self.device, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __repr__(self):
+        return f'CachedFeatures(batches={len(self)})'
+
+    def close(self):
+        self.arrays = []
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, max_bytes, checkpoint_fingerprint):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.checkpoint_fingerprint = checkpoint_fingerprint
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, imgs, config):
+        digest = hashlib.sha256()
+        digest.update(self.checkpoint_fingerprint.encode())
+        digest.update(json.dumps({key: config.get(key, None) for key in PASS1_CONFIG_KEYS}, sort_keys=True).encode())
+        for img in imgs:
+            digest.update(str(img.shape).encode())
+            digest.update(np.ascontiguousarray(img).data)
+        return digest.hexdigest()
+
+    def get(self, key, device):
+        # Returns the outputs of infer_imgs_masks, or None on a miss.
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(entry_dir, 'masks.npz')):
+            self.misses += 1
+            return None
+        try:
+            # marks it recently used
+            os.utime(entry_dir)
+            with np.load(os.path.join(entry_dir, 'masks.npz')) as masks:
+                # [N_patches, 5] (img_index, x0, y0, x1, y1)
+                patch_array = masks['patch_info']
+                fused_keypoint_masks, fused_road_masks = masks['keypoint'], masks['road']
+                batch_num = int(masks['batch_num'])
+            # read now, other runs may evict the entry before pass 2
+            feature_arrays = [np.load(os.path.join(entry_dir, f'features_{i}.npy')) for i in range(batch_num)]
+        except (OSError, ValueError, KeyError):
+            # evicted while reading
+            self.misses += 1
+            return None
+        all_patch_info = [
+            (img_index, (x0, y0), (x1, y1))
+            for img_index, x0, y0, x1, y1 in patch_array.tolist()
+        ]
+        img_features = CachedFeatures(feature_arrays, device)
+        self.hits += 1
+        return all_patch_info, img_features, fused_keypoint_masks, fused_road_masks
+
+    def put(self, key, masks_outputs, config):
+        # Stores the outputs of infer_imgs_masks. Embeddings are kept in fp16 unless
+        # INFER_FEATURE_STORE is fp32.
+        all_patch_info, img_features, fused_keypoint_masks, fused_road_masks = masks_outputs
+        dtype = np.float32 if config.get('INFER_FEATURE_STORE', 'fp32') == 'fp32' else np.float16
+        # written aside and renamed, so readers never see partial entries
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        try:
+            for i in range(len(img_features)):
+                np.save(os.path.join(tmp_dir, f'features_{i}.npy'), img_features[i].cpu().numpy().astype(dtype))
+            patch_array = np.array([
+                (img_index, x0, y0, x1, y1) for img_index, (x0, y0), (x1, y1) in all_patch_info
+            ], dtype=np.int64).reshape(-1, 5)
+            np.savez(
+                os.path.join(tmp_dir, 'masks.npz'), patch_info=patch_array,
+                keypoint=fused_keypoint_masks, road=fused_road_masks, batch_num=len(img_features))
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # another process stored the same key
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        # list of (last used time, size in bytes, path), oldest first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.tmp_') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.stat(path).st_mtime, size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        # Removes least recently used entries until the cache fits max_bytes.
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def __repr__(self):
+        return f'Embedding cache {self.cache_dir}: {self.hits} hits, {self.misses} misses'
+
+
+# Disabled until configured, see configure().
+CACHE = None
+
+
+def configure(config, checkpoint_path):
+    global CACHE
+    cache_dir = config.get('INFER_CACHE_DIR', None)
+    if not cache_dir:
+        CACHE = None
+        return CACHE
+    CACHE = EmbeddingCache(
+        cache_dir,
+        max_bytes=int(config.get('INFER_CACHE_MAX_GB', 50) * 2 ** 30),
+        checkpoint_fingerprint=get_checkpoint_fingerprint(checkpoint_path),
+    )
+    return CACHE
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_evict_after_get(self):
+        from addict import Dict
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = EmbeddingCache(cache_dir, max_bytes=2 ** 30, checkpoint_fingerprint='test')
+            config = Dict(INFER_FEATURE_STORE='fp32')
+            imgs = [np.zeros((8, 8, 3), dtype=np.uint8)]
+            key = cache.key(imgs, config)
+            features = [torch.arange(8, dtype=torch.float32).view(1, 2, 2, 2)]
+            masks = np.zeros((1, 8, 8), dtype=np.uint8)
+            cache.put(key, ([(0, (0, 0), (8, 8))], features, masks, masks), config)
+            all_patch_info, img_features, _, _ = cache.get(key, 'cpu')
+            self.assertEqual(all_patch_info, [(0, (0, 0), (8, 8))])
+            # another put evicts everything before pass 2 reads the features
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertIsNone(cache.get(key, 'cpu'))
+            self.assertTrue(torch.equal(img_features[0], features[0]))
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,101 @@
+import os
+from argparse import ArgumentParser
+
+import torch
+from torch import nn
+
+from utils import load_config
+from infer_utils import load_model
+from onnx_backend import MASKS_MODEL_NAME, TOPO_MODEL_NAME
+
+
+class MasksAndImgFeatures(nn.Module):
+    # SAMRoad.infer_masks_and_img_features as a module to export.
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, rgb):
+        return self.net.infer_masks_and_img_features(rgb)
+
+
+class TopoScores(nn.Module):
+    # SAMRoad.infer_toponet (BilinearSampler + TopoNet) as a module to export.
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, image_embeddings, graph_points, pairs, valid):
+        return self.net.infer_toponet(image_embeddings, graph_points, pairs, valid)
+
+
+def export_onnx(net, config, output_dir, opset_version=17):
+    # Writes the two graphs of onnx_backend.OnnxInferenceBackend to output_dir, with
+    # dynamic batch, point and pair dimensions.
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    net = net.to(torch.device('cpu')).eval()
+    # the nested tensor fast path of TransformerEncoder drops padded pairs, which
+    # doesn't trace with dynamic shapes
+    fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        batch_size, point_num, sample_num = 2, 8, 8
+        rgb = torch.rand(batch_size, config.PATCH_SIZE, config.PATCH_SIZE, 3) * 255
+        with torch.no_grad():
+            _, image_embeddings = net.infer_masks_and_img_features(rgb)
+        torch.onnx.export(
+            MasksAndImgFeatures(net), (rgb, ),
+            os.path.join(output_dir, MASKS_MODEL_NAME),
+            input_names=['rgb'],
+            output_names=['mask_scores', 'image_embeddings'],
+            dynamic_axes={
+                'rgb': {0: 'batch'},
+                'mask_scores': {0: 'batch'},
+                'image_embeddings': {0: 'batch'},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+        graph_points = torch.rand(batch_size, point_num, 2) * config.PATCH_SIZE
+        pairs = torch.randint(0, point_num, (batch_size, sample_num, config.MAX_NEIGHBOR_QUERIES, 2))
+        valid = torch.rand(batch_size, sample_num, config.MAX_NEIGHBOR_QUERIES) > 0.5
+        torch.onnx.export(
+            TopoScores(net), (image_embeddings, graph_points, pairs, valid),
+            os.path.join(output_dir, TOPO_MODEL_NAME),
+            input_names=['image_embeddings', 'graph_points', 'pairs', 'valid'],
+            output_names=['topo_scores'],
+            dynamic_axes={
+                'image_embeddings': {0: 'batch'},
+                'graph_points': {0: 'batch', 1: 'points'},
+                'pairs': {0: 'batch', 1: 'samples', 2: 'pairs'},
+                'valid': {0: 'batch', 1: 'samples', 2: 'pairs'},
+                'topo_scores': {0: 'batch', 1: 'samples', 2: 'pairs'},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath_enabled)
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model to export."
+)
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument(
+    "--output_dir", default=None, help="dir of the exported graphs, pass it as --checkpoint with INFER_BACKEND: 'onnx'."
+)
+parser.add_argument("--opset", default=17, type=int, help="onnx opset version")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    net = load_model(config, args.checkpoint, torch.device('cpu'))
+    export_onnx(net, config, args.output_dir, opset_version=args.opset)
+    print(f'Exported to {args.output_dir}')
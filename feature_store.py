@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+
+FEATURE_STORE_MODES = {'fp32', 'fp16', 'bf16', 'int8', 'mmap'}
+
+
+def quantize_per_channel(features):
+    # features: [B, D, h, w] float
+    # Returns int8 [B, D, h, w] and float32 scales [B, D, 1, 1], symmetric per (b, d) channel.
+    scales = features.abs().amax(dim=(2, 3), keepdim=True).to(torch.float32) / 127.0
+    scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+    quantized = torch.round(features / scales).clamp_(-127, 127).to(torch.int8)
+    return quantized, scales
+
+
+def dequantize_per_channel(quantized, scales):
+    return quantized.to(torch.float32) * scales
+
+
+class FeatureStoreStats:
+    def __init__(self):
+        self.stores = 0
+        self.batches = 0
+        self.nbytes = 0
+        self.max_nbytes = 0
+
+    def add(self, store):
+        nbytes = store.nbytes
+        self.stores += 1
+        self.batches += len(store)
+        self.nbytes += nbytes
+        self.max_nbytes = max(self.max_nbytes, nbytes)
+
+    def __repr__(self):
+        return (
+            f'Feature stores held {self.batches} batches in {self.stores} stores, '
+            f'mean {self.nbytes / max(self.stores, 1) / 2**20:.1f}MiB, max {self.max_nbytes / 2**20:.1f}MiB per store'
+        )
+
+
+STATS = FeatureStoreStats()
+
+
+class FeatureStore:
+    """List-like store for the per-batch image embeddings handed from pass 1 to pass 2.
+
+    Modes:
+    - fp32: keeps the tensors as they are.
+    - fp16 / bf16: keeps half precision copies on the same device.
+    - int8: per-channel symmetric int8 with float32 scales, on the same device.
+    - mmap: spills fp16 copies to .npy files under spill_dir and memory-maps them back.
+    Items are always returned as float32 on the device they were produced on, so
+    they can be fed to SAMRoad.infer_toponet as-is.
+    """
+
+    def __init__(self, mode='fp32', spill_dir=None):
+        assert mode in FEATURE_STORE_MODES, f'unknown feature store mode {mode}'
+        self.mode = mode
+        self.spill_dir = spill_dir
+        self._tmp_dir = None
+        # list of (payload, device)
+        self._items = []
+
+    def append(self, features):
+        # features: [B, D, h, w]
+        features = features.detach()
+        device = features.device
+        if self.mode == 'fp32':
+            payload = features
+        elif self.mode == 'fp16':
+            payload = features.to(torch.float16)
+        elif self.mode == 'bf16':
+            payload = features.to(torch.bfloat16)
+        elif self.mode == 'int8':
+            payload = quantize_per_channel(features)
+        elif self.mode == 'mmap':
+            if self._tmp_dir is None:
+                if self.spill_dir and not os.path.exists(self.spill_dir):
+                    os.makedirs(self.spill_dir)
+                self._tmp_dir = tempfile.mkdtemp(prefix='feature_store_', dir=self.spill_dir)
+            path = os.path.join(self._tmp_dir, f'{len(self._items)}.npy')
+            np.save(path, features.to(torch.float16).cpu().numpy())
+            payload = path
+        self._items.append((payload, device))
+
+    def __getitem__(self, index):
+        payload, device = self._items[index]
+        if self.mode == 'int8':
+            return dequantize_per_channel(*payload)
+        if self.mode == 'mmap':
+            array = np.load(payload, mmap_mode='r')
+            return torch.from_numpy(np.array(array)).to(device, dtype=torch.float32)
+        return payload.to(torch.float32)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        # memory held by the stored features, bytes. For mmap this is the size on disk.
+        total = 0
+        for payload, _ in self._items:
+            if self.mode == 'int8':
+                total += sum(t.numel() * t.element_size() for t in payload)
+            elif self.mode == 'mmap':
+                total += os.path.getsize(payload)
+            else:
+                total += payload.numel() * payload.element_size()
+        return total
+
+    def __repr__(self):
+        where = 'disk' if self.mode == 'mmap' else 'memory'
+        return f'FeatureStore(mode={self.mode}, batches={len(self)}, {where}={self.nbytes / 2**20:.1f}MiB)'
+
+    def close(self):
+        if self._items:
+            STATS.add(self)
+        self._items = []
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
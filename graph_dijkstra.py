@@ -0,0 +1,195 @@
+import glob
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from sklearn.neighbors import KDTree
+
+from graph_utils import get_disc_indices
+from utils import load_config
+
+
+# Edge search of graph_extraction.extract_graph_astar with one bounded Dijkstra per
+# keypoint instead of one A* per keypoint pair, selected with ASTAR_ENGINE: dijkstra.
+#
+# The A* engine opens the blocking discs of the two keypoints of a pair in the cost
+# field, and connects them if the cheapest path has less than NEIGHBOR_RADIUS steps.
+# Here each source keypoint searches the window of pixels within NEIGHBOR_RADIUS steps
+# around it, on a copy of the window where
+#   - the source disc is open,
+#   - the discs of the other keypoints are sinks: paths may enter a disc but not leave
+#     it, so they can reach its keypoint but not pass through it, as in the A* engine.
+# All keypoints within NEIGHBOR_RADIUS are read off the distances of one search, and
+# their path steps off the predecessors. Same step costs as tcod, the destination pixel
+# cost, times 1.41 for diagonal steps.
+#
+# Paths are kept within the window, so where the cheapest path to a keypoint detours
+# outside, and A* rejects it as too long, a dearer path within the window may still
+# connect it. Run this file on masks to compare the two engines.
+#
+# Configs: ASTAR_WORKERS > 1 fans the sources out to a process pool.
+
+KP_BLOCK_RADIUS = 6
+# (row, col) offset and length of the 8-connected steps
+STEPS = [(dr, dc, 1.41 if dr != 0 and dc != 0 else 1.0) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr != 0 or dc != 0]
+
+
+def get_owner_field(kps, shape):
+    # [H, W] int32, 1 + index of the keypoint whose blocking disc covers each pixel, 0 elsewhere.
+    owner_field = np.zeros(shape, dtype=np.int32)
+    flat_indices, point_indices = get_disc_indices(kps, KP_BLOCK_RADIUS, shape)
+    # later keypoints win where discs overlap, as when drawn in order
+    np.maximum.at(owner_field.reshape(-1), flat_indices, (point_indices + 1).astype(np.int32))
+    return owner_field
+
+
+def search_from_source(source_index, target_indices, kps, cost_field, owner_field, max_path_len):
+    # Returns the target_indices connected to the keypoint source_index by a path of
+    # less than max_path_len steps.
+    height, width = cost_field.shape
+    x, y = int(kps[source_index][0]), int(kps[source_index][1])
+    row_0, row_1 = max(y - max_path_len, 0), min(y + max_path_len + 1, height)
+    col_0, col_1 = max(x - max_path_len, 0), min(x + max_path_len + 1, width)
+    # the shared cost field stays untouched
+    cost = cost_field[row_0:row_1, col_0:col_1].astype(np.float64)
+    owner = owner_field[row_0:row_1, col_0:col_1]
+    sink = (owner > 0) & (owner != source_index + 1)
+    cost[owner > 0] = 1.0
+    passable = cost > 0
+
+    window_height, window_width = cost.shape
+    node_ids = np.arange(window_height * window_width).reshape(window_height, window_width)
+    all_src, all_dst, all_weights = [], [], []
+    for dr, dc, step_len in STEPS:
+        src_slice = (slice(max(-dr, 0), window_height - max(dr, 0)), slice(max(-dc, 0), window_width - max(dc, 0)))
+        dst_slice = (slice(max(dr, 0), window_height - max(-dr, 0)), slice(max(dc, 0), window_width - max(-dc, 0)))
+        # nothing leaves a sink disc but into the same disc
+        valid = passable[src_slice] & passable[dst_slice] & (~sink[src_slice] | (owner[src_slice] == owner[dst_slice]))
+        all_src.append(node_ids[src_slice][valid])
+        all_dst.append(node_ids[dst_slice][valid])
+        all_weights.append(cost[dst_slice][valid] * step_len)
+    node_num = window_height * window_width
+    graph = csr_matrix(
+        (np.concatenate(all_weights), (np.concatenate(all_src), np.concatenate(all_dst))), shape=(node_num, node_num))
+    source_node = (y - row_0) * window_width + (x - col_0)
+    dists, predecessors = dijkstra(graph, indices=source_node, return_predecessors=True)
+
+    target_indices = np.asarray(target_indices)
+    target_indices = target_indices[target_indices != source_index]
+    target_rows, target_cols = kps[target_indices, 1] - row_0, kps[target_indices, 0] - col_0
+    inside = (target_rows >= 0) & (target_rows < window_height) & (target_cols >= 0) & (target_cols < window_width)
+    target_indices, target_rows, target_cols = target_indices[inside], target_rows[inside], target_cols[inside]
+    target_nodes = node_ids[target_rows, target_cols]
+    # steps of the cheapest paths, walking back all targets at once
+    reached = np.isfinite(dists[target_nodes])
+    steps = np.zeros(target_nodes.shape, dtype=np.int64)
+    current = target_nodes.copy()
+    walking = reached & (current != source_node)
+    for _ in range(max_path_len):
+        if not walking.any():
+            break
+        current[walking] = predecessors[current[walking]]
+        steps[walking] += 1
+        walking &= current != source_node
+    return target_indices[reached & ~walking & (steps < max_path_len)]
+
+
+# per process state of the pool workers, set once by init_worker
+WORKER_STATE = {}
+
+
+def init_worker(kps, cost_field, owner_field, max_path_len):
+    WORKER_STATE.update(kps=kps, cost_field=cost_field, owner_field=owner_field, max_path_len=max_path_len)
+
+
+def search_sources(source_indices, all_target_indices):
+    # [N_edges, 2] keypoint index pairs connected from source_indices, in a pool worker.
+    all_edges = []
+    for source_index, target_indices in zip(source_indices, all_target_indices):
+        connected = search_from_source(
+            source_index, target_indices, WORKER_STATE['kps'], WORKER_STATE['cost_field'],
+            WORKER_STATE['owner_field'], WORKER_STATE['max_path_len'])
+        all_edges.append(np.stack([np.full_like(connected, source_index), connected], axis=1))
+    return np.concatenate(all_edges, axis=0) if all_edges else np.zeros((0, 2), dtype=np.int64)
+
+
+def extract_graph_edges(kps, cost_field, config):
+    # kps: [N, 2] (x, y), cost_field: create_cost_field_astar of kps, 0 is blocked.
+    # Returns the nx.Graph of (x, y) tuples like extract_graph_astar.
+    kps = np.asarray(kps, dtype=np.int64)
+    max_path_len = int(config.NEIGHBOR_RADIUS)
+    graph = nx.Graph()
+    if kps.shape[0] == 0:
+        return graph
+    owner_field = get_owner_field(kps, cost_field.shape)
+    all_target_indices = KDTree(kps).query_radius(kps, r=config.NEIGHBOR_RADIUS)
+    source_indices = list(range(kps.shape[0]))
+    state = (kps, cost_field, owner_field, max_path_len)
+
+    workers = config.get('ASTAR_WORKERS', 0)
+    if workers > 1:
+        chunk_size = (len(source_indices) + workers - 1) // workers
+        chunks = [source_indices[i:i + chunk_size] for i in range(0, len(source_indices), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=state) as pool:
+            all_edges = list(pool.map(search_sources, chunks, [all_target_indices[chunk] for chunk in chunks]))
+    else:
+        init_worker(*state)
+        all_edges = [search_sources(source_indices, all_target_indices)]
+
+    for i, j in np.concatenate(all_edges, axis=0):
+        graph.add_edge((int(kps[i][0]), int(kps[i][1])), (int(kps[j][0]), int(kps[j][1])))
+    return graph
+
+
+def get_edge_set(graph):
+    return set(frozenset(edge) for edge in graph.edges())
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="model config, NEIGHBOR_RADIUS and ASTAR_WORKERS are used."
+)
+parser.add_argument("--mask_dir", default=None, help="mask dir of an inference output, with <id>_itsc.png and <id>_road.png.")
+
+
+if __name__ == "__main__":
+    # Compares the edges of the dijkstra and the A* engine of extract_graph_astar.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    import graph_extraction
+
+    astar_config = config.copy()
+    astar_config.ASTAR_ENGINE = 'astar'
+    dijkstra_config = config.copy()
+    dijkstra_config.ASTAR_ENGINE = 'dijkstra'
+
+    all_metrics = []
+    for road_path in sorted(glob.glob(os.path.join(args.mask_dir, '*_road.png'))):
+        name = os.path.basename(road_path)[:-len('_road.png')]
+        road_mask = cv2.imread(road_path, cv2.IMREAD_GRAYSCALE)
+        keypoint_mask = cv2.imread(os.path.join(args.mask_dir, f'{name}_itsc.png'), cv2.IMREAD_GRAYSCALE)
+        start_seconds = time.time()
+        ref_edges = get_edge_set(graph_extraction.extract_graph_astar(keypoint_mask, road_mask, astar_config))
+        astar_seconds = time.time() - start_seconds
+        start_seconds = time.time()
+        edges = get_edge_set(graph_extraction.extract_graph_astar(keypoint_mask, road_mask, dijkstra_config))
+        dijkstra_seconds = time.time() - start_seconds
+        metrics = {
+            'edges': len(edges),
+            'ref_edges': len(ref_edges),
+            'only_in_ref': len(ref_edges - edges),
+            'only_in_edges': len(edges - ref_edges),
+            'astar_seconds': astar_seconds,
+            'dijkstra_seconds': dijkstra_seconds,
+            'speedup': astar_seconds / max(dijkstra_seconds, 1e-6),
+        }
+        print(name, ', '.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
+        all_metrics.append(metrics)
+    if all_metrics:
+        print('mean', ', '.join(f'{k}={np.mean([m[k] for m in all_metrics]):.4f}' for k in all_metrics[0]))
@@ -7,7 +7,10 @@ import tcod
 from sklearn.neighbors import KDTree
 from skimage.draw import line
 import networkx as nx
-from graph_utils import nms_points
+from graph_utils import nms_points, nms_points_batch, get_disc_stamp, stamp_discs, get_line_pixels
+import device_points
+import graph_dijkstra
+import nms_prefilter
 
 
 IMAGE_SIZE = 2048
@@ -70,20 +73,30 @@ def draw_points_on_grayscale_image(image, points, radius):
 
 # takes xy
 def is_connected_bresenham(cost, start, end):
-    c0, r0 = start
-    c1, r1 = end
-    rr, cc = line(r0, c0, r1, c1)
-    kp_block_radius = 4
-    cv2.circle(cost, start, kp_block_radius, 0, -1)
-    cv2.circle(cost, end, kp_block_radius, 0, -1)
-    
-    # mean_cost = np.mean(cost[rr, cc])
-    max_cost = np.max(cost[rr, cc])
+    return bool(are_connected_bresenham(cost, [start], [end])[0])
 
-    cv2.circle(cost, start, kp_block_radius, 255, -1)
-    cv2.circle(cost, end, kp_block_radius, 255, -1)
 
-    return max_cost < 255
+def are_connected_bresenham(cost, starts, ends):
+    # is_connected_bresenham of all (x, y) starts [N, 2] and ends [N, 2] at once: whether
+    # the line of each pair only crosses pixels below 255 out of the blocking discs of its
+    # two ends. Reads cost only.
+    starts = np.asarray(starts, dtype=np.int64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.int64).reshape(-1, 2)
+    if starts.shape[0] == 0:
+        return np.zeros((0, ), dtype=bool)
+    kp_block_radius = 4
+    rows, cols, line_indices = get_line_pixels(starts, ends)
+    line_cost = cost[rows, cols]
+    stamp = get_disc_stamp(kp_block_radius).astype(bool)
+    for ends_xy in (starts, ends):
+        # the blocking disc of each end counts as 0
+        dxs = cols - ends_xy[:, 0][line_indices] + kp_block_radius
+        dys = rows - ends_xy[:, 1][line_indices] + kp_block_radius
+        near = np.flatnonzero((dxs >= 0) & (dxs <= 2 * kp_block_radius) & (dys >= 0) & (dys <= 2 * kp_block_radius))
+        line_cost[near[stamp[dys[near], dxs[near]]]] = 0
+    # lines are never empty
+    line_starts = np.flatnonzero(np.diff(line_indices, prepend=-1))
+    return np.maximum.reduceat(line_cost, line_starts) < 255
 
 
 def is_connected_astar(pathfinder, cost, start, end, max_path_len):
@@ -106,32 +119,39 @@ def is_connected_astar(pathfinder, cost, start, end, max_path_len):
 
 def create_cost_field(sample_pts, road_mask):
     # road mask shall be uint8 normalized to 0-255
-    cost_field = np.zeros(road_mask.shape, dtype=np.uint8)
     kp_block_radius = 4
-    for point in sample_pts:
-        cv2.circle(cost_field, point, kp_block_radius, 255, -1)
-    cost_field = np.maximum(cost_field, 255 - road_mask)
+    cost_field = 255 - road_mask
+    stamp_discs(cost_field, sample_pts, kp_block_radius, 255)
     return cost_field
 
 def create_cost_field_astar(sample_pts, road_mask, block_threshold=200):
     # road mask shall be uint8 normalized to 0-255
     # for tcod, 0 is blocked
-    cost_field = np.zeros(road_mask.shape, dtype=np.uint8)
+    # one lookup of the road mask: 255 - road, 0 raised to 1, above block_threshold blocked
+    costs = 255 - np.arange(256)
+    lut = np.where(costs > block_threshold, 0, np.maximum(costs, 1)).astype(np.uint8)
+    cost_field = cv2.LUT(road_mask, lut)
     kp_block_radius = 6
-    for point in sample_pts:
-        cv2.circle(cost_field, point, kp_block_radius, 255, -1)
-    cost_field = np.maximum(cost_field, 255 - road_mask)
-    cost_field[cost_field == 0] = 1
-    cost_field[cost_field > block_threshold] = 0
-
+    # blocking discs, 255 before the lookup
+    stamp_discs(cost_field, sample_pts, kp_block_radius, lut[0])
     return cost_field
 
 
 def extract_graph_points(keypoint_mask, road_mask, config):
-    kp_candidates, kp_scores = get_points_and_scores_from_mask(keypoint_mask, config.ITSC_THRESHOLD * 255)
-    kps_0 = nms_points(kp_candidates, kp_scores, config.ITSC_NMS_RADIUS)
-    kp_candidates, kp_scores = get_points_and_scores_from_mask(road_mask, config.ROAD_THRESHOLD * 255)
-    kps_1 = nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+    if config.get('POINT_EXTRACTION', 'numpy') == 'torch':
+        # on device, see device_points
+        return device_points.extract_graph_points(keypoint_mask, road_mask, config)
+    if config.get('NMS_PREFILTER', False):
+        # only the local maxima of the masks, approximate, see nms_prefilter
+        itsc_candidates, itsc_scores = nms_prefilter.get_points_and_scores_from_mask(
+            keypoint_mask, config.ITSC_THRESHOLD * 255, config.ITSC_NMS_RADIUS, config)
+        road_candidates, road_scores = nms_prefilter.get_points_and_scores_from_mask(
+            road_mask, config.ROAD_THRESHOLD * 255, config.ROAD_NMS_RADIUS, config)
+    else:
+        itsc_candidates, itsc_scores = get_points_and_scores_from_mask(keypoint_mask, config.ITSC_THRESHOLD * 255)
+        road_candidates, road_scores = get_points_and_scores_from_mask(road_mask, config.ROAD_THRESHOLD * 255)
+    kps_0, kps_1 = nms_points_batch(
+        [itsc_candidates, road_candidates], [itsc_scores, road_scores], [config.ITSC_NMS_RADIUS, config.ROAD_NMS_RADIUS])
     # prioritize intersection points
     kp_candidates = np.concatenate([kps_0, kps_1], axis=0)
     kp_scores = np.concatenate([np.ones((kps_0.shape[0])), np.zeros((kps_1.shape[0]))], axis=0)
@@ -142,11 +162,16 @@ def extract_graph_points(keypoint_mask, road_mask, config):
 def extract_graph_astar(keypoint_mask, road_mask, config):
     kps = extract_graph_points(keypoint_mask, road_mask, config)
 
-    # cost_field = create_cost_field(kps, road_mask)
+    if config.get('ASTAR_ENGINE', 'astar') == 'bresenham':
+        # straight lines over the road mask instead of paths
+        return extract_graph_bresenham(kps, create_cost_field(kps, road_mask), config)
     cost_field = create_cost_field_astar(kps, road_mask)
     viz_cost_field = np.array(cost_field)
     viz_cost_field[viz_cost_field == 0] = 255
     # cv2.imwrite('astar_cost_dbg.png', viz_cost_field)
+    if config.get('ASTAR_ENGINE', 'astar') == 'dijkstra':
+        # one search per keypoint, see graph_dijkstra
+        return graph_dijkstra.extract_graph_edges(kps, cost_field, config)
     pathfinder = tcod.path.AStar(cost_field)
 
     tree = KDTree(kps)
@@ -166,6 +191,25 @@ def extract_graph_astar(keypoint_mask, road_mask, config):
             checked.add((start, end))
     return graph
 
+def extract_graph_bresenham(kps, cost_field, config):
+    # Connects the keypoints within NEIGHBOR_RADIUS whose line is not blocked, all pairs
+    # checked at once.
+    graph = nx.Graph()
+    if len(kps) == 0:
+        return graph
+    kps = np.asarray(kps, dtype=np.int64)
+    all_neighbor_indices = KDTree(kps).query_radius(kps, r=config.NEIGHBOR_RADIUS)
+    pairs = np.concatenate([
+        np.stack([np.full_like(neighbor_indices, i), neighbor_indices], axis=1)
+        for i, neighbor_indices in enumerate(all_neighbor_indices)
+    ], axis=0)
+    # both directions, the lines may differ
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    connected = are_connected_bresenham(cost_field, kps[pairs[:, 0]], kps[pairs[:, 1]])
+    for i, j in pairs[connected]:
+        graph.add_edge((int(kps[i][0]), int(kps[i][1])), (int(kps[j][0]), int(kps[j][1])))
+    return graph
+
 # takes xys    
 def visualize_image_and_graph(img, graph):
     # Draw nodes as green squares
@@ -0,0 +1,228 @@
+import os
+import pickle
+import unittest
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+# Flat binary graph files, written next to the sat2graph pickles by the inferencer and
+# read by cityscale_metrics / spacenet_metrics.
+#
+# Layout, little endian, every array 4-byte aligned:
+#   header      64 bytes, see HEADER_DTYPE
+#   nodes       float32 [N_node, 2], same coordinates as the keys of the sat2graph dict
+#   edges       int32 [N_edge, 2], (src, dst) node indices, undirected
+#   edge_scores float32 [N_edge, ], if HAS_EDGE_SCORES is set in flags
+#
+# Only depends on numpy, so the metric scripts can import it.
+
+
+GRAPH_SUFFIX = '.graph'
+MAGIC = b'SAMGRAPH'
+VERSION = 1
+HAS_EDGE_SCORES = 1
+
+# Node coordinate conventions:
+# rc: (row, col) pixels.
+# rc_flip: (height - row, col) pixels, the convention of the SpaceNet metrics.
+COORDS = ('rc', 'rc_flip')
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('flags', '<u4'),
+    ('node_num', '<u8'),
+    ('edge_num', '<u8'),
+    ('coords', 'S16'),
+    ('height', '<f4'),
+    ('reserved', 'V12'),
+])
+assert HEADER_DTYPE.itemsize == 64
+
+
+def save_graph(path, nodes, edges, edge_scores=None, coords='rc', height=0.0):
+    # nodes: [N_node, 2], edges: [N_edge, 2], edge_scores: [N_edge, ] or None.
+    assert coords in COORDS, f'unknown coords {coords}'
+    nodes = np.ascontiguousarray(np.asarray(nodes, dtype='<f4').reshape(-1, 2))
+    edges = np.ascontiguousarray(np.asarray(edges, dtype='<i4').reshape(-1, 2))
+    header = np.zeros((1, ), dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['flags'] = HAS_EDGE_SCORES if edge_scores is not None else 0
+    header['node_num'] = nodes.shape[0]
+    header['edge_num'] = edges.shape[0]
+    header['coords'] = coords.encode()
+    header['height'] = height
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(nodes.tobytes())
+        f.write(edges.tobytes())
+        if edge_scores is not None:
+            edge_scores = np.asarray(edge_scores, dtype='<f4').reshape(-1)
+            assert edge_scores.shape[0] == edges.shape[0]
+            f.write(edge_scores.tobytes())
+
+
+def read_header(path):
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if header.shape[0] == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f'{path} is not a graph file')
+    if header['version'][0] != VERSION:
+        raise ValueError(f'{path} has unsupported version {header["version"][0]}')
+    return {
+        'node_num': int(header['node_num'][0]),
+        'edge_num': int(header['edge_num'][0]),
+        'has_edge_scores': bool(header['flags'][0] & HAS_EDGE_SCORES),
+        'coords': header['coords'][0].decode(),
+        'height': float(header['height'][0]),
+    }
+
+
+def load_graph(path, mmap=True):
+    # Returns (nodes, edges, edge_scores or None, header). With mmap the arrays are
+    # read-only views of the file.
+    header = read_header(path)
+    node_num, edge_num = header['node_num'], header['edge_num']
+    offset = HEADER_DTYPE.itemsize
+    arrays = []
+    for dtype, shape in [('<f4', (node_num, 2)), ('<i4', (edge_num, 2)), ('<f4', (edge_num, ))]:
+        if len(arrays) == 2 and not header['has_edge_scores']:
+            arrays.append(None)
+            break
+        size = int(np.prod(shape))
+        if size == 0:
+            array = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            array = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                array = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+        arrays.append(array)
+        offset += size * 4
+    nodes, edges, edge_scores = arrays
+    return nodes, edges, edge_scores, header
+
+
+def unique_undirected_edges(edges, edge_scores=None):
+    # Keeps each undirected edge once as (min, max), with the max score of its directions.
+    edges = np.sort(np.asarray(edges).reshape(-1, 2), axis=1)
+    edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+    if edge_scores is None:
+        return edges, None
+    unique_scores = np.full((edges.shape[0], ), -np.inf, dtype=np.float32)
+    np.maximum.at(unique_scores, inverse.reshape(-1), np.asarray(edge_scores, dtype=np.float32))
+    return edges, unique_scores
+
+
+def get_rc_nodes(nodes, header):
+    # Nodes of load_graph in (row, col) pixels.
+    if header['coords'] == 'rc_flip':
+        return np.stack([header['height'] - nodes[:, 0], nodes[:, 1]], axis=1)
+    return np.asarray(nodes)
+
+
+def to_sat2graph(nodes, edges):
+    # Converts a graph to the same format as the labels in Sat2Graph, see
+    # graph_utils.convert_to_sat2graph_format.
+    nodes, edges = np.asarray(nodes), np.asarray(edges).reshape(-1, 2)
+    all_edges = np.concatenate((edges, edges[:, ::-1]), axis=0)
+    adj_table = [set() for _ in range(len(nodes))]
+    for start_idx, end_idx in all_edges.tolist():
+        adj_table[start_idx].add(end_idx)
+
+    int_nodes = [(round(x), round(y)) for x, y in nodes.tolist()]
+
+    result = dict()
+    for node_idx, neighbor_indices in enumerate(adj_table):
+        # Notice, we expect the input graph has gone through node-merging so
+        # there shouldn't be two nodes at the same pixel location.
+        key = int_nodes[node_idx]
+        value = [int_nodes[neighbor_idx] for neighbor_idx in neighbor_indices]
+        result[key] = value
+    return result
+
+
+def from_sat2graph(graph):
+    # Converts a sat2graph dict to float32 nodes [N_node, 2] and int32 edges [N_edge, 2],
+    # with every undirected edge once.
+    node_to_idx = dict()
+    for node, neighbors in graph.items():
+        for n in [node] + list(neighbors):
+            if n not in node_to_idx:
+                node_to_idx[n] = len(node_to_idx)
+    nodes = np.array(list(node_to_idx.keys()), dtype=np.float32).reshape(-1, 2)
+    edges = np.array([
+        (node_to_idx[node], node_to_idx[neighbor])
+        for node, neighbors in graph.items() for neighbor in neighbors
+    ], dtype=np.int32).reshape(-1, 2)
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    return nodes, edges
+
+
+def load_sat2graph(path):
+    # Loads a graph as a sat2graph dict, from a graph file or a pickle. Without a suffix,
+    # path + GRAPH_SUFFIX is preferred over path + '.p'.
+    if not os.path.splitext(path)[1]:
+        path = path + GRAPH_SUFFIX if os.path.exists(path + GRAPH_SUFFIX) else path + '.p'
+    if path.endswith(GRAPH_SUFFIX):
+        nodes, edges, _, _ = load_graph(path)
+        return to_sat2graph(nodes, edges)
+    with open(path, 'rb') as f:
+        return pickle.load(f, encoding='latin1')
+
+
+class TestGraphIo(unittest.TestCase):
+    def test_round_trip(self):
+        import tempfile
+        nodes = np.array([[0.0, 0.0], [1.5, 2.0], [10.0, 3.0]])
+        edges = np.array([[0, 1], [1, 2]])
+        edge_scores = np.array([0.7, 0.9])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, '1.graph')
+            save_graph(path, nodes, edges, edge_scores, coords='rc_flip', height=400)
+            for mmap in (True, False):
+                loaded_nodes, loaded_edges, loaded_scores, header = load_graph(path, mmap=mmap)
+                np.testing.assert_array_equal(loaded_nodes, nodes)
+                np.testing.assert_array_equal(loaded_edges, edges)
+                np.testing.assert_almost_equal(loaded_scores, edge_scores)
+            self.assertEqual(header['coords'], 'rc_flip')
+            edges, scores = unique_undirected_edges(np.array([[1, 0], [0, 1], [2, 1]]), np.array([0.2, 0.6, 0.4]))
+            np.testing.assert_array_equal(edges, [[0, 1], [1, 2]])
+            np.testing.assert_almost_equal(scores, [0.6, 0.4])
+            np.testing.assert_array_equal(get_rc_nodes(loaded_nodes, header)[:, 0], 400 - nodes[:, 0])
+
+            save_graph(path, np.zeros((0, 2)), np.zeros((0, 2)))
+            loaded_nodes, loaded_edges, loaded_scores, _ = load_graph(path)
+            self.assertEqual(loaded_nodes.shape, (0, 2))
+            self.assertIsNone(loaded_scores)
+
+    def test_sat2graph(self):
+        graph = {(0, 0): [(1, 1)], (1, 1): [(0, 0), (2, 2)], (2, 2): [(1, 1)]}
+        nodes, edges = from_sat2graph(graph)
+        np.testing.assert_array_equal(edges, [[0, 1], [1, 2]])
+        result = to_sat2graph(nodes, edges)
+        self.assertEqual(result.keys(), graph.keys())
+        for k, v in result.items():
+            self.assertSetEqual(set(v), set(graph[k]))
+
+
+parser = ArgumentParser()
+parser.add_argument("inputs", nargs='+', help="graph files or sat2graph pickles.")
+parser.add_argument("--to", default='graph', choices=['graph', 'sat2graph'], help="output format, written next to the input.")
+parser.add_argument("--coords", default='rc', choices=COORDS, help="node convention of sat2graph inputs.")
+parser.add_argument("--height", default=0.0, type=float, help="image height of rc_flip nodes.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    for path in args.inputs:
+        stem = os.path.splitext(path)[0]
+        if args.to == 'graph':
+            nodes, edges = from_sat2graph(load_sat2graph(path))
+            save_graph(stem + GRAPH_SUFFIX, nodes, edges, coords=args.coords, height=args.height)
+        else:
+            with open(stem + '.p', 'wb') as f:
+                pickle.dump(load_sat2graph(path), f)
+        print(f'Converted {path}')
@@ -9,11 +9,15 @@ from shapely.geometry import Point, LineString
 from shapely.strtree import STRtree
 from collections import deque
 import unittest
+from functools import lru_cache
+import cv2
 
 import igraph as ig
 import rtree
 import scipy
 
+import graph_io
+
 
 def inspect_graph(node_array, edge_array):
     # node_array: [N_node, 2] coordinates of nodes.
@@ -380,6 +384,29 @@ def merge_into_large_graph(nodes, edges, merge_node_dist_thresh, split_edge_dist
     return nodes4, edges4
 
 
+def aggregate_edge_scores(edges, scores, node_num):
+    # Averages the scores of repeated edge queries, e.g. the same pair of
+    # points scored in several overlapping patches.
+    # edges: [N_query, 2] (src_idx, dst_idx) pairs, may contain duplicates.
+    # scores: [N_query, ] score of each query.
+    # node_num: number of nodes the indices refer to.
+    # Returns:
+    # unique_edges: [N_edge, 2] directed edges, in order of first appearance.
+    # mean_scores: [N_edge, ] average score of each edge.
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    # packs (src, dst) into a single id
+    edge_ids = edges[:, 0] * node_num + edges[:, 1]
+    unique_ids, first_indices, inverse = np.unique(edge_ids, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    score_sums = np.bincount(inverse, weights=scores, minlength=unique_ids.shape[0])
+    counts = np.bincount(inverse, minlength=unique_ids.shape[0])
+    # restores first-appearance order
+    order = np.argsort(first_indices, kind='stable')
+    unique_edges = np.stack([unique_ids // node_num, unique_ids % node_num], axis=1)[order, :]
+    mean_scores = (score_sums / np.maximum(counts, 1))[order]
+    return unique_edges, mean_scores
+
+
 def convert_to_sat2graph_format(nodes, edges):
     # Converts a graph to the same format as the labels
     # in Sat2Graph.
@@ -388,21 +415,7 @@ def convert_to_sat2graph_format(nodes, edges):
     # Returns: A dict. Keys are (row, col) coordinates of each node. Float inputs will be rounded to int.
     # Values are lists, each item being a (row, col) of a neighbor node.
     # Edges are not directed. Input edges will be combined with reverse edges.
-    reverse_edges = edges[:, ::-1]
-    all_edges = np.concatenate((edges, reverse_edges), axis=0)
-
-    adj_table = edge_list_to_adj_table(nodes, all_edges)
-    
-    int_nodes = [(round(x), round(y)) for x, y in nodes]
-    
-    result = dict()
-    for node_idx, neighbor_indices in enumerate(adj_table):
-        # Notice, we expect the input graph has gone through node-merging so
-        # there shouldn't be two nodes at the same pixel location.
-        key = int_nodes[node_idx]
-        value = [int_nodes[neighbor_idx] for neighbor_idx in neighbor_indices]
-        result[key] = value
-    return result
+    return graph_io.to_sat2graph(nodes, edges)
 
 
 def convert_from_sat2graph_format(graph):
@@ -574,22 +587,159 @@ def nms_points(points, scores, radius, return_indices=False):
     sorted_indices = np.argsort(scores)[::-1]
     sorted_points = points[sorted_indices, :]
     sorted_scores = scores[sorted_indices]
-    kept = np.ones(sorted_indices.shape[0], dtype=bool)
-    tree = scipy.spatial.KDTree(sorted_points)
-    for idx, p in enumerate(sorted_points):
-        if not kept[idx]:
-            continue
-        # neighbor_indices = tree.query_radius(p[np.newaxis, :], r=radius)[0]
-        neighbor_indices = tree.query_ball_point(p, r=radius)
-        neighbor_scores = sorted_scores[neighbor_indices]
-        keep_nbr = np.greater(neighbor_scores, 1.0)
-        kept[neighbor_indices] = keep_nbr
-        kept[idx] = True
+    kept = greedy_nms_sorted(sorted_points, sorted_scores, np.full(sorted_indices.shape[0], radius, dtype=np.float64))
     if return_indices:
         return sorted_points[kept], sorted_indices[kept]
     else:
         return sorted_points[kept]
 
+
+def nms_points_batch(all_points, all_scores, radius, return_indices=False):
+    # nms_points over several point sets at once, radius is a scalar or one per set.
+    # Returns a list of what nms_points returns for each set.
+    radii = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(all_points), ))
+    all_sorted_indices = [np.argsort(scores)[::-1] for scores in all_scores]
+    all_sorted_points = [points[sorted_indices, :] for points, sorted_indices in zip(all_points, all_sorted_indices)]
+    set_sizes = [sorted_indices.shape[0] for sorted_indices in all_sorted_indices]
+    sorted_points = np.concatenate([np.zeros((0, 2))] + all_sorted_points, axis=0)
+    sorted_scores = np.concatenate([np.zeros((0, ))] + [
+        scores[sorted_indices] for scores, sorted_indices in zip(all_scores, all_sorted_indices)
+    ])
+    kept = greedy_nms_sorted(
+        sorted_points, sorted_scores, np.repeat(radii, set_sizes),
+        set_ids=np.repeat(np.arange(len(all_points)), set_sizes))
+    results = []
+    for set_points, sorted_indices, set_kept in zip(all_sorted_points, all_sorted_indices, np.split(kept, np.cumsum(set_sizes)[:-1])):
+        if return_indices:
+            results.append((set_points[set_kept], sorted_indices[set_kept]))
+        else:
+            results.append(set_points[set_kept])
+    return results
+
+
+def greedy_nms_sorted(sorted_points, sorted_scores, radii, set_ids=None):
+    # sorted_points: [N, 2] by descending score within each set of set_ids [N, ], radii: [N, ]
+    # suppression radius of each point. Greedy NMS in that order, returns the kept mask [N, ].
+    # A point is suppressed by an earlier kept point of its set within (inclusive) its
+    # radius, unless its score > 1.0.
+    point_num = sorted_points.shape[0]
+    forced = np.greater(sorted_scores, 1.0)
+    kept = forced.copy()
+    candidate_indices = np.flatnonzero(~forced)
+    if point_num == 0 or candidate_indices.shape[0] == 0:
+        return kept
+    sorted_points = sorted_points.astype(np.float64)
+    if set_ids is None:
+        set_ids = np.zeros((point_num, ), dtype=np.int64)
+
+    # forced points come first in the order and are always kept, they suppress in one
+    # batched query. Sets are apart by more than any radius along a third axis.
+    alive = np.zeros((point_num, ), dtype=bool)
+    alive[candidate_indices] = True
+    if candidate_indices.shape[0] < point_num:
+        set_coords = set_ids[:, np.newaxis] * (2 * float(radii.max()) + 1)
+        tree = scipy.spatial.KDTree(np.concatenate([sorted_points, set_coords], axis=1)[forced])
+        near_forced = tree.query_ball_point(
+            np.concatenate([sorted_points, set_coords], axis=1)[candidate_indices],
+            r=radii[candidate_indices], return_length=True) > 0
+        alive[candidate_indices[near_forced]] = False
+
+    # buckets the candidates into a grid of cells a bit larger than the radius, so that
+    # rounding never puts points within the radius more than one cell apart. Rows of
+    # cells are padded by one, then the 3 cells of a row next to a cell are one key range.
+    cell_size = float(radii.max()) * (1 + 1e-6) if radii.max() > 0 else 1.0
+    cells = np.floor((sorted_points - sorted_points.min(axis=0)) / cell_size).astype(np.int64)
+    row_width = int(cells[:, 0].max()) + 3
+    row_num = int(cells[:, 1].max()) + 3
+    keys = ((set_ids * row_num) + cells[:, 1] + 1) * row_width + cells[:, 0] + 1
+    cell_order = candidate_indices[np.argsort(keys[candidate_indices], kind='stable')]
+    cell_keys = keys[cell_order]
+    cell_points = sorted_points[cell_order]
+
+    # only visits the points that end up kept
+    position, window = 0, 1024
+    while position < point_num:
+        alive_indices = np.flatnonzero(alive[position:position + window])
+        if alive_indices.shape[0] == 0:
+            position += window
+            continue
+        idx = position + alive_indices[0]
+        kept[idx] = True
+        # key ranges of the 3 cells above, at and below the point
+        range_keys = keys[idx] - 1 + np.array([-row_width, 0, row_width])
+        starts = np.searchsorted(cell_keys, range_keys, side='left')
+        ends = np.searchsorted(cell_keys, range_keys + 2, side='right')
+        neighbor_slots = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        offsets = cell_points[neighbor_slots] - sorted_points[idx]
+        near = offsets[:, 0] * offsets[:, 0] + offsets[:, 1] * offsets[:, 1] <= radii[idx] * radii[idx]
+        alive[cell_order[neighbor_slots[near]]] = False
+        position = idx + 1
+    return kept
+
+
+
+@lru_cache(maxsize=None)
+def get_disc_stamp(radius):
+    # [2 * radius + 1, 2 * radius + 1] uint8, 1 on the pixels of a filled cv2.circle of radius.
+    stamp = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(stamp, (radius, radius), radius, 1, -1)
+    stamp.flags.writeable = False
+    return stamp
+
+
+def get_disc_indices(points, radius, shape):
+    # Flat indices into an image of shape (H, W) of the pixels of filled cv2.circles of
+    # radius at integer points [N, 2] (x, y), and the point index of each pixel. The disc
+    # stamp is scattered at all points at once, discs crossing the border are clipped.
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width = shape[:2]
+    dys, dxs = np.nonzero(get_disc_stamp(radius))
+    dys, dxs = dys - radius, dxs - radius
+    inner = (
+        (points[:, 0] >= radius) & (points[:, 0] < width - radius)
+        & (points[:, 1] >= radius) & (points[:, 1] < height - radius)
+    )
+    inner_indices, border_indices = np.flatnonzero(inner), np.flatnonzero(~inner)
+    # most discs are within the image, one add of the flat offsets
+    inner_bases = points[inner_indices, 1] * width + points[inner_indices, 0]
+    all_flat = [(inner_bases[:, np.newaxis] + (dys * width + dxs)[np.newaxis, :]).reshape(-1)]
+    all_point_indices = [np.repeat(inner_indices, dys.shape[0])]
+    rows = (points[border_indices, 1][:, np.newaxis] + dys[np.newaxis, :]).reshape(-1)
+    cols = (points[border_indices, 0][:, np.newaxis] + dxs[np.newaxis, :]).reshape(-1)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    all_flat.append(rows[inside] * width + cols[inside])
+    all_point_indices.append(np.repeat(border_indices, dys.shape[0])[inside])
+    return np.concatenate(all_flat), np.concatenate(all_point_indices)
+
+
+def stamp_discs(img, points, radius, value):
+    # In place cv2.circle(img, point, radius, value, -1) of all points [N, 2] (x, y).
+    flat_indices, _ = get_disc_indices(points, radius, img.shape)
+    img.reshape(-1)[flat_indices] = value
+    return img
+
+
+def get_line_pixels(starts, ends):
+    # Pixels of skimage.draw.line from (x, y) starts [N, 2] to ends [N, 2], all lines at
+    # once. Returns rows, cols [N_pixels, ] and the line index [N_pixels, ] of each, line
+    # by line from start to end.
+    starts = np.asarray(starts, dtype=np.int64).reshape(-1, 2)
+    deltas = np.asarray(ends, dtype=np.int64).reshape(-1, 2) - starts
+    # steps along the major axis, y only if it moves strictly more, the minor axis
+    # follows the bresenham error term
+    major_len = np.abs(deltas).max(axis=1)
+    minor_len = np.abs(deltas).min(axis=1)
+    x_major = np.abs(deltas[:, 0]) >= np.abs(deltas[:, 1])
+    signs = np.sign(deltas)
+    line_indices = np.repeat(np.arange(starts.shape[0]), major_len + 1)
+    steps = np.arange(line_indices.shape[0]) - np.repeat(np.cumsum(major_len + 1) - (major_len + 1), major_len + 1)
+    minor_steps = (2 * minor_len[line_indices] * steps - major_len[line_indices]) // np.maximum(2 * major_len[line_indices], 1) + 1
+    # a single pixel line has no step
+    minor_steps[steps == 0] = 0
+    cols = starts[line_indices, 0] + np.where(x_major, signs[:, 0], 0)[line_indices] * steps + np.where(x_major, 0, signs[:, 0])[line_indices] * minor_steps
+    rows = starts[line_indices, 1] + np.where(x_major, 0, signs[:, 1])[line_indices] * steps + np.where(x_major, signs[:, 1], 0)[line_indices] * minor_steps
+    return rows, cols, line_indices
+
     
 def bfs_with_conditions(graph, start_node, stop_nodes, max_depth):
     """
@@ -684,6 +834,15 @@ class TestGraphUtils(unittest.TestCase):
         gt_vertices = np.array([[10.0, 2.0], [10.0, -2.0], [0.0, -2.0], [0.0, 2.0], [10.0, 2.0]])
         np.testing.assert_almost_equal(vertices_array, gt_vertices)
 
+    def test_aggregate_edge_scores(self):
+        edges = np.array([[2, 0], [0, 1], [2, 0], [1, 0], [0, 1]])
+        scores = np.array([0.2, 0.5, 0.6, 0.9, 0.7])
+        unique_edges, mean_scores = aggregate_edge_scores(edges, scores, 3)
+        gt_edges = np.array([[2, 0], [0, 1], [1, 0]])
+        gt_scores = np.array([0.4, 0.6, 0.9])
+        np.testing.assert_array_equal(unique_edges, gt_edges)
+        np.testing.assert_almost_equal(mean_scores, gt_scores)
+
     def test_convert_to_sat2graph_format(self):
         nodes = np.array([[0.0, 0.0], [1.1, 1.1], [1.6, 1.6]])
         edges = np.array([[0, 1], [1, 2]])
@@ -748,6 +907,50 @@ class TestGraphUtils(unittest.TestCase):
         self.assertEqual(len(g1.vs['point']), 11)
         self.assertEqual(len(g1.es), 10)
 
+    def test_nms_points(self):
+        points = np.array([[0, 0], [3, 4], [6, 8], [20, 20], [21, 20], [40, 40]])
+        scores = np.array([0.9, 0.8, 0.7, 0.6, 2.0, 0.5])
+        # (0, 0) suppresses (3, 4) at exactly the radius, (21, 20) is forced and suppresses (20, 20)
+        kept_points, kept_indices = nms_points(points, scores, 5.0, return_indices=True)
+        np.testing.assert_array_equal(kept_indices, [4, 0, 2, 5])
+        np.testing.assert_array_equal(kept_points, points[[4, 0, 2, 5]])
+        # forced points are never suppressed
+        np.testing.assert_array_equal(nms_points(points, scores + 2.0, 5.0), points[np.argsort(scores)[::-1]])
+
+        # same as the greedy definition on random sets, batched with per-set radii
+        rng = np.random.default_rng(0)
+        all_points = [rng.integers(0, 50, (n, 2)) for n in (0, 1, 200, 300)]
+        all_scores = [rng.integers(0, 4, points.shape[0]) * 0.5 for points in all_points]
+        radii = [3.0, 5.0, 5.0, 2.5]
+        results = nms_points_batch(all_points, all_scores, radii, return_indices=True)
+        for points, scores, radius, (kept_points, kept_indices) in zip(all_points, all_scores, radii, results):
+            gt_kept = []
+            for idx in np.argsort(scores)[::-1]:
+                if scores[idx] > 1.0 or all(np.sum((points[idx] - points[k]) ** 2) > radius ** 2 for k in gt_kept):
+                    gt_kept.append(idx)
+            np.testing.assert_array_equal(kept_indices, gt_kept)
+            np.testing.assert_array_equal(kept_points, points[gt_kept].reshape(-1, 2))
+            np.testing.assert_array_equal(nms_points(points, scores, radius, return_indices=True)[1], gt_kept)
+
+    def test_stamped_discs_and_lines(self):
+        from skimage.draw import line
+        rng = np.random.default_rng(0)
+        # discs crossing the border are clipped like cv2.circle
+        points = rng.integers(0, 40, (50, 2))
+        img, gt_img = np.zeros((30, 40), dtype=np.uint8), np.zeros((30, 40), dtype=np.uint8)
+        stamp_discs(img, points, 4, 7)
+        for point in points:
+            cv2.circle(gt_img, (int(point[0]), int(point[1])), 4, 7, -1)
+        np.testing.assert_array_equal(img, gt_img)
+
+        starts, ends = rng.integers(-5, 30, (100, 2)), rng.integers(-5, 30, (100, 2))
+        ends[0] = starts[0]
+        rows, cols, line_indices = get_line_pixels(starts, ends)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            gt_rows, gt_cols = line(start[1], start[0], end[1], end[0])
+            np.testing.assert_array_equal(rows[line_indices == i], gt_rows)
+            np.testing.assert_array_equal(cols[line_indices == i], gt_cols)
+
 
 if __name__ == '__main__':
     unittest.main()
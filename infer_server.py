@@ -0,0 +1,267 @@
+import base64
+import io
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import cv2
+import numpy as np
+import torch
+
+from utils import load_config
+from dataset import read_rgb_img
+from infer_utils import load_inference_net
+import inferencer
+import sweep_inference
+
+
+# Keeps the model resident and serves tile jobs over localhost HTTP or a Unix socket.
+#
+# POST /infer, JSON body:
+#   image_path: path of an image readable by the server, or
+#   image_npy: base64 of an [H, W, 3] uint8 RGB array saved with np.save
+#   overrides: optional dict of config overrides, keys from OVERRIDABLE_KEYS
+#   return_masks: optional, also returns the fused masks as base64 PNGs
+# Returns JSON with nodes [N, 2] (r, c), edges [M, 2] and, if asked,
+# keypoint_mask_png / road_mask_png.
+#
+# GET /health returns the server status.
+#
+# Concurrent jobs of the same tile size and overrides are packed into one
+# infer_imgs call, see inferencer.infer_imgs.
+
+
+# Only post-processing configs can be overridden, the model is shared by all jobs.
+OVERRIDABLE_KEYS = {
+    'ITSC_THRESHOLD',
+    'ROAD_THRESHOLD',
+    'TOPO_THRESHOLD',
+    'ITSC_NMS_RADIUS',
+    'ROAD_NMS_RADIUS',
+    'NEIGHBOR_RADIUS',
+    'MAX_NEIGHBOR_QUERIES',
+}
+
+
+class InferJob:
+    def __init__(self, img, overrides):
+        self.img = img
+        self.overrides = overrides
+        self.future = Future()
+
+    def batch_key(self):
+        # jobs sharing a key can be packed into one infer_imgs call
+        return self.img.shape, tuple(sorted(self.overrides.items()))
+
+
+class MicroBatcher:
+    """Runs all model work on a single thread, packing concurrent jobs.
+
+    The first queued job opens a batch; jobs with the same batch key arriving within
+    batch_wait_ms join it, up to max_batch_imgs. Jobs with another key wait for the
+    next batch in arrival order.
+    """
+
+    def __init__(self, net, config, max_batch_imgs=8, batch_wait_ms=10):
+        self.net = net
+        self.config = config
+        self.max_batch_imgs = max_batch_imgs
+        self.batch_wait_seconds = batch_wait_ms / 1000.0
+        self.jobs = queue.Queue()
+        # jobs taken from the queue that didn't fit in the last batch
+        self.deferred = []
+        self.served_imgs = 0
+        self.served_batches = 0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+        return job.future.result()
+
+    def next_job(self, timeout=None):
+        if self.deferred:
+            return self.deferred.pop(0)
+        return self.jobs.get(timeout=timeout)
+
+    def collect_batch(self):
+        first = self.next_job()
+        batch = [first]
+        key = first.batch_key()
+        # square tiles only, others go through the sweep one by one
+        if first.img.shape[0] != first.img.shape[1]:
+            return batch
+        deadline = time.time() + self.batch_wait_seconds
+        skipped = []
+        while len(batch) < self.max_batch_imgs:
+            remaining = deadline - time.time()
+            if remaining <= 0 and not self.deferred:
+                break
+            try:
+                job = self.next_job(timeout=max(remaining, 0.0))
+            except queue.Empty:
+                break
+            if job.batch_key() == key:
+                batch.append(job)
+            else:
+                skipped.append(job)
+        self.deferred = skipped + self.deferred
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                results = self.infer_batch(batch)
+            except Exception as e:
+                for job in batch:
+                    job.future.set_exception(e)
+                continue
+            for job, result in zip(batch, results):
+                job.future.set_result(result)
+            self.served_imgs += len(batch)
+            self.served_batches += 1
+
+    def infer_batch(self, batch):
+        config = self.config.deepcopy()
+        config.update(batch[0].overrides)
+        imgs = [job.img for job in batch]
+        if len(imgs) == 1 and imgs[0].shape[0] != imgs[0].shape[1]:
+            return [sweep_inference.infer_one_img_sweep(self.net, imgs[0], config)]
+        if len(imgs) == 1:
+            return [inferencer.infer_one_img(self.net, imgs[0], config)]
+        return inferencer.infer_imgs(self.net, imgs, config)
+
+
+def encode_png(mask):
+    _, png = cv2.imencode('.png', mask)
+    return base64.b64encode(png.tobytes()).decode('ascii')
+
+
+def decode_npy(data):
+    return np.load(io.BytesIO(base64.b64decode(data)), allow_pickle=False)
+
+
+class InferRequestHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    batcher = None
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        self.send_json(200, {
+            'status': 'ok',
+            'served_imgs': self.batcher.served_imgs,
+            'served_batches': self.batcher.served_batches,
+        })
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if 'image_path' in request:
+                img = read_rgb_img(request['image_path'])
+            else:
+                img = decode_npy(request['image_npy'])
+            assert img.ndim == 3 and img.dtype == np.uint8, 'expects an [H, W, 3] uint8 RGB image'
+            overrides = dict(request.get('overrides', {}))
+            unknown = set(overrides) - OVERRIDABLE_KEYS
+            assert not unknown, f'cannot override {sorted(unknown)}'
+        except Exception as e:
+            self.send_json(400, {'error': repr(e)})
+            return
+
+        start_seconds = time.time()
+        try:
+            pred_nodes, pred_edges, itsc_mask, road_mask = self.batcher.submit(
+                InferJob(img[:, :, :3], overrides))
+        except Exception as e:
+            self.send_json(500, {'error': repr(e)})
+            return
+        response = {
+            'nodes': np.asarray(pred_nodes).tolist(),
+            'edges': np.asarray(pred_edges).tolist(),
+            'seconds': time.time() - start_seconds,
+        }
+        if request.get('return_masks', False):
+            response['keypoint_mask_png'] = encode_png(itsc_mask)
+            response['road_mask_png'] = encode_png(road_mask)
+        self.send_json(200, response)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        # attributes BaseHTTPRequestHandler expects from HTTPServer
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def serve(batcher, host='127.0.0.1', port=8765, unix_socket=None):
+    InferRequestHandler.batcher = batcher
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, InferRequestHandler)
+        print(f'Serving on unix socket {unix_socket}')
+    else:
+        server = ThreadingHTTPServer((host, port), InferRequestHandler)
+        print(f'Serving on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model to serve."
+)
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+parser.add_argument("--host", default="127.0.0.1", help="host to listen on, keep it local")
+parser.add_argument("--port", default=8765, type=int, help="port to listen on")
+parser.add_argument("--unix_socket", default=None, help="serves on this unix socket instead of tcp")
+parser.add_argument("--max_batch_imgs", default=8, type=int, help="max tiles packed into one batch")
+parser.add_argument("--batch_wait_ms", default=10, type=float, help="how long a batch waits for more tiles")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.enabled = True
+    net = load_inference_net(config, args.checkpoint, device)
+
+    batcher = MicroBatcher(net, config, max_batch_imgs=args.max_batch_imgs, batch_wait_ms=args.batch_wait_ms)
+    serve(batcher, host=args.host, port=args.port, unix_socket=args.unix_socket)
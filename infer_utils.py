@@ -0,0 +1,421 @@
+import numpy as np
+import torch
+import scipy
+import functools
+import contextlib
+import queue
+import threading
+import time
+import unittest
+
+from dataset import get_patch_grid
+import topo_dedup
+
+
+def load_model(config, checkpoint_path, device):
+    # Builds the eval model from a trained checkpoint.
+    # Imported here so that modules only sharing the helpers below don't pull in lightning.
+    from model import SAMRoad
+    net = SAMRoad(config)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    print(f'##### Loading Trained CKPT {checkpoint_path} #####')
+    net.load_state_dict(checkpoint["state_dict"], strict=True)
+    net.eval()
+    net.to(device)
+    return net
+
+
+def load_inference_net(config, checkpoint_path, device):
+    # Model or backend selected by INFER_BACKEND, all expose device,
+    # infer_masks_and_img_features and infer_toponet.
+    backend = config.get('INFER_BACKEND', 'torch')
+    if backend == 'torch':
+        return load_model(config, checkpoint_path, device)
+    if backend == 'cpu':
+        from cpu_backend import build_cpu_backend
+        return build_cpu_backend(load_model(config, checkpoint_path, torch.device('cpu')), config)
+    if backend == 'onnx':
+        # checkpoint_path is the output dir of export_onnx.py
+        from onnx_backend import build_onnx_backend
+        return build_onnx_backend(checkpoint_path, config)
+    raise ValueError(f'unknown INFER_BACKEND {backend}')
+
+
+#### Pass 1: patches -> masks and img features
+
+def upload_img(img, device):
+    # [H, W, C] uint8 numpy -> uint8 tensor on device. Only the raw image is copied,
+    # patches are cropped and converted to float on the device.
+    img_tensor = torch.from_numpy(np.ascontiguousarray(img))
+    if device.type == 'cuda':
+        return img_tensor.pin_memory().to(device, non_blocking=True)
+    return img_tensor.to(device)
+
+
+def get_patch_pixel_indices(batch_patch_info, image_width, device, image_height=0):
+    # Flat indices into an [IMG_H * IMG_W] canvas of every pixel of every patch.
+    # With image_height, the canvas is [N_img * IMG_H * IMG_W] and patches are
+    # offset by their image index.
+    # Returns [B * H * W] long tensor, ordered like [B, H, W] patches.
+    img_offsets = torch.tensor([i * image_height * image_width for i, _, _ in batch_patch_info], device=device).view(-1, 1, 1)
+    x0 = torch.tensor([x0 for _, (x0, _), _ in batch_patch_info], device=device).view(-1, 1, 1)
+    y0 = torch.tensor([y0 for _, (_, y0), _ in batch_patch_info], device=device).view(-1, 1, 1)
+    _, (x_begin, y_begin), (x_end, y_end) = batch_patch_info[0]
+    rows = y0 + torch.arange(y_end - y_begin, device=device).view(1, -1, 1)
+    cols = x0 + torch.arange(x_end - x_begin, device=device).view(1, 1, -1)
+    return (img_offsets + rows * image_width + cols).view(-1)
+
+
+def get_batch_img_patches(img_tensor, batch_patch_info):
+    # img_tensor: [IMG_H, IMG_W, C] or stacked [N_img, IMG_H, IMG_W, C] uint8 on device, from upload_img.
+    # Returns [B, H, W, C] float32 on the same device.
+    image_height, image_width, channels = img_tensor.shape[-3:]
+    if img_tensor.dim() == 3:
+        image_height = 0
+    _, (x0, y0), (x1, y1) = batch_patch_info[0]
+    pixel_indices = get_patch_pixel_indices(batch_patch_info, image_width, img_tensor.device, image_height)
+    batch = img_tensor.view(-1, channels).index_select(0, pixel_indices)
+    batch = batch.view(len(batch_patch_info), y1 - y0, x1 - x0, channels).to(torch.float32)
+    return batch
+
+
+class PatchBatchLoader:
+    """Iterates over (batch_patch_info, [B, H, W, C] float32 patches) of one image.
+
+    With prefetch > 0, a background thread prepares up to `prefetch` batches ahead,
+    so batch N+1 is cropped while batch N runs through the encoder. On cuda the
+    producer works on its own stream and the consumer waits on a per-batch event.
+    """
+
+    def __init__(self, img_tensor, all_patch_info, batch_size, prefetch=1):
+        self.img_tensor = img_tensor
+        self.all_patch_info = all_patch_info
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.device = img_tensor.device
+
+    def batches(self):
+        for offset in range(0, len(self.all_patch_info), self.batch_size):
+            batch_patch_info = self.all_patch_info[offset : offset + self.batch_size]
+            yield batch_patch_info, get_batch_img_patches(self.img_tensor, batch_patch_info)
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            yield from self.batches()
+            return
+
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        stream = None
+        if self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+            # the non_blocking upload of upload_img runs on the current stream
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            self.img_tensor.record_stream(stream)
+
+        def put(item):
+            # Returns False once the consumer has stopped, a full queue must not block its join.
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                    for batch_patch_info, batch in self.batches():
+                        event = None
+                        if stream is not None:
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                        if not put((batch_patch_info, batch, event)):
+                            return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch_patch_info, batch, event = item
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    batch.record_stream(torch.cuda.current_stream(self.device))
+                yield batch_patch_info, batch
+        finally:
+            stop.set()
+            producer.join()
+
+
+def fuse_batch_masks(fused_masks, mask_scores, batch_patch_info):
+    # Accumulates a batch of patch masks into the canvas in a single scatter.
+    # fused_masks: [IMG_H, IMG_W, 2] or stacked [N_img, IMG_H, IMG_W, 2], modified in place.
+    # mask_scores: [B, H, W, 2]
+    image_height, image_width = fused_masks.shape[-3:-1]
+    if fused_masks.dim() == 3:
+        image_height = 0
+    pixel_indices = get_patch_pixel_indices(batch_patch_info, image_width, fused_masks.device, image_height)
+    fused_masks.view(-1, 2).index_add_(0, pixel_indices, mask_scores.reshape(-1, 2).to(fused_masks.dtype))
+
+
+def get_axis_coverage(length, patch_begins, patch_size):
+    # Number of patches covering each pixel along one axis, [length].
+    # Colliding rounded begins are separate patches and count twice.
+    coverage = np.zeros((length, ), dtype=np.float32)
+    for begin in patch_begins:
+        coverage[begin:begin + patch_size] += 1.0
+    return coverage
+
+
+@functools.lru_cache(maxsize=8)
+def get_pixel_counter(image_size, sample_margin, patch_size, patches_per_edge, device):
+    # Number of patches covering each pixel, [IMG_H, IMG_W].
+    # Only depends on the patch grid, so it's built once per config and shared.
+    # Callers must not modify it in place.
+    # the grid is separable: count coverage along each axis
+    patch_begins = get_patch_grid(image_size, sample_margin, patch_size, patches_per_edge)
+    coverage = get_axis_coverage(image_size, patch_begins, patch_size)
+    pixel_counter = np.outer(coverage, coverage)
+    return torch.tensor(pixel_counter, dtype=torch.float32, device=device)
+
+
+def get_patch_pixel_counter(all_patch_info, img_num, image_size, batch_size, device):
+    # Number of patches of all_patch_info covering each pixel, [N_img, IMG_H, IMG_W],
+    # for patch subsets like the ones kept by road_prefilter. Pixels no patch covers
+    # count 1, their fused masks stay 0.
+    pixel_counter = torch.zeros((img_num, image_size, image_size), dtype=torch.float32, device=device)
+    for offset in range(0, len(all_patch_info), batch_size):
+        batch_patch_info = all_patch_info[offset:offset + batch_size]
+        pixel_indices = get_patch_pixel_indices(batch_patch_info, image_size, device, image_size)
+        pixel_counter.view(-1).index_add_(0, pixel_indices, torch.ones_like(pixel_indices, dtype=torch.float32))
+    return pixel_counter.clamp_(min=1.0)
+
+
+#### Pass 2: graph points + img features -> edge scores
+
+def collated_idx_maps(idx_maps, length):
+    # idx_maps: list of [N_points_i, ] arrays, patch-local point idx -> idx to the full graph.
+    # Returns [B, length] array, padded with 0 like the collated points.
+    collated = np.zeros((len(idx_maps), length), dtype=np.int64)
+    for i, idx_map in enumerate(idx_maps):
+        collated[i, :idx_map.shape[0]] = idx_map
+    return collated
+
+
+class PointIndex:
+    """Neighbor index of the graph points of one or more imgs, built once for pass 2.
+
+    Points of all imgs are concatenated; neighbors never cross imgs. For every point,
+    knn_idx holds all points within NEIGHBOR_RADIUS sorted by distance, so the kNN
+    among the points of any patch is the first MAX_NEIGHBOR_QUERIES of them that
+    are inside the patch.
+    """
+
+    def __init__(self, img_graph_points, max_neighbors, radius):
+        # img_graph_points: list of [N_points_i, 2] (x, y) arrays, one per img.
+        self.img_graph_points = img_graph_points
+        self.point_offsets = np.cumsum([0] + [points.shape[0] for points in img_graph_points])
+        self.point_num = int(self.point_offsets[-1])
+        img_knn_idx = []
+        for offset, points in zip(self.point_offsets, img_graph_points):
+            if points.shape[0] == 0:
+                continue
+            kdtree = scipy.spatial.KDTree(points)
+            # k covers the densest neighborhood, +1 because the nearest one is always self
+            k = int(kdtree.query_ball_point(points, r=radius, return_length=True).max())
+            k = min(max(k, max_neighbors) + 1, points.shape[0])
+            _, knn_idx = kdtree.query(points, k=k, distance_upper_bound=radius)
+            knn_idx = knn_idx.reshape(points.shape[0], k)[:, 1:]  # removes self
+            # missing neighbors are point_num, like missing kdtree results
+            img_knn_idx.append(np.where(knn_idx < points.shape[0], knn_idx + offset, self.point_num))
+        width = max([max_neighbors] + [knn_idx.shape[1] for knn_idx in img_knn_idx])
+        # [N_points, width] indices to all points
+        self.knn_idx = np.full((self.point_num, width), self.point_num, dtype=np.int64)
+        row = 0
+        for knn_idx in img_knn_idx:
+            self.knn_idx[row:row + knn_idx.shape[0], :knn_idx.shape[1]] = knn_idx
+            row += knn_idx.shape[0]
+
+    def points_in_box(self, img_index, box):
+        # Sorted indices to all points of the points of img img_index inside box, borders included.
+        indices = get_points_in_box(self.img_graph_points[img_index], box)
+        return indices + self.point_offsets[img_index]
+
+    def patch_neighbors(self, patch_point_indices, max_neighbors, source_indices=None):
+        # patch_point_indices: sorted [N_points_i, ] indices of the points inside a patch.
+        # source_indices: sorted subset of patch_point_indices to query, defaults to all.
+        # Returns the patch-local [N_sources, max_neighbors] kNN indices of each source
+        # among the patch points and their validity.
+        in_patch = np.zeros((self.point_num + 1, ), dtype=bool)
+        in_patch[patch_point_indices] = True
+        if source_indices is None:
+            source_indices = patch_point_indices
+        knn_idx = self.knn_idx[source_indices, :]
+        valid = in_patch[knn_idx]
+        # first max_neighbors neighbors inside the patch, keeping the distance order
+        order = np.argsort(~valid, axis=1, kind='stable')[:, :max_neighbors]
+        knn_idx = np.take_along_axis(knn_idx, order, axis=1)
+        valid = np.take_along_axis(valid, order, axis=1)
+        local_idx = np.searchsorted(patch_point_indices, knn_idx)
+        return local_idx, valid
+
+
+def prepare_topo_queries(graph_points, batch_point_indices, batch_patch_info, config, point_index=None, batch_source_indices=None):
+    # Builds toponet queries of a batch of patches.
+    # graph_points: [N_points, 2] (x, y) of the full graph.
+    # batch_point_indices: list of [N_points_i, ] arrays, indices of the points inside each patch.
+    # point_index: PointIndex of graph_points, sorted batch_point_indices reuse its kNN
+    # instead of building a kdtree per patch.
+    # batch_source_indices: list of sorted subsets of batch_point_indices, the points
+    # queried as sources in each patch, see topo_dedup.assign_query_patches. Defaults to all.
+    # Returns:
+    # collated: dict of 'points' [B, N, 2], 'pairs' [B, N_src, N_nbr, 2], 'valid' [B, N_src, N_nbr],
+    # and 'folded' [B, N_src, N_nbr] with TOPO_SYMMETRIC_FOLD
+    # idx_maps: [B, N] patch-local point idx -> idx to the full graph.
+    fold = config.get('TOPO_SYMMETRIC_FOLD', False)
+    topo_data = {
+        'points': [],
+        'pairs': [],
+        'valid': [],
+    }
+    if fold:
+        topo_data['folded'] = []
+    idx_maps = []
+
+    # prepares pairs queries
+    for patch_index, (patch_point_indices, patch_info) in enumerate(zip(batch_point_indices, batch_patch_info)):
+        _, (x0, y0), (x1, y1) = patch_info
+        patch_point_num = len(patch_point_indices)
+        source_indices = batch_source_indices[patch_index] if batch_source_indices is not None else None
+        # normalize into patch
+        patch_points = graph_points[patch_point_indices, :] - np.array([[x0, y0]], dtype=graph_points.dtype)
+        # [N_src, ] patch-local idx of the sources
+        if source_indices is None:
+            source_local_idx = np.arange(patch_point_num)
+        else:
+            source_local_idx = np.searchsorted(patch_point_indices, source_indices)
+        # [N_src, n_nbr] idx is to the patch subgraph
+        src_idx = np.tile(
+            source_local_idx[:, np.newaxis],
+            (1, config.MAX_NEIGHBOR_QUERIES)
+        )
+        if point_index is not None:
+            knn_idx, valid = point_index.patch_neighbors(
+                patch_point_indices, config.MAX_NEIGHBOR_QUERIES, source_indices=source_indices)
+        else:
+            # for knn and circle query
+            patch_kdtree = scipy.spatial.KDTree(patch_points)
+
+            # k+1 because the nearest one is always self
+            # idx is to the patch subgraph
+            knn_d, knn_idx = patch_kdtree.query(
+                patch_points[source_local_idx], k=config.MAX_NEIGHBOR_QUERIES + 1, distance_upper_bound=config.NEIGHBOR_RADIUS)
+            # [N_src, n_nbr]
+            knn_idx = knn_idx[:, 1:]  # removes self
+            valid = knn_idx < patch_point_num
+        tgt_idx = np.where(valid, knn_idx, src_idx)
+        # [N_src, n_nbr, 2]
+        pairs = np.stack([src_idx, tgt_idx], axis=-1)
+        if fold:
+            valid, folded = topo_dedup.fold_symmetric_pairs(pairs, valid)
+            pairs[..., 1] = np.where(valid, pairs[..., 1], pairs[..., 0])
+            topo_data['folded'].append(folded)
+
+        topo_data['points'].append(patch_points)
+        topo_data['pairs'].append(pairs)
+        topo_data['valid'].append(valid)
+        # patch-local point idx -> idx to the full graph
+        idx_maps.append(patch_point_indices)
+
+    # collate
+    collated = {}
+    for key, x_list in topo_data.items():
+        length = max([x.shape[0] for x in x_list])
+        collated[key] = np.stack([
+            np.pad(x, [(0, length - x.shape[0])] + [(0, 0)] * (len(x.shape) - 1))
+            for x in x_list
+        ], axis=0)
+    return collated, collated_idx_maps(idx_maps, collated['points'].shape[1])
+
+
+def infer_topo_batch(net, batch_features, collated, idx_maps, device):
+    # Scores the queries of prepare_topo_queries with toponet.
+    # batch_features: [B, D, h, w]
+    # Returns:
+    # batch_edges: [N_valid, 2] (src, tgt) indices to the full graph, ordered as (batch, sample, pair).
+    # batch_edge_scores: [N_valid, ]
+    # [B, N_sample, N_pair, 2]
+    batch_points = torch.tensor(collated['points'], device=device)
+    batch_pairs = torch.tensor(collated['pairs'], device=device)
+    batch_valid = torch.tensor(collated['valid'], device=device)
+
+    with torch.no_grad():
+        # [B, N_samples, N_pairs, 1]
+        topo_scores = net.infer_toponet(batch_features, batch_points, batch_pairs, batch_valid)
+
+    # all-invalid (padded, no neighbors) queries returns nan scores
+    # [B, N_samples, N_pairs]
+    topo_scores = torch.where(torch.isnan(topo_scores), -100.0, topo_scores).squeeze(-1).cpu().numpy()
+
+    # aggregate edge scores
+    batch_size, n_samples, n_pairs = topo_scores.shape
+    # toponet may return fewer pairs than queried, see TopoNet.forward
+    valid = collated['valid'][:, :n_samples, :n_pairs]
+    pairs = collated['pairs'][:, :n_samples, :n_pairs, :]
+    # maps patch-local pair indices to indices into the full graph
+    batch_indices = np.arange(batch_size)[:, np.newaxis, np.newaxis]
+    src_idx_all = idx_maps[batch_indices, pairs[..., 0]]
+    tgt_idx_all = idx_maps[batch_indices, pairs[..., 1]]
+    batch_edges = np.stack([src_idx_all[valid], tgt_idx_all[valid]], axis=-1)
+    batch_edge_scores = topo_scores[valid]
+    if 'folded' in collated:
+        # folded pairs score both directions
+        folded = collated['folded'][:, :n_samples, :n_pairs]
+        batch_edges = np.concatenate([
+            batch_edges, np.stack([tgt_idx_all[folded], src_idx_all[folded]], axis=-1)], axis=0)
+        batch_edge_scores = np.concatenate([batch_edge_scores, topo_scores[folded]], axis=0)
+    assert np.all((0.0 <= batch_edge_scores) & (batch_edge_scores <= 1.0))
+    return batch_edges, batch_edge_scores
+
+
+def get_points_in_box(graph_points, box):
+    # Indices of points inside an (x0, y0, x1, y1) box, borders included like rtree.
+    x0, y0, x1, y1 = box
+    inside = (
+        (graph_points[:, 0] >= x0) & (graph_points[:, 0] <= x1) &
+        (graph_points[:, 1] >= y0) & (graph_points[:, 1] <= y1)
+    )
+    return np.flatnonzero(inside)
+
+
+class TestPatchBatchLoader(unittest.TestCase):
+    def test_consumer_raises(self):
+        img_tensor = upload_img(np.zeros((8, 16, 3), dtype=np.uint8), torch.device('cpu'))
+        all_patch_info = [(0, (0, 0), (8, 8)), (0, (8, 0), (16, 8))]
+
+        def consume():
+            batches = iter(PatchBatchLoader(img_tensor, all_patch_info, batch_size=1, prefetch=1))
+            try:
+                for _ in batches:
+                    # the producer queues the last batch and waits on the full queue
+                    time.sleep(0.3)
+                    raise RuntimeError('encoder failed')
+            except RuntimeError:
+                pass
+            finally:
+                batches.close()
+
+        consumer = threading.Thread(target=consume, daemon=True)
+        consumer.start()
+        consumer.join(timeout=5)
+        self.assertFalse(consumer.is_alive())
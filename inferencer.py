@@ -7,16 +7,26 @@ import cv2
 from utils import load_config, create_output_dir_and_save_config
 from dataset import cityscale_data_partition, read_rgb_img, get_patch_info_one_img
 from dataset import spacenet_data_partition
-from model import SAMRoad
+import feature_store
+from feature_store import FeatureStore
+from infer_utils import load_inference_net, upload_img, PatchBatchLoader, fuse_batch_masks, get_pixel_counter, get_patch_pixel_counter
+from infer_utils import PointIndex, prepare_topo_queries, infer_topo_batch
+import embedding_cache
 import graph_extraction
+import graph_io
 import graph_utils
+import nms_prefilter
+import output_sink
+import profile_utils
+import road_prefilter
+import sweep_inference
+import topo_dedup
 import triage
 # from triage import visualize_image_and_graph, rasterize_graph
 import pickle
-import scipy
-import rtree
-from collections import defaultdict
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from argparse import ArgumentParser
 
@@ -32,7 +42,6 @@ parser.add_argument(
     "--output_dir", default=None, help="Name of the output dir, if not specified will use timestamp"
 )
 parser.add_argument("--device", default="cuda", help="device to use for training")
-args = parser.parse_args()
 
 
 def get_img_paths(root_dir, image_indices):
@@ -45,69 +54,101 @@ def get_img_paths(root_dir, image_indices):
 
 
 
-def crop_img_patch(img, x0, y0, x1, y1):
-    return img[y0:y1, x0:x1, :]
-
-
-def get_batch_img_patches(img, batch_patch_info):
-    patches = []
-    for _, (x0, y0), (x1, y1) in batch_patch_info:
-        patch = crop_img_patch(img, x0, y0, x1, y1)
-        patches.append(torch.tensor(patch, dtype=torch.float32))
-    batch = torch.stack(patches, 0).contiguous()
-    return batch
-
-
 def infer_one_img(net, img, config):
+    if config.get('INFER_SCHEDULE', 'two_pass') == 'sweep':
+        # interleaves the two passes row by row, see sweep_inference.BandSweep
+        return sweep_inference.infer_one_img_sweep(net, img, config)
+    return infer_imgs(net, [img], config)[0]
+
+
+def infer_imgs(net, imgs, config):
+    # Infers several same-sized tiles at once: patches of all tiles are packed into the
+    # same encoder and toponet batches, results are routed back by the patch's image index.
+    # Returns a list of (pred_nodes, pred_edges, fused_keypoint_mask, fused_road_mask), one per img.
+    all_patch_info, img_features, fused_keypoint_masks, fused_road_masks = infer_imgs_masks(net, imgs, config)
+    img_graph_points = extract_imgs_points(fused_keypoint_masks, fused_road_masks, config)
+    return infer_imgs_topo(net, all_patch_info, img_features, img_graph_points, fused_keypoint_masks, fused_road_masks, config)
+
+
+def infer_imgs_masks(net, imgs, config):
+    # Pass 1 of infer_imgs, runs the encoder over the patches of all imgs.
+    # Returns (all_patch_info, img_features, fused_keypoint_masks, fused_road_masks),
+    # masks are [N_img, IMG_H, IMG_W] uint8 numpy. With POINT_EXTRACTION: torch they stay
+    # uint8 tensors on the device for extract_imgs_points, see to_host_mask.
     # TODO(congrui): centralize these configs
-    image_size = img.shape[0]
+    img_num = len(imgs)
+    image_size = imgs[0].shape[0]
+    assert all(img.shape == imgs[0].shape for img in imgs), 'packed tiles must have the same size'
+    device = net.device
+
+    # pass 1 outputs of the same imgs, checkpoint and patch grid, see embedding_cache
+    cache = embedding_cache.CACHE
+    if cache is not None:
+        cache_key = cache.key(imgs, config)
+        with profile_utils.span('cache_load'):
+            cached = cache.get(cache_key, device)
+        if cached is not None:
+            return cached
 
     batch_size = config.INFER_BATCH_SIZE
-    # list of (i, (x_begin, y_begin), (x_end, y_end))
-    all_patch_info = get_patch_info_one_img(
-        0, image_size, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
-    patch_num = len(all_patch_info)
-    batch_num = (
-        patch_num // batch_size
-        if patch_num % batch_size == 0
-        else patch_num // batch_size + 1
-    )
-
-    
-
-    # [IMG_H, IMG_W]
-    fused_keypoint_mask = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
-    fused_road_mask = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
-    pixel_counter = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
+    # list of (i, (x_begin, y_begin), (x_end, y_end)), i is the index to imgs
+    all_patch_info = []
+    for img_index in range(img_num):
+        all_patch_info += get_patch_info_one_img(
+            img_index, image_size, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+    prefilter = config.get('INFER_PREFILTER', False)
+    if prefilter:
+        # skipped patches add nothing to the fused masks and get no toponet queries
+        with profile_utils.span('prefilter'):
+            all_patch_info = road_prefilter.filter_patches(net, imgs, all_patch_info, config)
+    # [N_img, IMG_H, IMG_W, 2], keypoint and road
+    fused_masks = torch.zeros((img_num, ) + imgs[0].shape[0:2] + (2, ), dtype=torch.float32, device=device)
+    if prefilter:
+        # [N_img, IMG_H, IMG_W], only the kept patches count
+        pixel_counter = get_patch_pixel_counter(all_patch_info, img_num, image_size, batch_size, device)
+    else:
+        # [IMG_H, IMG_W]
+        pixel_counter = get_pixel_counter(
+            image_size, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE, device)
 
     # stores img embeddings for toponet
-    # list of [B, D, h, w], len=batch_num
-    img_features = list()
-
-    for batch_index in range(batch_num):
-        offset = batch_index * batch_size
-        batch_patch_info = all_patch_info[offset : offset + batch_size]
-        # tensor [B, H, W, C]
-        batch_img_patches = get_batch_img_patches(img, batch_patch_info)
-
+    # list-like of [B, D, h, w], len=batch_num
+    img_features = FeatureStore(
+        mode=config.get('INFER_FEATURE_STORE', 'fp32'), spill_dir=config.get('INFER_FEATURE_SPILL_DIR', None))
+
+    # [N_img, IMG_H, IMG_W, C] uint8, uploaded once
+    img_tensor = upload_img(np.stack(imgs, axis=0), device)
+    encoder_start_seconds = time.time()
+    patch_loader = PatchBatchLoader(
+        img_tensor, all_patch_info, batch_size, prefetch=config.get('INFER_PREFETCH_BATCHES', 1))
+    # tensor [B, H, W, C]
+    for batch_patch_info, batch_img_patches in patch_loader:
         with torch.no_grad():
-            batch_img_patches = batch_img_patches.to(args.device, non_blocking=False)
             # [B, H, W, 2]
-            mask_scores, patch_img_features = net.infer_masks_and_img_features(batch_img_patches)
-            img_features.append(patch_img_features)
-        # Aggregate masks
-        for patch_index, patch_info in enumerate(batch_patch_info):
-            _, (x0, y0), (x1, y1) = patch_info
-            keypoint_patch, road_patch = mask_scores[patch_index, :, :, 0], mask_scores[patch_index, :, :, 1]
-            fused_keypoint_mask[y0:y1, x0:x1] += keypoint_patch
-            fused_road_mask[y0:y1, x0:x1] += road_patch
-            pixel_counter[y0:y1, x0:x1] += torch.ones(road_patch.shape[0:2], dtype=torch.float32, device=args.device)
+            with profile_utils.span('encoder'):
+                mask_scores, patch_img_features = net.infer_masks_and_img_features(batch_img_patches)
+                img_features.append(patch_img_features)
+            # Aggregate masks
+            with profile_utils.span('mask_fusion'):
+                fuse_batch_masks(fused_masks, mask_scores, batch_patch_info)
     
-    fused_keypoint_mask /= pixel_counter
-    fused_road_mask /= pixel_counter
-    # range 0-1 -> 0-255
-    fused_keypoint_mask = (fused_keypoint_mask * 255).to(torch.uint8).cpu().numpy()
-    fused_road_mask = (fused_road_mask * 255).to(torch.uint8).cpu().numpy()
+    with profile_utils.span('mask_normalize'):
+        fused_masks /= pixel_counter.unsqueeze(-1)
+        fused_keypoint_masks, fused_road_masks = fused_masks[..., 0], fused_masks[..., 1]
+        # range 0-1 -> 0-255
+        fused_keypoint_masks = (fused_keypoint_masks * 255).to(torch.uint8)
+        fused_road_masks = (fused_road_masks * 255).to(torch.uint8)
+        if config.get('POINT_EXTRACTION', 'numpy') != 'torch':
+            fused_keypoint_masks, fused_road_masks = fused_keypoint_masks.cpu().numpy(), fused_road_masks.cpu().numpy()
+    if prefilter:
+        road_prefilter.STATS.encoded += len(all_patch_info)
+        road_prefilter.STATS.encoder_seconds += time.time() - encoder_start_seconds
+
+    if cache is not None:
+        with profile_utils.span('cache_store'):
+            cache.put(
+                cache_key, (all_patch_info, img_features, to_host_mask(fused_keypoint_masks), to_host_mask(fused_road_masks)),
+                config)
 
     # ## Astar graph extraction
     # pred_graph = graph_extraction.extract_graph_astar(fused_keypoint_mask, fused_road_mask, config)
@@ -115,128 +156,223 @@ def infer_one_img(net, img, config):
     # pred_nodes, pred_edges = graph_utils.convert_from_nx(pred_graph)
     # return pred_nodes, pred_edges, fused_keypoint_mask, fused_road_mask
     # ## Astar graph extraction
+
+    return all_patch_info, img_features, fused_keypoint_masks, fused_road_masks
+
+
+def to_host_mask(mask):
+    # uint8 numpy mask, for the masks infer_imgs_masks leaves on the device.
+    if isinstance(mask, torch.Tensor):
+        return mask.cpu().numpy()
+    return mask
+
+
+def extract_imgs_points(fused_keypoint_masks, fused_road_masks, config, profile_tile=None):
+    # CPU only, so it can run while the model infers other tiles. With POINT_EXTRACTION: torch
+    # it runs on POINT_EXTRACTION_DEVICE instead, see device_points.
+    # Returns a list of [N_points_i, 2] (x, y) graph points, one per img.
+    ## Extract sample points from masks
+    with profile_utils.span('point_extraction', tile=profile_tile):
+        return [
+            graph_extraction.extract_graph_points(keypoint_mask, road_mask, config)
+            for keypoint_mask, road_mask in zip(fused_keypoint_masks, fused_road_masks)
+        ]
+
+
+def infer_imgs_topo(net, all_patch_info, img_features, img_graph_points, fused_keypoint_masks, fused_road_masks, config):
+    # Pass 2 of infer_imgs, scores the edges of the extracted points and frees img_features.
+    # Returns the results of infer_imgs.
+    img_num = len(img_graph_points)
+    # points of all imgs are concatenated, img i owns [point_offsets[i], point_offsets[i + 1])
+    point_offsets = np.cumsum([0] + [points.shape[0] for points in img_graph_points])
+    edges, edge_scores = infer_imgs_edge_scores(net, all_patch_info, img_features, img_graph_points, config)
+    img_features.close()
+
+    edges = edges[edge_scores > config.TOPO_THRESHOLD, :]
+    # patches only hold points of their own img, so edges never cross imgs
+    edge_img_indices = np.searchsorted(point_offsets, edges[:, 0], side='right') - 1
+
+    results = []
+    for i in range(img_num):
+        pred_edges = edges[edge_img_indices == i, :] - point_offsets[i]
+        pred_nodes = img_graph_points[i][:, ::-1]  # to rc
+        if pred_nodes.shape[0] == 0:
+            pred_edges = np.zeros((0, 2), dtype=np.int32)
+        results.append((pred_nodes, pred_edges, to_host_mask(fused_keypoint_masks[i]), to_host_mask(fused_road_masks[i])))
     
     
-    ## Extract sample points from masks
-    graph_points = graph_extraction.extract_graph_points(fused_keypoint_mask, fused_road_mask, config)
-    if graph_points.shape[0] == 0:
-        return graph_points, np.zeros((0, 2), dtype=np.int32), fused_keypoint_mask, fused_road_mask
-
-    # for box query
-    graph_rtree = rtree.index.Index()
-    for i, v in enumerate(graph_points):
-        x, y = v
-        # hack to insert single points
-        graph_rtree.insert(i, (x, y, x, y))
+
+    return results
+
+
+def infer_imgs_edge_scores(net, all_patch_info, img_features, img_graph_points, config):
+    # Scores the candidate edges of the extracted points with toponet, before TOPO_THRESHOLD.
+    # Returns:
+    # edges: [N_edges, 2] indices to the concatenated img_graph_points.
+    # edge_scores: [N_edges, ] toponet scores averaged over the patches querying them.
+    device = net.device
+    batch_size = config.INFER_BATCH_SIZE
+    patch_num = len(all_patch_info)
+    batch_num = (
+        patch_num // batch_size
+        if patch_num % batch_size == 0
+        else patch_num // batch_size + 1
+    )
+
+    # points of all imgs are concatenated, like in PointIndex
+    graph_points = np.concatenate(img_graph_points, axis=0)
+
+    # for box and knn queries, built once for all patches
+    with profile_utils.span('point_index'):
+        point_index = PointIndex(img_graph_points, config.MAX_NEIGHBOR_QUERIES, config.NEIGHBOR_RADIUS)
+        all_patch_point_indices = [
+            point_index.points_in_box(i, (x0, y0, x1, y1))
+            for i, (x0, y0), (x1, y1) in all_patch_info
+        ]
+        # query sources of each patch, all points unless deduplicated
+        all_source_indices = None
+        query_patches = config.get('TOPO_QUERY_PATCHES', 0)
+        if query_patches > 0:
+            all_source_indices = topo_dedup.assign_query_patches(
+                graph_points, all_patch_point_indices, all_patch_info, query_patches,
+                point_index.knn_idx, config.MAX_NEIGHBOR_QUERIES)
     
     ## Pass 2: infer toponet to predict topology of points from stored img features
-    edge_scores = defaultdict(float)
-    edge_counts = defaultdict(float)
+    # edges queried in all patches and their scores, one array per batch
+    all_edges, all_edge_scores = [np.zeros((0, 2), dtype=np.int64)], [np.zeros((0, ), dtype=np.float32)]
     for batch_index in range(batch_num):
+        if graph_points.shape[0] == 0:
+            break
         offset = batch_index * batch_size
         batch_patch_info = all_patch_info[offset : offset + batch_size]
 
-        topo_data = {
-            'points': [],
-            'pairs': [],
-            'valid': [],
-        }
-        idx_maps = []
-
-
-        # prepares pairs queries
-        for patch_info in batch_patch_info:
-            _, (x0, y0), (x1, y1) = patch_info
-            patch_point_indices = list(graph_rtree.intersection((x0, y0, x1, y1)))
-            idx_patch2all = {patch_idx : all_idx for patch_idx, all_idx in enumerate(patch_point_indices)}
-            patch_point_num = len(patch_point_indices)
-            # normalize into patch
-            patch_points = graph_points[patch_point_indices, :] - np.array([[x0, y0]], dtype=graph_points.dtype)
-            # for knn and circle query
-            patch_kdtree = scipy.spatial.KDTree(patch_points)
-
-            # k+1 because the nearest one is always self
-            # idx is to the patch subgraph
-            knn_d, knn_idx = patch_kdtree.query(patch_points, k=config.MAX_NEIGHBOR_QUERIES + 1, distance_upper_bound=config.NEIGHBOR_RADIUS)
-            # [patch_point_num, n_nbr]
-            knn_idx = knn_idx[:, 1:]  # removes self
-            # [patch_point_num, n_nbr] idx is to the patch subgraph
-            src_idx = np.tile(
-                np.arange(patch_point_num)[:, np.newaxis],
-                (1, config.MAX_NEIGHBOR_QUERIES)
+        with profile_utils.span('topo_queries'):
+            batch_point_indices = all_patch_point_indices[offset : offset + batch_size]
+            batch_source_indices = (
+                all_source_indices[offset : offset + batch_size]
+                if all_source_indices is not None else None
             )
-            valid = knn_idx < patch_point_num
-            tgt_idx = np.where(valid, knn_idx, src_idx)
-            # [patch_point_num, n_nbr, 2]
-            pairs = np.stack([src_idx, tgt_idx], axis=-1)
-
-            topo_data['points'].append(patch_points)
-            topo_data['pairs'].append(pairs)
-            topo_data['valid'].append(valid)
-            idx_maps.append(idx_patch2all)
-        
-        # collate
-        collated = {}
-        for key, x_list in topo_data.items():
-            length = max([x.shape[0] for x in x_list])
-            collated[key] = np.stack([
-                np.pad(x, [(0, length - x.shape[0])] + [(0, 0)] * (len(x.shape) - 1))
-                for x in x_list
-            ], axis=0)
+            collated, idx_maps = prepare_topo_queries(
+                graph_points, batch_point_indices, batch_patch_info, config,
+                point_index=point_index, batch_source_indices=batch_source_indices)
+            topo_dedup.STATS.add(collated)
 
         # skips this batch if there's no points
-        if collated['points'].shape[1] == 0:
+        if collated['valid'].shape[1] == 0:
             continue
         
         # infer toponet
         # [B, D, h, w]
-        batch_features = img_features[batch_index]
-        # [B, N_sample, N_pair, 2]
-        batch_points = torch.tensor(collated['points'], device=args.device)
-        batch_pairs = torch.tensor(collated['pairs'], device=args.device)
-        batch_valid = torch.tensor(collated['valid'], device=args.device)
+        with profile_utils.span('toponet'):
+            batch_features = img_features[batch_index]
+            batch_edges, batch_edge_scores = infer_topo_batch(net, batch_features, collated, idx_maps, device)
+        all_edges.append(batch_edges)
+        all_edge_scores.append(batch_edge_scores)
 
+    # avg edge scores
+    with profile_utils.span('edge_aggregation'):
+        edges, edge_scores = graph_utils.aggregate_edge_scores(
+            np.concatenate(all_edges, axis=0), np.concatenate(all_edge_scores, axis=0), max(graph_points.shape[0], 1))
+    return edges, edge_scores
 
-        with torch.no_grad():
-            # [B, N_samples, N_pairs, 1]
-            topo_scores = net.infer_toponet(batch_features, batch_points, batch_pairs, batch_valid)
-                
-        # all-invalid (padded, no neighbors) queries returns nan scores
-        # [B, N_samples, N_pairs]
-        topo_scores = torch.where(torch.isnan(topo_scores), -100.0, topo_scores).squeeze(-1).cpu().numpy()
-
-        # aggregate edge scores
-        batch_size, n_samples, n_pairs = topo_scores.shape
-        for bi in range(batch_size):
-            for si in range(n_samples):
-                for pi in range(n_pairs):
-                    if not collated['valid'][bi, si, pi]:
-                        continue
-                    # idx to the full graph
-                    src_idx_patch, tgt_idx_patch = collated['pairs'][bi, si, pi, :]
-                    src_idx_all, tgt_idx_all = idx_maps[bi][src_idx_patch], idx_maps[bi][tgt_idx_patch]
-                    edge_score = topo_scores[bi, si, pi]
-                    assert 0.0 <= edge_score <= 1.0
-                    edge_scores[(src_idx_all, tgt_idx_all)] += edge_score
-                    edge_counts[(src_idx_all, tgt_idx_all)] += 1.0
-
-    # avg edge scores and filter
-    pred_edges = []
-    for edge, score_sum in edge_scores.items():
-        score = score_sum / edge_counts[edge] 
-        if score > config.TOPO_THRESHOLD:
-            pred_edges.append(edge)
-    pred_edges = np.array(pred_edges).reshape(-1, 2)
-    pred_nodes = graph_points[:, ::-1]  # to rc
-    
-    
 
-    return pred_nodes, pred_edges, fused_keypoint_mask, fused_road_mask
-
-    
+def get_test_split(config):
+    # Returns (test_img_indices, rgb_pattern, gt_graph_pattern) of config.DATASET.
+    if config.DATASET == 'cityscale':
+        _, _, test_img_indices = cityscale_data_partition()
+        rgb_pattern = './cityscale/20cities/region_{}_sat.png'
+        gt_graph_pattern = 'cityscale/20cities/region_{}_graph_gt.pickle'
+    elif config.DATASET == 'spacenet':
+        _, _, test_img_indices = spacenet_data_partition()
+        rgb_pattern = './spacenet/RGB_1.0_meter/{}__rgb.png'
+        gt_graph_pattern = './spacenet/RGB_1.0_meter/{}__gt_graph.p'
+    return test_img_indices, rgb_pattern, gt_graph_pattern
+
+
+def save_graph(output_dir, img_id, pred_nodes, pred_edges, config, edge_scores=None):
+    # Saves the large map to output_dir/graph/{img_id}.graph, read by the metrics, see
+    # graph_io. Also writes the sat2graph pickle {img_id}.p unless INFER_SAVE_SAT2GRAPH is off.
+    # pred_nodes in (r, c). Returns the paths written.
+    coords, height = 'rc', 0.0
+    if config.DATASET == 'spacenet':
+        # r, c -> ???
+        pred_nodes = np.stack([400 - pred_nodes[:, 0], pred_nodes[:, 1]], axis=1)
+        coords, height = 'rc_flip', 400.0
+    graph_save_dir = os.path.join(output_dir, 'graph')
+    if not os.path.exists(graph_save_dir):
+        os.makedirs(graph_save_dir, exist_ok=True)
+    unique_edges, unique_edge_scores = graph_io.unique_undirected_edges(pred_edges, edge_scores)
+    graph_paths = [os.path.join(graph_save_dir, f'{img_id}{graph_io.GRAPH_SUFFIX}')]
+    graph_io.save_graph(
+        graph_paths[0], pred_nodes, unique_edges,
+        edge_scores=unique_edge_scores, coords=coords, height=height)
+    if config.get('INFER_SAVE_SAT2GRAPH', True):
+        large_map_sat2graph_format = graph_utils.convert_to_sat2graph_format(pred_nodes, pred_edges)
+        graph_save_path = os.path.join(graph_save_dir, f'{img_id}.p')
+        with open(graph_save_path, 'wb') as file:
+            pickle.dump(large_map_sat2graph_format, file)
+        graph_paths.append(graph_save_path)
+    return graph_paths
+
+
+def render_viz(sink, img, pred_nodes, pred_edges, gt_graph_path, viz_save_path, config):
+    # pred_nodes in (r, c)
+    gt_graph = pickle.load(open(gt_graph_path, "rb"))
+    gt_nodes, gt_edges = graph_utils.convert_from_sat2graph_format(gt_graph)
+    if len(gt_nodes) == 0:
+        gt_nodes = np.zeros([0, 2], dtype=np.float32)
+
+    if config.DATASET == 'spacenet':
+        # convert ??? -> xy -> rc
+        gt_nodes = np.stack([gt_nodes[:, 1], 400 - gt_nodes[:, 0]], axis=1)
+        gt_nodes = gt_nodes[:, ::-1]
+
+    # RGB already
+    viz_img = np.copy(img)
+    img_size = viz_img.shape[0]
+
+    # # Visualizes the diff between rasterized pred/gt graphs.
+    # rast_pred = triage.rasterize_graph(pred_nodes / img_size, pred_edges, img_size, dilation_radius=1)
+    # rast_pred_dilate = triage.rasterize_graph(pred_nodes / img_size, pred_edges, img_size, dilation_radius=5)
+    # rast_gt = triage.rasterize_graph(gt_nodes / img_size, gt_edges, img_size, dilation_radius=1)
+    # rast_gt_dilate = triage.rasterize_graph(gt_nodes / img_size, gt_edges, img_size, dilation_radius=5)
+
+    # fp_pred = (np.less_equal(rast_gt_dilate, 0) * np.greater(rast_pred, 0)).astype(np.uint8)
+    # missed_gt = (np.less_equal(rast_pred_dilate, 0) * np.greater(rast_gt, 0)).astype(np.uint8)
+
+    # diff_img = np.array(viz_img)
+    # # FP in blue, missed in red (BGR for opencv)
+    # diff_img = diff_img * np.less_equal(fp_pred, 0) + fp_pred * np.array([255, 0, 0], dtype=np.uint8)
+    # diff_img = diff_img * np.less_equal(missed_gt, 0) + missed_gt * np.array([0, 0, 255], dtype=np.uint8)
+
+    # diff_save_dir = os.path.join(output_dir, 'diff')
+    # if not os.path.exists(diff_save_dir):
+    #     os.makedirs(diff_save_dir)
+    # cv2.imwrite(os.path.join(diff_save_dir, f'{img_id}.png'), diff_img)
+
+    # Visualizes merged large map
+    viz_img = triage.visualize_image_and_graph(viz_img, pred_nodes / img_size, pred_edges, viz_img.shape[0])
+    return sink.imwrite(viz_save_path, viz_img)
+
+
+def save_img_results(sink, img_id, img, pred_nodes, pred_edges, itsc_mask, road_mask, gt_graph_path, config):
+    # Queues the artifacts of a tile on the output sink, returns their futures.
+    futures = []
+    # visualizes fused masks
+    futures.append(sink.write_png('road_mask', 'mask', f'{img_id}_road.png', road_mask))
+    futures.append(sink.write_png('itsc_mask', 'mask', f'{img_id}_itsc.png', itsc_mask))
+    if sink.save_viz:
+        viz_save_path = os.path.join(sink.get_dir('viz'), f'{img_id}.png')
+        futures.append(sink.submit('viz', render_viz, sink, img, pred_nodes, pred_edges, gt_graph_path, viz_save_path, config))
+    # Saves the large map
+    sink.get_dir('graph')
+    futures.append(sink.submit('graph', save_graph, sink.output_dir, img_id, pred_nodes, pred_edges, config))
+    print(f'Queued outputs of {img_id}.')
+    return futures
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     config = load_config(args.config)
     
     # Builds eval model    
@@ -244,23 +380,11 @@ if __name__ == "__main__":
     # Good when model architecture/input shape are fixed.
     torch.backends.cudnn.benchmark = True
     torch.backends.cudnn.enabled = True
-    net = SAMRoad(config)
-
-    # load checkpoint
-    checkpoint = torch.load(args.checkpoint, map_location="cpu")
-    print(f'##### Loading Trained CKPT {args.checkpoint} #####')
-    net.load_state_dict(checkpoint["state_dict"], strict=True)
-    net.eval()
-    net.to(device)
+    net = load_inference_net(config, args.checkpoint, device)
+    profiler = profile_utils.configure(config)
+    cache = embedding_cache.configure(config, args.checkpoint)
 
-    if config.DATASET == 'cityscale':
-        _, _, test_img_indices = cityscale_data_partition()
-        rgb_pattern = './cityscale/20cities/region_{}_sat.png'
-        gt_graph_pattern = 'cityscale/20cities/region_{}_graph_gt.pickle'
-    elif config.DATASET == 'spacenet':
-        _, _, test_img_indices = spacenet_data_partition()
-        rgb_pattern = './spacenet/RGB_1.0_meter/{}__rgb.png'
-        gt_graph_pattern = './spacenet/RGB_1.0_meter/{}__gt_graph.p'
+    test_img_indices, rgb_pattern, gt_graph_pattern = get_test_split(config)
     
     output_dir_prefix = './save/infer_'
     if args.output_dir:
@@ -268,82 +392,131 @@ if __name__ == "__main__":
     else:
         output_dir = create_output_dir_and_save_config(output_dir_prefix, config)
     
+    sink = output_sink.OutputSink(output_dir, config)
+
+    # Staged pipeline: tiles are decoded by a reader pool ahead of the model, point
+    # extraction of a chunk runs while the encoder processes the next chunk, and
+    # masks / viz / graphs are written by the output sink behind the model.
+    # Every queue is bounded.
+    read_workers = config.get('INFER_READ_WORKERS', 2)
+    queue_size = config.get('INFER_QUEUE_SIZE', 4)
+    reader_pool = ThreadPoolExecutor(max_workers=read_workers)
+    extract_pool = ThreadPoolExecutor(max_workers=1)
+
+    # SpaceNet tiles are much smaller than a batch of patches, packs several per batch
+    imgs_per_batch = config.get('INFER_IMGS_PER_BATCH', 1)
+    chunks = [
+        test_img_indices[chunk_offset : chunk_offset + imgs_per_batch]
+        for chunk_offset in range(0, len(test_img_indices), imgs_per_batch)
+    ]
+    # the sweep schedule extracts points itself, tile by tile
+    staged = config.get('INFER_SCHEDULE', 'two_pass') != 'sweep'
+
+    def chunk_name(chunk_img_ids):
+        # profiling key of a chunk of tiles
+        return ','.join(str(img_id) for img_id in chunk_img_ids)
+
+    def read_chunk(chunk_img_ids):
+        # [H, W, C] RGB
+        with profile_utils.span('read', tile=chunk_name(chunk_img_ids)):
+            return [read_rgb_img(rgb_pattern.format(img_id)) for img_id in chunk_img_ids]
+
+    def write_results(chunk_img_ids, imgs, chunk_results):
+        # only blocks when the sink queue is full
+        with profile_utils.span('write', tile=chunk_name(chunk_img_ids)):
+            for img_id, img, (pred_nodes, pred_edges, itsc_mask, road_mask) in zip(chunk_img_ids, imgs, chunk_results):
+                save_img_results(
+                    sink, img_id, img, pred_nodes, pred_edges, itsc_mask, road_mask,
+                    gt_graph_pattern.format(img_id), config)
+
+    pending_reads = deque()
+    # (chunk_img_ids, imgs, pass 1 outputs, future of points) waiting for pass 2
+    pending_topo = None
     total_inference_seconds = 0.0
+    pipeline_start_seconds = time.time()
 
-    for img_id in test_img_indices:
-        print(f'Processing {img_id}')
-        # [H, W, C] RGB
-        img = read_rgb_img(rgb_pattern.format(img_id))
+    def finish_topo(chunk_img_ids, imgs, masks_outputs, points_future):
+        all_patch_info, img_features, fused_keypoint_masks, fused_road_masks = masks_outputs
         start_seconds = time.time()
-        # coords in (r, c)
-        pred_nodes, pred_edges, itsc_mask, road_mask = infer_one_img(net, img, config)
-        end_seconds = time.time()
-        total_inference_seconds += (end_seconds - start_seconds)
-
-        gt_graph_path = gt_graph_pattern.format(img_id)
-        gt_graph = pickle.load(open(gt_graph_path, "rb"))
-        gt_nodes, gt_edges = graph_utils.convert_from_sat2graph_format(gt_graph)
-        if len(gt_nodes) == 0:
-            gt_nodes = np.zeros([0, 2], dtype=np.float32)
-
-        if config.DATASET == 'spacenet':
-            # convert ??? -> xy -> rc
-            gt_nodes = np.stack([gt_nodes[:, 1], 400 - gt_nodes[:, 0]], axis=1)
-            gt_nodes = gt_nodes[:, ::-1]
-
-        # RGB already
-        viz_img = np.copy(img)
-        img_size = viz_img.shape[0]
-
-        # visualizes fused masks
-        mask_save_dir = os.path.join(output_dir, 'mask')
-        if not os.path.exists(mask_save_dir):
-            os.makedirs(mask_save_dir)
-        cv2.imwrite(os.path.join(mask_save_dir, f'{img_id}_road.png'), road_mask)
-        cv2.imwrite(os.path.join(mask_save_dir, f'{img_id}_itsc.png'), itsc_mask)
-
-        # # Visualizes the diff between rasterized pred/gt graphs.
-        # rast_pred = triage.rasterize_graph(pred_nodes / img_size, pred_edges, img_size, dilation_radius=1)
-        # rast_pred_dilate = triage.rasterize_graph(pred_nodes / img_size, pred_edges, img_size, dilation_radius=5)
-        # rast_gt = triage.rasterize_graph(gt_nodes / img_size, gt_edges, img_size, dilation_radius=1)
-        # rast_gt_dilate = triage.rasterize_graph(gt_nodes / img_size, gt_edges, img_size, dilation_radius=5)
-
-        # fp_pred = (np.less_equal(rast_gt_dilate, 0) * np.greater(rast_pred, 0)).astype(np.uint8)
-        # missed_gt = (np.less_equal(rast_pred_dilate, 0) * np.greater(rast_gt, 0)).astype(np.uint8)
-
-        # diff_img = np.array(viz_img)
-        # # FP in blue, missed in red (BGR for opencv)
-        # diff_img = diff_img * np.less_equal(fp_pred, 0) + fp_pred * np.array([255, 0, 0], dtype=np.uint8)
-        # diff_img = diff_img * np.less_equal(missed_gt, 0) + missed_gt * np.array([0, 0, 255], dtype=np.uint8)
-
-        # diff_save_dir = os.path.join(output_dir, 'diff')
-        # if not os.path.exists(diff_save_dir):
-        #     os.makedirs(diff_save_dir)
-        # cv2.imwrite(os.path.join(diff_save_dir, f'{img_id}.png'), diff_img)
-
-        # Visualizes merged large map
-        viz_save_dir = os.path.join(output_dir, 'viz')
-        if not os.path.exists(viz_save_dir):
-            os.makedirs(viz_save_dir)
-        viz_img = triage.visualize_image_and_graph(viz_img, pred_nodes / img_size, pred_edges, viz_img.shape[0])
-        cv2.imwrite(os.path.join(viz_save_dir, f'{img_id}.png'), viz_img)
-
-        # Saves the large map
-        if config.DATASET == 'spacenet':
-            # r, c -> ???
-            pred_nodes = np.stack([400 - pred_nodes[:, 0], pred_nodes[:, 1]], axis=1)
-        large_map_sat2graph_format = graph_utils.convert_to_sat2graph_format(pred_nodes, pred_edges)
-        graph_save_dir = os.path.join(output_dir, 'graph')
-        if not os.path.exists(graph_save_dir):
-            os.makedirs(graph_save_dir)
-        graph_save_path = os.path.join(graph_save_dir, f'{img_id}.p')
-        with open(graph_save_path, 'wb') as file:
-            pickle.dump(large_map_sat2graph_format, file)
-        
-        print(f'Done for {img_id}.')
+        with profile_utils.tile(chunk_name(chunk_img_ids)):
+            with profile_utils.span('wait_points'):
+                img_graph_points = points_future.result()
+            chunk_results = infer_imgs_topo(
+                net, all_patch_info, img_features, img_graph_points, fused_keypoint_masks, fused_road_masks, config)
+        write_results(chunk_img_ids, imgs, chunk_results)
+        return time.time() - start_seconds
+
+    try:
+        for chunk_index, chunk_img_ids in enumerate(chunks):
+            # keeps the reader pool queue_size chunks ahead
+            while len(pending_reads) < queue_size and chunk_index + len(pending_reads) < len(chunks):
+                pending_reads.append(reader_pool.submit(read_chunk, chunks[chunk_index + len(pending_reads)]))
+            imgs = pending_reads.popleft().result()
+            print(f'Processing {chunk_img_ids}')
+
+            start_seconds = time.time()
+            if not staged:
+                with profile_utils.tile(chunk_name(chunk_img_ids)):
+                    chunk_results = [infer_one_img(net, img, config) for img in imgs]
+                total_inference_seconds += (time.time() - start_seconds)
+                write_results(chunk_img_ids, imgs, chunk_results)
+                continue
+            with profile_utils.tile(chunk_name(chunk_img_ids)):
+                masks_outputs = infer_imgs_masks(net, imgs, config)
+            points_future = extract_pool.submit(
+                extract_imgs_points, masks_outputs[2], masks_outputs[3], config, profile_tile=chunk_name(chunk_img_ids))
+            total_inference_seconds += (time.time() - start_seconds)
+            # pass 2 of the previous chunk, its points were extracted during this pass 1
+            if pending_topo is not None:
+                total_inference_seconds += finish_topo(*pending_topo)
+            pending_topo = (chunk_img_ids, imgs, masks_outputs, points_future)
+        if pending_topo is not None:
+            total_inference_seconds += finish_topo(*pending_topo)
+        # waits for all outputs to be on disk
+        sink.flush()
+    finally:
+        reader_pool.shutdown()
+        extract_pool.shutdown()
+        sink.close()
+    pipeline_seconds = time.time() - pipeline_start_seconds
     
     # log inference time
     time_txt = f'Inference completed for {args.config} in {total_inference_seconds} seconds.'
+    time_txt += f'\n{len(test_img_indices)} tiles, {len(test_img_indices) / max(total_inference_seconds, 1e-6):.4f} tiles/sec.'
+    time_txt += f'\nEnd-to-end pipeline took {pipeline_seconds} seconds, {len(test_img_indices) / max(pipeline_seconds, 1e-6):.4f} tiles/sec.'
     print(time_txt)
     with open(os.path.join(output_dir, 'inference_time.txt'), 'w') as f:
         f.write(time_txt)
+
+    print(sink.stats)
+    with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+        f.write(f'\n{sink.stats}')
+
+    print(feature_store.STATS)
+    with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+        f.write(f'\n{feature_store.STATS}.')
+
+    if config.get('INFER_PREFILTER', False):
+        print(road_prefilter.STATS)
+        with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+            f.write(f'\n{road_prefilter.STATS}.')
+
+    if config.get('NMS_PREFILTER', False):
+        print(nms_prefilter.STATS)
+        with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+            f.write(f'\n{nms_prefilter.STATS}.')
+
+    if cache is not None:
+        print(cache)
+        with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+            f.write(f'\n{cache}.')
+
+    if config.get('TOPO_QUERY_PATCHES', 0) > 0 or config.get('TOPO_SYMMETRIC_FOLD', False):
+        print(topo_dedup.STATS)
+        with open(os.path.join(output_dir, 'inference_time.txt'), 'a') as f:
+            f.write(f'\n{topo_dedup.STATS}.')
+
+    if profiler.enabled:
+        print(profiler.format_summary())
+        profiler.write_json(os.path.join(output_dir, 'profile.json'))
+        profiler.write_csv(os.path.join(output_dir, 'profile.csv'))
@@ -0,0 +1,144 @@
+import glob
+import os
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils import load_config
+
+
+# Candidate reduction before the point NMS of graph_extraction.extract_graph_points:
+# only pixels that are the max of their window of the mask go to NMS, instead of every
+# pixel above ITSC_THRESHOLD / ROAD_THRESHOLD.
+#
+# This is approximate and off by default: it changes the output graph, not only its
+# speed. The greedy NMS takes candidates in pixel order, not by mask value, so any
+# subset of the candidates ends in a different set of points. On the masks of a test
+# run, with the default window, every prefiltered point has an exhaustive point within
+# ROAD_NMS_RADIUS but only about 92% of the exhaustive points have a prefiltered one,
+# and only about half of the points match within 4 pixels. Smaller windows and higher
+# tolerances keep more candidates but don't make it exact.
+#
+# Configs: NMS_PREFILTER enables it, default False. The window side is
+# 2 * round(radius * NMS_PREFILTER_SCALE) + 1 for ITSC_NMS_RADIUS / ROAD_NMS_RADIUS,
+# pixels within NMS_PREFILTER_TOLERANCE (0-255) of the window max survive too.
+# NMS_PREFILTER_DEVICE runs the max filter with torch on that device instead of
+# opencv. Run this file on the masks of an inference output to compare against the
+# exhaustive path before enabling it.
+
+
+class CandidateStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.candidates = 0
+        self.survivors = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return (
+            f'NMS prefilter kept {self.survivors} / {self.candidates} candidates, '
+            f'took {self.seconds:.3f}s'
+        )
+
+
+STATS = CandidateStats()
+
+
+def get_window_size(radius, config):
+    return 2 * int(round(radius * config.get('NMS_PREFILTER_SCALE', 1.0))) + 1
+
+
+def get_local_maximum_mask(mask, window_size, tolerance=0, device=None):
+    # mask: [H, W] uint8. Whether each pixel is within tolerance of the max of its
+    # window_size x window_size neighborhood, [H, W] bool.
+    if device is None or device == 'cpu':
+        window_max = cv2.dilate(mask, np.ones((window_size, window_size), dtype=np.uint8))
+        return mask.astype(np.int16) + tolerance >= window_max
+    # borders are padded with -inf like the opencv dilation
+    mask_tensor = torch.from_numpy(np.ascontiguousarray(mask)).to(device)[None, None].float()
+    window_max = F.max_pool2d(mask_tensor, window_size, stride=1, padding=window_size // 2)
+    return (mask_tensor + tolerance >= window_max)[0, 0].cpu().numpy()
+
+
+def get_points_and_scores_from_mask(mask, threshold, radius, config):
+    # Same as graph_extraction.get_points_and_scores_from_mask, keeping only the local maxima.
+    start_seconds = time.time()
+    above = mask > threshold
+    local_maximum = get_local_maximum_mask(
+        mask, get_window_size(radius, config), config.get('NMS_PREFILTER_TOLERANCE', 0),
+        config.get('NMS_PREFILTER_DEVICE', None))
+    keep = above & local_maximum
+    rcs = np.column_stack(np.where(keep))
+    xys = rcs[:, ::-1]
+    scores = mask[keep]
+    STATS.candidates += int(np.sum(above))
+    STATS.survivors += xys.shape[0]
+    STATS.seconds += time.time() - start_seconds
+    return xys, scores
+
+
+def compare_points(points, ref_points, tolerance):
+    # Point-set difference of points against ref_points.
+    from cpu_backend import match_nodes
+    points, ref_points = np.asarray(points, dtype=np.float64), np.asarray(ref_points, dtype=np.float64)
+    exact = set(map(tuple, points.tolist())) & set(map(tuple, ref_points.tolist()))
+    precision = np.mean(match_nodes(points, ref_points, tolerance) >= 0) if len(points) else 1.0
+    recall = np.mean(match_nodes(ref_points, points, tolerance) >= 0) if len(ref_points) else 1.0
+    return {
+        'points': len(points),
+        'ref_points': len(ref_points),
+        'only_in_ref': len(ref_points) - len(exact),
+        'only_in_points': len(points) - len(exact),
+        'precision': precision,
+        'recall': recall,
+    }
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="model config, NMS_PREFILTER_* keys select the prefilter."
+)
+parser.add_argument("--mask_dir", default=None, help="mask dir of an inference output, with <id>_itsc.png and <id>_road.png.")
+parser.add_argument("--tolerance", default=4.0, type=float, help="max distance in pixels of matching points.")
+
+
+if __name__ == "__main__":
+    # Compares the points of the prefiltered and the exhaustive extract_graph_points.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    # the stats updated by graph_extraction, not the ones of __main__
+    import nms_prefilter
+    import graph_extraction
+
+    exhaustive_config = config.copy()
+    exhaustive_config.POINT_EXTRACTION = 'numpy'
+    exhaustive_config.NMS_PREFILTER = False
+    prefilter_config = exhaustive_config.copy()
+    prefilter_config.NMS_PREFILTER = True
+
+    all_metrics = []
+    for road_path in sorted(glob.glob(os.path.join(args.mask_dir, '*_road.png'))):
+        name = os.path.basename(road_path)[:-len('_road.png')]
+        road_mask = cv2.imread(road_path, cv2.IMREAD_GRAYSCALE)
+        keypoint_mask = cv2.imread(os.path.join(args.mask_dir, f'{name}_itsc.png'), cv2.IMREAD_GRAYSCALE)
+        start_seconds = time.time()
+        ref_points = graph_extraction.extract_graph_points(keypoint_mask, road_mask, exhaustive_config)
+        exhaustive_seconds = time.time() - start_seconds
+        nms_prefilter.STATS.reset()
+        start_seconds = time.time()
+        points = graph_extraction.extract_graph_points(keypoint_mask, road_mask, prefilter_config)
+        prefilter_seconds = time.time() - start_seconds
+        metrics = compare_points(points, ref_points, args.tolerance)
+        metrics['candidates'] = nms_prefilter.STATS.candidates
+        metrics['survivors'] = nms_prefilter.STATS.survivors
+        metrics['speedup'] = exhaustive_seconds / max(prefilter_seconds, 1e-6)
+        print(name, ', '.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
+        all_metrics.append(metrics)
+    if all_metrics:
+        print('mean', ', '.join(f'{k}={np.mean([m[k] for m in all_metrics]):.4f}' for k in all_metrics[0]))
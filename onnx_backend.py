@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import torch
+import onnxruntime
+
+
+# File names of the artifacts written by export_onnx.py.
+MASKS_MODEL_NAME = 'masks_and_img_features.onnx'
+TOPO_MODEL_NAME = 'toponet.onnx'
+
+
+class OnnxInferenceBackend:
+    """Runs the two exported SAMRoad graphs with onnxruntime.
+
+    Exposes device, infer_masks_and_img_features and infer_toponet like SAMRoad, so
+    it can be passed to infer_one_img as the net. Takes and returns cpu torch tensors,
+    and doesn't import the model code.
+    """
+
+    def __init__(self, model_dir, providers=None, intra_op_threads=0, inter_op_threads=0):
+        # model_dir: output dir of export_onnx.py.
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        providers = providers or ['CPUExecutionProvider']
+        self.masks_session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, MASKS_MODEL_NAME), sess_options=options, providers=providers)
+        self.topo_session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, TOPO_MODEL_NAME), sess_options=options, providers=providers)
+        self.device = torch.device('cpu')
+
+    def infer_masks_and_img_features(self, rgb):
+        # rgb: [B, H, W, C] float32
+        mask_scores, image_embeddings = self.masks_session.run(
+            ['mask_scores', 'image_embeddings'], {'rgb': rgb.cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(mask_scores), torch.from_numpy(image_embeddings)
+
+    def infer_toponet(self, image_embeddings, graph_points, pairs, valid):
+        (topo_scores, ) = self.topo_session.run(['topo_scores'], {
+            'image_embeddings': image_embeddings.cpu().numpy().astype(np.float32),
+            'graph_points': graph_points.cpu().numpy().astype(np.float32),
+            'pairs': pairs.cpu().numpy().astype(np.int64),
+            'valid': valid.cpu().numpy().astype(bool),
+        })
+        return torch.from_numpy(topo_scores)
+
+
+def build_onnx_backend(model_dir, config):
+    # ONNX_* configs select the execution, see OnnxInferenceBackend.
+    return OnnxInferenceBackend(
+        model_dir,
+        providers=config.get('ONNX_PROVIDERS', None),
+        intra_op_threads=config.get('CPU_INTRA_OP_THREADS', 0),
+        inter_op_threads=config.get('CPU_INTER_OP_THREADS', 0),
+    )
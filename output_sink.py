@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+
+
+# Asynchronous writer of the per-tile artifacts of the inferencer: masks, viz and graphs.
+# Every artifact is written by a bounded thread pool, the caller only blocks when
+# INFER_WRITE_QUEUE_SIZE artifacts are in flight. Output dirs are created once.
+# flush() waits for all writes and fsyncs the written files and their dirs, so a run
+# is only reported done once its outputs are durable.
+#
+# Configs: INFER_WRITE_WORKERS, INFER_WRITE_QUEUE_SIZE, INFER_PNG_COMPRESSION (0-9,
+# opencv default if unset), INFER_SAVE_VIZ and INFER_WRITE_FSYNC.
+
+
+class SinkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # artifact -> [count, bytes, total seconds, max seconds]
+        self.artifacts = defaultdict(lambda: [0, 0, 0.0, 0.0])
+        # time the caller was blocked on a full queue
+        self.wait_seconds = 0.0
+        self.fsync_seconds = 0.0
+
+    def add(self, artifact, size, seconds):
+        with self.lock:
+            stats = self.artifacts[artifact]
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+
+    def __repr__(self):
+        lines = [f'Output sink waited {self.wait_seconds:.3f}s on a full queue, fsync took {self.fsync_seconds:.3f}s']
+        for artifact, (count, size, seconds, max_seconds) in sorted(self.artifacts.items()):
+            lines.append(
+                f'{artifact}: {count} files, {size / 2 ** 20:.1f} MB, '
+                f'mean {seconds / max(count, 1) * 1000:.1f} ms, max {max_seconds * 1000:.1f} ms')
+        return '\n'.join(lines)
+
+
+class OutputSink:
+    def __init__(self, output_dir, config):
+        self.output_dir = output_dir
+        workers = config.get('INFER_WRITE_WORKERS', 4)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(config.get('INFER_WRITE_QUEUE_SIZE', 4 * workers))
+        compression = config.get('INFER_PNG_COMPRESSION', None)
+        self.png_params = [cv2.IMWRITE_PNG_COMPRESSION, int(compression)] if compression is not None else []
+        self.save_viz = config.get('INFER_SAVE_VIZ', True)
+        self.fsync = config.get('INFER_WRITE_FSYNC', True)
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.pending = []
+        self.written = []
+        self.stats = SinkStats()
+
+    def get_dir(self, name):
+        # output_dir/name, created on first use
+        path = os.path.join(self.output_dir, name)
+        with self.lock:
+            if path not in self.dirs:
+                os.makedirs(path, exist_ok=True)
+                self.dirs.add(path)
+        return path
+
+    def submit(self, artifact, write_fn, *args):
+        # Runs write_fn(*args) in the pool, it returns the list of paths it wrote.
+        start_seconds = time.time()
+        self.slots.acquire()
+        self.stats.wait_seconds += time.time() - start_seconds
+        try:
+            future = self.pool.submit(self._run, artifact, write_fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # drops finished writes, raising their errors early
+        for done_future in [f for f in self.pending if f.done()]:
+            self.pending.remove(done_future)
+            done_future.result()
+        self.pending.append(future)
+        return future
+
+    def _run(self, artifact, write_fn, *args):
+        try:
+            start_seconds = time.time()
+            paths = write_fn(*args)
+            seconds = time.time() - start_seconds
+            self.stats.add(artifact, sum(os.path.getsize(path) for path in paths), seconds)
+            with self.lock:
+                self.written.extend(paths)
+            return paths
+        finally:
+            self.slots.release()
+
+    def write_png(self, artifact, dir_name, file_name, img):
+        path = os.path.join(self.get_dir(dir_name), file_name)
+        return self.submit(artifact, self.imwrite, path, img)
+
+    def imwrite(self, path, img):
+        # Writes a png now with the configured compression, returns the paths written.
+        if not cv2.imwrite(path, img, self.png_params):
+            raise IOError(f'Failed to write {path}')
+        return [path]
+
+    def mark_done(self, futures, marker_path, content=''):
+        # Writes marker_path once the writes of futures succeeded and are fsynced, e.g. the
+        # completion marker of a tile. Waited for by flush().
+        marker_future = Future()
+        remaining = [len(futures)]
+
+        def on_done(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                paths = [path for future in futures for path in future.result()]
+                if self.fsync:
+                    for path in paths:
+                        _fsync_path(path)
+                tmp_path = marker_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(content)
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, marker_path)
+                marker_future.set_result([marker_path])
+            except BaseException as e:
+                marker_future.set_exception(e)
+
+        self.pending.append(marker_future)
+        if not futures:
+            remaining[0] = 1
+            on_done(None)
+        for future in futures:
+            future.add_done_callback(on_done)
+        return marker_future
+
+    def flush(self):
+        # Barrier: waits for every submitted write, raising the first error, then fsyncs.
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+        with self.lock:
+            written, self.written = self.written, []
+        if not self.fsync or not written:
+            return
+        start_seconds = time.time()
+        # files in parallel, as they may live on a network filesystem
+        list(self.pool.map(_fsync_path, written))
+        list(self.pool.map(_fsync_path, sorted(set(os.path.dirname(path) for path in written))))
+        self.stats.fsync_seconds += time.time() - start_seconds
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
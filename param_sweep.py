@@ -0,0 +1,245 @@
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import yaml
+
+from utils import load_config
+from dataset import read_rgb_img
+import embedding_cache
+import graph_io
+import inferencer
+
+
+# Post-processing parameter sweep over the test split, e.g.
+#
+#   python param_sweep.py --config ... --checkpoint ... --output_dir sweep \
+#       --grid ITSC_THRESHOLD=0.2,0.25,0.3 ROAD_NMS_RADIUS=12,16 TOPO_THRESHOLD=0.3,0.4,0.5,0.6
+#
+# Pass 1 runs once per tile through the embedding cache. Every setting of the grid keys
+# other than TOPO_THRESHOLD needs its own points, their raw toponet edge scores are
+# stored under save/<output_dir>/scores and reused by all TOPO_THRESHOLD values and by
+# later sweeps of the same checkpoint and SCORE_CONFIG_KEYS. Worker processes extract the points, write the graphs of each setting
+# to save/<output_dir>/<setting> and run the TOPO / APLS metrics on them.
+
+
+# default gt graphs of the APLS metric, relative to the repo like the dataset dirs,
+# --gt_pattern overrides them
+APLS_GT_PATTERNS = {
+    'cityscale': 'cityscale/20cities/region_{}_refine_gt_graph.p',
+    'spacenet': 'spacenet/RGB_1.0_meter/{}__gt_graph.p',
+}
+
+# configs deciding the stored points and edge scores besides the swept ones: pass 1, the
+# topo net and the point / query extraction. TOPO_THRESHOLD and output configs are left
+# out so that settings only differing there share the scores.
+SCORE_CONFIG_KEYS = embedding_cache.PASS1_CONFIG_KEYS + [
+    'DATASET', 'TOPONET_VERSION',
+    'ITSC_THRESHOLD', 'ROAD_THRESHOLD', 'ITSC_NMS_RADIUS', 'ROAD_NMS_RADIUS',
+    'NEIGHBOR_RADIUS', 'MAX_NEIGHBOR_QUERIES', 'POINT_EXTRACTION', 'POINT_EXTRACTION_BLOCK',
+    'NMS_PREFILTER', 'NMS_PREFILTER_SCALE', 'NMS_PREFILTER_TOLERANCE',
+    'TOPO_QUERY_PATCHES', 'TOPO_SYMMETRIC_FOLD',
+]
+
+
+def parse_grid(grid_args):
+    # ['KEY=v0,v1', ...] -> {KEY: [v0, v1]}, values parsed as yaml like the configs.
+    grid = {}
+    for grid_arg in grid_args:
+        key, values = grid_arg.split('=', 1)
+        grid[key] = [yaml.safe_load(value) for value in values.split(',')]
+    return grid
+
+
+def get_settings(grid):
+    # Cartesian product of the grid, list of {KEY: value}.
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def get_score_setting(setting):
+    # The part of a setting deciding the points and their edge scores.
+    return {key: value for key, value in setting.items() if key != 'TOPO_THRESHOLD'}
+
+
+def get_score_key(config, score_setting, checkpoint_fingerprint):
+    # Name of the stored edge scores of a score setting, reused by later sweeps with the
+    # same checkpoint, SCORE_CONFIG_KEYS and score setting.
+    key_config = {key: config.get(key, None) for key in SCORE_CONFIG_KEYS}
+    key_config.update(score_setting)
+    digest = hashlib.sha256(checkpoint_fingerprint.encode())
+    digest.update(json.dumps(key_config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def apply_setting(config, setting):
+    setting_config = config.copy()
+    for key, value in setting.items():
+        setting_config[key] = value
+    return setting_config
+
+
+def score_tile(net, img, img_id, score_settings, score_dirs, config, pool):
+    # Stores the points and raw edge scores of img under each score setting.
+    todo = [
+        (score_setting, score_dir) for score_setting, score_dir in zip(score_settings, score_dirs)
+        if not os.path.exists(os.path.join(score_dir, f'{img_id}.npz'))
+    ]
+    if not todo:
+        return
+    # from the embedding cache, or runs the encoder and stores it
+    all_patch_info, img_features, fused_keypoint_masks, fused_road_masks = inferencer.infer_imgs_masks(net, [img], config)
+    # the worker processes take host masks
+    fused_keypoint_masks = inferencer.to_host_mask(fused_keypoint_masks)
+    fused_road_masks = inferencer.to_host_mask(fused_road_masks)
+
+    points_futures = [
+        pool.submit(
+            inferencer.extract_imgs_points, fused_keypoint_masks, fused_road_masks,
+            apply_setting(config, score_setting))
+        for score_setting, _ in todo
+    ]
+    for (score_setting, score_dir), points_future in zip(todo, points_futures):
+        img_graph_points = points_future.result()
+        edges, edge_scores = inferencer.infer_imgs_edge_scores(
+            net, all_patch_info, img_features, img_graph_points, apply_setting(config, score_setting))
+        np.savez(
+            os.path.join(score_dir, f'{img_id}.npz'),
+            points=img_graph_points[0], edges=edges, edge_scores=edge_scores)
+    img_features.close()
+
+
+def run_topo(setting_dir, config):
+    # Runs <dataset>_metrics/topo.bash, returns (TOPO, precision, recall).
+    metrics_dir = f'{config.DATASET}_metrics'
+    subprocess.run(['bash', 'topo.bash', setting_dir], cwd=metrics_dir, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(setting_dir, 'score', 'topo.json')) as f:
+        return json.load(f)['mean topo']
+
+
+def run_apls(setting_dir, img_ids, config, gt_pattern):
+    # Same steps as <dataset>_metrics/apls.bash, with the json files of the graphs kept
+    # in setting_dir so that settings can be scored in parallel. gt_pattern: path of the
+    # gt graph of an img id. Returns the mean APLS.
+    metrics_dir = f'{config.DATASET}_metrics'
+    apls_dir = os.path.join(setting_dir, 'results', 'apls')
+    os.makedirs(apls_dir, exist_ok=True)
+    gt_json = os.path.abspath(os.path.join(setting_dir, 'gt.json'))
+    prop_json = os.path.abspath(os.path.join(setting_dir, 'prop.json'))
+    for img_id in img_ids:
+        gt_graph = gt_pattern.format(img_id)
+        if not os.path.exists(gt_graph):
+            continue
+        prop_graph = os.path.join(setting_dir, 'graph', f'{img_id}{graph_io.GRAPH_SUFFIX}')
+        subprocess.run([sys.executable, './apls/convert.py', os.path.abspath(gt_graph), gt_json], cwd=metrics_dir, check=True)
+        subprocess.run([sys.executable, './apls/convert.py', os.path.abspath(prop_graph), prop_json], cwd=metrics_dir, check=True)
+        subprocess.run(
+            ['go', 'run', '.', gt_json, prop_json, os.path.abspath(os.path.join(apls_dir, f'{img_id}.txt')), config.DATASET],
+            cwd=os.path.join(metrics_dir, 'apls'), check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([sys.executable, 'apls.py', '--dir', setting_dir], cwd=metrics_dir, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(setting_dir, 'score', 'apls.json')) as f:
+        return json.load(f)['final_APLS']
+
+
+def evaluate_setting(setting_dir, score_dir, img_ids, config, metrics, gt_pattern):
+    # Worker: thresholds the stored edge scores, writes the graphs and scores them.
+    for img_id in img_ids:
+        with np.load(os.path.join(score_dir, f'{img_id}.npz')) as scores:
+            points, edges, edge_scores = scores['points'], scores['edges'], scores['edge_scores']
+        keep = edge_scores > config.TOPO_THRESHOLD
+        inferencer.save_graph(setting_dir, img_id, points[:, ::-1], edges[keep, :], config, edge_scores=edge_scores[keep])
+    results = {}
+    if 'topo' in metrics:
+        results['TOPO'], results['precision'], results['recall'] = run_topo(setting_dir, config)
+    if 'apls' in metrics:
+        results['APLS'] = run_apls(setting_dir, img_ids, config, gt_pattern)
+    return results
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model."
+)
+parser.add_argument(
+    "--config", default=None, help="base model config."
+)
+parser.add_argument(
+    "--output_dir", default=None, help="name of the sweep dir under ./save."
+)
+parser.add_argument("--grid", nargs='+', default=[], help="KEY=v0,v1,... post-processing configs to sweep.")
+parser.add_argument("--metrics", nargs='*', default=['topo', 'apls'], help="metrics to run on every setting.")
+parser.add_argument("--gt_pattern", default=None, help="gt graph path of the APLS metric with {} for the img id, defaults to the dataset dir in the repo.")
+parser.add_argument("--workers", default=8, type=int, help="worker processes.")
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    start_seconds = time.time()
+    sweep_dir = os.path.join('save', args.output_dir)
+    if not config.get('INFER_CACHE_DIR', None):
+        config.INFER_CACHE_DIR = os.path.join(sweep_dir, 'cache')
+
+    gt_pattern = args.gt_pattern or APLS_GT_PATTERNS[config.DATASET]
+    grid = parse_grid(args.grid)
+    settings = get_settings(grid)
+    score_settings = []
+    for setting in settings:
+        if get_score_setting(setting) not in score_settings:
+            score_settings.append(get_score_setting(setting))
+    checkpoint_fingerprint = embedding_cache.get_checkpoint_fingerprint(args.checkpoint)
+    score_dirs = [
+        os.path.join(sweep_dir, 'scores', get_score_key(config, score_setting, checkpoint_fingerprint))
+        for score_setting in score_settings
+    ]
+    for score_dir, score_setting in zip(score_dirs, score_settings):
+        os.makedirs(score_dir, exist_ok=True)
+        with open(os.path.join(score_dir, 'setting.json'), 'w') as f:
+            json.dump(score_setting, f)
+    print(f'{len(settings)} settings, {len(score_settings)} of them need their own points')
+
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    net = inferencer.load_inference_net(config, args.checkpoint, device)
+    embedding_cache.configure(config, args.checkpoint)
+    test_img_indices, rgb_pattern, _ = inferencer.get_test_split(config)
+
+    # workers don't touch the model, spawned so they don't inherit the device context
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        for img_id in test_img_indices:
+            img = read_rgb_img(rgb_pattern.format(img_id))
+            score_tile(net, img, img_id, score_settings, score_dirs, config, pool)
+            print(f'Scored {img_id}')
+        print(f'Scoring took {time.time() - start_seconds:.1f} seconds. {embedding_cache.CACHE}')
+
+        futures = []
+        for setting_index, setting in enumerate(settings):
+            score_dir = score_dirs[score_settings.index(get_score_setting(setting))]
+            setting_dir = os.path.join(sweep_dir, f'{setting_index:03d}')
+            futures.append(pool.submit(
+                evaluate_setting, setting_dir, score_dir, test_img_indices, apply_setting(config, setting), args.metrics, gt_pattern))
+        rows = []
+        for setting_index, (setting, future) in enumerate(zip(settings, futures)):
+            row = {'setting': f'{setting_index:03d}', **setting, **future.result()}
+            print(', '.join(f'{key}={value}' for key, value in row.items()))
+            rows.append(row)
+    finally:
+        pool.shutdown()
+
+    fields = list(dict.fromkeys(key for row in rows for key in row))
+    with open(os.path.join(sweep_dir, 'sweep.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Sweep of {len(settings)} settings took {time.time() - start_seconds:.1f} seconds.')
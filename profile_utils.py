@@ -0,0 +1,192 @@
+import contextlib
+import csv
+import json
+import resource
+import threading
+import time
+from collections import defaultdict
+
+import torch
+
+
+# Named timing spans for the inference pipeline.
+#
+#   with profile_utils.span('encoder'):
+#       ...
+#
+# Spans are recorded per tile: the main loop enters profile_utils.tile(tile_id) and
+# every span on that thread is attributed to it; worker threads pass tile= explicitly.
+# When profiling is disabled, span() returns a shared no-op context.
+#
+# The cuda peak counter is global to the device, so only a span opened while no other
+# span is open, on any thread, resets it and records peak_cuda_mb: the exact device peak
+# while it was open, including work of spans running alongside it. Spans nested in it
+# or overlapping it record cuda_delta_mb instead, the change of allocated cuda memory
+# from entry to exit, which misses transient allocations freed before the exit.
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def get_rss_mb():
+    # Current resident set size of the process.
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler:
+    def __init__(self, enabled=False, sync=False, track_memory=False):
+        # sync: synchronizes cuda around spans, so async kernels are timed in the span launching them.
+        # track_memory: records RSS and cuda tensor memory of each span.
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.track_memory = track_memory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # spans open on all threads, the one opened at 0 owns the cuda peak counter
+        self.open_spans = 0
+        # tile -> span name -> stats
+        self.records = defaultdict(dict)
+        self.tile_order = []
+
+    def current_tile(self):
+        return getattr(self.local, 'tile', None)
+
+    @contextlib.contextmanager
+    def tile(self, tile_id):
+        previous = self.current_tile()
+        self.local.tile = str(tile_id)
+        try:
+            yield
+        finally:
+            self.local.tile = previous
+
+    def span(self, name, tile=None):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._span(name, str(tile) if tile is not None else self.current_tile())
+
+    @contextlib.contextmanager
+    def _span(self, name, tile):
+        track_cuda = self.track_memory and torch.cuda.is_available()
+        if self.sync:
+            torch.cuda.synchronize()
+        with self.lock:
+            owns_peak = self.open_spans == 0
+            self.open_spans += 1
+            if track_cuda:
+                if owns_peak:
+                    torch.cuda.reset_peak_memory_stats()
+                start_cuda_bytes = torch.cuda.memory_allocated()
+        start_seconds = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            seconds = time.perf_counter() - start_seconds
+            memory = {}
+            if self.track_memory:
+                memory['rss_mb'] = get_rss_mb()
+                memory['peak_rss_mb'] = get_peak_rss_mb()
+            with self.lock:
+                self.open_spans -= 1
+                if track_cuda:
+                    if owns_peak:
+                        memory['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+                    else:
+                        memory['cuda_delta_mb'] = (torch.cuda.memory_allocated() - start_cuda_bytes) / 2 ** 20
+            self.record(tile, name, seconds, memory)
+
+    def record(self, tile, name, seconds, memory):
+        with self.lock:
+            if tile not in self.records:
+                self.tile_order.append(tile)
+            stats = self.records[tile].setdefault(name, {'seconds': 0.0, 'count': 0})
+            stats['seconds'] += seconds
+            stats['count'] += 1
+            for key, value in memory.items():
+                stats[key] = max(stats.get(key, value), value)
+
+    def summary(self):
+        # span name -> stats summed over tiles, memory is the max
+        totals = {}
+        with self.lock:
+            for tile in self.tile_order:
+                for name, stats in self.records[tile].items():
+                    total = totals.setdefault(name, {'seconds': 0.0, 'count': 0})
+                    for key, value in stats.items():
+                        if key in ('seconds', 'count'):
+                            total[key] += value
+                        else:
+                            total[key] = max(total.get(key, value), value)
+        return totals
+
+    def format_summary(self):
+        lines = []
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            line = f'{name:>20s}: {stats["seconds"]:10.3f}s in {stats["count"]} spans'
+            for key in ('rss_mb', 'peak_rss_mb', 'peak_cuda_mb', 'cuda_delta_mb'):
+                if key in stats:
+                    line += f', {key}={stats[key]:.1f}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with self.lock:
+            trace = {
+                'tiles': {tile: self.records[tile] for tile in self.tile_order},
+            }
+        trace['summary'] = self.summary()
+        with open(path, 'w') as f:
+            json.dump(trace, f, indent=2)
+
+    def write_csv(self, path):
+        # one row per (tile, span)
+        fields = ['tile', 'span', 'seconds', 'count', 'rss_mb', 'peak_rss_mb', 'peak_cuda_mb', 'cuda_delta_mb']
+        with self.lock, open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, restval='')
+            writer.writeheader()
+            for tile in self.tile_order:
+                for name, stats in self.records[tile].items():
+                    writer.writerow({'tile': tile, 'span': name, **stats})
+
+
+# Disabled until configured, see configure().
+PROFILER = Profiler()
+
+
+def configure(config):
+    # INFER_PROFILE enables profiling, INFER_PROFILE_SYNC and INFER_PROFILE_MEMORY add
+    # device syncs and memory tracking.
+    global PROFILER
+    PROFILER = Profiler(
+        enabled=config.get('INFER_PROFILE', False),
+        sync=config.get('INFER_PROFILE_SYNC', False),
+        track_memory=config.get('INFER_PROFILE_MEMORY', False),
+    )
+    return PROFILER
+
+
+def span(name, tile=None):
+    return PROFILER.span(name, tile=tile)
+
+
+def current_tile():
+    # tile of the calling thread, to hand over to worker threads
+    return PROFILER.current_tile()
+
+
+def tile(tile_id):
+    if not PROFILER.enabled:
+        return _NULL_CONTEXT
+    return PROFILER.tile(tile_id)
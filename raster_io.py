@@ -0,0 +1,82 @@
+import os
+import re
+import functools
+
+import numpy as np
+
+from dataset import read_rgb_img
+
+
+class ArrayRaster:
+    """[H, W, C] uint8 RGB raster backed by an in-memory or memory-mapped array."""
+
+    def __init__(self, array):
+        self.array = array
+        self.height, self.width = array.shape[0:2]
+
+    def read_window(self, x0, y0, x1, y1):
+        # Returns [y1 - y0, x1 - x0, 3] uint8 RGB.
+        return np.ascontiguousarray(self.array[y0:y1, x0:x1, :3])
+
+
+class TiledPngRaster:
+    """Raster stored as a directory of PNG tiles named {row}_{col}.png.
+
+    All tiles share the size of tile 0_0, except the last row / column which may be
+    smaller. Missing tiles read as zeros. Recently decoded tiles are cached, since
+    consecutive windows of a sweep overlap.
+    """
+
+    TILE_PATTERN = re.compile(r'^(\d+)_(\d+)\.png$')
+
+    def __init__(self, tile_dir, cached_tiles=64):
+        self.tile_dir = tile_dir
+        self.tiles = set()
+        for name in os.listdir(tile_dir):
+            match = self.TILE_PATTERN.match(name)
+            if match:
+                self.tiles.add((int(match.group(1)), int(match.group(2))))
+        assert (0, 0) in self.tiles, f'no tile 0_0.png under {tile_dir}'
+        self.tile_height, self.tile_width = self._load_tile(0, 0).shape[0:2]
+        last_row = max(r for r, _ in self.tiles)
+        last_col = max(c for _, c in self.tiles)
+        self.height = last_row * self.tile_height + self._load_tile(last_row, min(c for r, c in self.tiles if r == last_row)).shape[0]
+        self.width = last_col * self.tile_width + self._load_tile(min(r for r, c in self.tiles if c == last_col), last_col).shape[1]
+        self._read_tile = functools.lru_cache(maxsize=cached_tiles)(self._load_tile)
+
+    def _load_tile(self, row, col):
+        if (row, col) not in self.tiles:
+            return None
+        return read_rgb_img(os.path.join(self.tile_dir, f'{row}_{col}.png'))
+
+    def read_window(self, x0, y0, x1, y1):
+        # Returns [y1 - y0, x1 - x0, 3] uint8 RGB.
+        window = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+        for row in range(y0 // self.tile_height, (y1 - 1) // self.tile_height + 1):
+            for col in range(x0 // self.tile_width, (x1 - 1) // self.tile_width + 1):
+                tile = self._read_tile(row, col)
+                if tile is None:
+                    continue
+                tile_x0, tile_y0 = col * self.tile_width, row * self.tile_height
+                # overlap in raster coords
+                ox0, oy0 = max(x0, tile_x0), max(y0, tile_y0)
+                ox1, oy1 = min(x1, tile_x0 + tile.shape[1]), min(y1, tile_y0 + tile.shape[0])
+                if ox0 >= ox1 or oy0 >= oy1:
+                    continue
+                window[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0] = tile[oy0 - tile_y0:oy1 - tile_y0, ox0 - tile_x0:ox1 - tile_x0]
+        return window
+
+
+def open_raster(path, raw_shape=None):
+    # path: a .npy array, a headerless .raw/.bin file of raw_shape (H, W, C) uint8,
+    # a directory of PNG tiles, or any image cv2 can read (loaded fully).
+    # Arrays are RGB, memory-mapped so only the windows being read are paged in.
+    if os.path.isdir(path):
+        return TiledPngRaster(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return ArrayRaster(np.load(path, mmap_mode='r'))
+    if ext in {'.raw', '.bin'}:
+        assert raw_shape is not None, 'raw rasters need an (H, W, C) shape'
+        return ArrayRaster(np.memmap(path, dtype=np.uint8, mode='r', shape=tuple(raw_shape)))
+    return ArrayRaster(read_rgb_img(path))
@@ -0,0 +1,161 @@
+import math
+import time
+from argparse import ArgumentParser
+
+import cv2
+import numpy as np
+import torch
+
+from utils import load_config
+from dataset import read_rgb_img, get_patch_info_one_img
+
+
+# Road-presence prefilter: a low-resolution pass of the model itself scores every
+# patch of the inference grid, patches scoring below PREFILTER_THRESHOLD skip the
+# encoder and are treated as zero-mask and point-free.
+#
+# Configs: INFER_PREFILTER enables it, PREFILTER_SCALE is the downsampling of the
+# low-res pass and PREFILTER_THRESHOLD the min road score of a kept patch. Run this
+# file to calibrate the threshold for a target patch recall.
+
+
+class PrefilterStats:
+    def __init__(self):
+        self.patches = 0
+        self.skipped = 0
+        self.prefilter_seconds = 0.0
+        # encoder time of the kept patches, to estimate the time saved
+        self.encoded = 0
+        self.encoder_seconds = 0.0
+
+    def saved_seconds(self):
+        if self.encoded == 0:
+            return 0.0
+        return self.skipped * self.encoder_seconds / self.encoded - self.prefilter_seconds
+
+    def __repr__(self):
+        return (
+            f'Prefilter skipped {self.skipped} / {self.patches} patches, '
+            f'took {self.prefilter_seconds:.3f}s, saved about {self.saved_seconds():.3f}s'
+        )
+
+
+STATS = PrefilterStats()
+
+
+def infer_lowres_road_masks(net, imgs, config):
+    # Runs the model on imgs downsampled by PREFILTER_SCALE, tiled into zero-padded patches.
+    # Returns a list of [h, w] float32 road scores, one per img, h = ceil(IMG_H * scale).
+    scale = config.get('PREFILTER_SCALE', 0.25)
+    patch_size = config.PATCH_SIZE
+    lowres_imgs = [cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for img in imgs]
+
+    patches = []
+    # (img_index, x, y, w, h) of each patch in its low-res img
+    patch_slots = []
+    for img_index, lowres_img in enumerate(lowres_imgs):
+        height, width = lowres_img.shape[0:2]
+        for y in range(0, height, patch_size):
+            for x in range(0, width, patch_size):
+                crop = lowres_img[y:y + patch_size, x:x + patch_size]
+                patch = np.zeros((patch_size, patch_size, 3), dtype=np.uint8)
+                patch[:crop.shape[0], :crop.shape[1]] = crop
+                patches.append(patch)
+                patch_slots.append((img_index, x, y, crop.shape[1], crop.shape[0]))
+
+    road_masks = [np.zeros(lowres_img.shape[0:2], dtype=np.float32) for lowres_img in lowres_imgs]
+    batch_size = config.INFER_BATCH_SIZE
+    for offset in range(0, len(patches), batch_size):
+        batch = torch.from_numpy(np.stack(patches[offset:offset + batch_size], axis=0)).to(net.device).to(torch.float32)
+        with torch.no_grad():
+            # [B, H, W, 2]
+            mask_scores, _ = net.infer_masks_and_img_features(batch)
+        road_scores = mask_scores[..., 1].float().cpu().numpy()
+        for (img_index, x, y, w, h), patch_road_scores in zip(patch_slots[offset:offset + batch_size], road_scores):
+            road_masks[img_index][y:y + h, x:x + w] = patch_road_scores[:h, :w]
+    return road_masks
+
+
+def get_patch_road_scores(lowres_road_masks, all_patch_info, scale):
+    # Max low-res road score inside each patch, [N_patches, ].
+    scores = np.zeros((len(all_patch_info), ), dtype=np.float32)
+    for patch_index, (img_index, (x0, y0), (x1, y1)) in enumerate(all_patch_info):
+        road_mask = lowres_road_masks[img_index]
+        box = road_mask[
+            int(math.floor(y0 * scale)):int(math.ceil(y1 * scale)),
+            int(math.floor(x0 * scale)):int(math.ceil(x1 * scale))]
+        scores[patch_index] = box.max() if box.size > 0 else 0.0
+    return scores
+
+
+def filter_patches(net, imgs, all_patch_info, config):
+    # Returns the patches of all_patch_info that may contain roads, in the same order.
+    start_seconds = time.time()
+    lowres_road_masks = infer_lowres_road_masks(net, imgs, config)
+    scores = get_patch_road_scores(lowres_road_masks, all_patch_info, config.get('PREFILTER_SCALE', 0.25))
+    keep = scores >= config.get('PREFILTER_THRESHOLD', 0.05)
+    STATS.prefilter_seconds += time.time() - start_seconds
+    STATS.patches += len(all_patch_info)
+    STATS.skipped += int(np.sum(~keep))
+    return [patch_info for patch_info, kept in zip(all_patch_info, keep) if kept]
+
+
+def get_patch_has_road(fused_road_mask, all_patch_info, config):
+    # Whether each patch holds a road pixel of the full-res fused mask, [N_patches, ].
+    threshold = config.ROAD_THRESHOLD * 255
+    return np.array([
+        np.any(fused_road_mask[y0:y1, x0:x1] > threshold)
+        for _, (x0, y0), (x1, y1) in all_patch_info
+    ], dtype=bool)
+
+
+def calibrate_threshold(scores, has_road, recall):
+    # Highest threshold keeping at least `recall` of the patches with roads.
+    # Returns (threshold, skip rate at it).
+    positive_scores = np.sort(scores[has_road])
+    if positive_scores.shape[0] == 0:
+        return 0.0, 0.0
+    # number of positives allowed to be skipped
+    allowed_misses = int(math.floor((1.0 - recall) * positive_scores.shape[0]))
+    threshold = float(positive_scores[allowed_misses])
+    return threshold, float(np.mean(scores < threshold))
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model."
+)
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument("--images", nargs='+', default=[], help="calibration images.")
+parser.add_argument("--recall", default=1.0, type=float, help="min fraction of road patches to keep.")
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+
+
+if __name__ == "__main__":
+    # Calibration: runs the full inference on the images and picks the highest
+    # PREFILTER_THRESHOLD that keeps --recall of the patches with roads.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    config.INFER_PREFILTER = False
+    from infer_utils import load_inference_net
+    from inferencer import infer_one_img
+
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    net = load_inference_net(config, args.checkpoint, device)
+
+    all_scores, all_has_road = [], []
+    for path in args.images:
+        img = read_rgb_img(path)
+        all_patch_info = get_patch_info_one_img(
+            0, img.shape[0], config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+        _, _, _, fused_road_mask = infer_one_img(net, img, config)
+        lowres_road_masks = infer_lowres_road_masks(net, [img], config)
+        all_scores.append(get_patch_road_scores(lowres_road_masks, all_patch_info, config.get('PREFILTER_SCALE', 0.25)))
+        all_has_road.append(get_patch_has_road(fused_road_mask, all_patch_info, config))
+        print(f'{path}: {np.sum(all_has_road[-1])} / {len(all_patch_info)} patches with roads')
+
+    scores, has_road = np.concatenate(all_scores), np.concatenate(all_has_road)
+    threshold, skip_rate = calibrate_threshold(scores, has_road, args.recall)
+    print(f'PREFILTER_THRESHOLD: {threshold} keeps {args.recall} of the road patches and skips {skip_rate:.4f} of all patches')
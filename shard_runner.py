@@ -0,0 +1,215 @@
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import time
+from argparse import ArgumentParser
+
+import cv2
+import torch
+
+from utils import load_config, create_output_dir_and_save_config
+from dataset import read_rgb_img
+from infer_utils import load_inference_net
+import embedding_cache
+import inferencer
+import output_sink
+
+
+# Sharded, resumable inference over the test split, e.g.
+#
+#   python shard_runner.py --config ... --checkpoint ... --output_dir run --workers 4 --devices cuda:0 cuda:1
+#
+# Worker processes each load their own model replica and claim tiles one at a time
+# through lock files in save/<output_dir>/claims, so several machines sharing the
+# output dir can run this on the same output_dir too. A tile is done once its outputs
+# are fsynced and save/<output_dir>/done/<img_id> is written, re-runs skip done tiles.
+# Claims are released once the tile is done or its outputs failed to write.
+# Claims older than --stale_seconds, left by dead workers, are taken over. At worst a
+# tile is then inferred twice, which writes the same outputs.
+#
+# Every worker keeps its throughput in save/<output_dir>/workers/<worker>.json, merged
+# into inference_time.txt when the workers exit, or with --merge_only.
+
+
+def get_done_path(output_dir, img_id):
+    return os.path.join(output_dir, 'done', str(img_id))
+
+
+def claim_tile(output_dir, img_id, worker_name, stale_seconds):
+    # Creates the claim of img_id, returns whether this worker got it.
+    claim_path = os.path.join(output_dir, 'claims', f'{img_id}.lock')
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            age = time.time() - os.stat(claim_path).st_mtime
+        except FileNotFoundError:
+            return False
+        if age < stale_seconds:
+            return False
+        # takes over a stale claim, only one worker wins the rename
+        stale_path = f'{claim_path}.{worker_name}.stale'
+        try:
+            os.rename(claim_path, stale_path)
+        except FileNotFoundError:
+            return False
+        os.remove(stale_path)
+        return claim_tile(output_dir, img_id, worker_name, stale_seconds)
+    with os.fdopen(fd, 'w') as f:
+        f.write(worker_name)
+    return True
+
+
+def release_tile(output_dir, img_id):
+    try:
+        os.remove(os.path.join(output_dir, 'claims', f'{img_id}.lock'))
+    except FileNotFoundError:
+        pass
+
+
+def write_json(path, obj):
+    # atomic, others may read it anytime
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def get_img_ids(args, config):
+    test_img_indices, rgb_pattern, gt_graph_pattern = inferencer.get_test_split(config)
+    if args.img_ids:
+        # same type as the split, cityscale ids are ints
+        id_type = type(test_img_indices[0]) if len(test_img_indices) > 0 else str
+        test_img_indices = [id_type(img_id) for img_id in args.img_ids]
+    return test_img_indices, rgb_pattern, gt_graph_pattern
+
+
+def run_worker(worker_index, args):
+    config = load_config(args.config)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+        cv2.setNumThreads(args.threads)
+    devices = args.devices or [args.device]
+    device = torch.device(devices[worker_index % len(devices)])
+    torch.backends.cudnn.benchmark = True
+    net = load_inference_net(config, args.checkpoint, device)
+    embedding_cache.configure(config, args.checkpoint)
+    img_ids, rgb_pattern, gt_graph_pattern = get_img_ids(args, config)
+
+    output_dir = os.path.join('save', args.output_dir)
+    worker_name = f'{socket.gethostname()}-{os.getpid()}'
+    sink = output_sink.OutputSink(output_dir, config)
+    sink.get_dir('done')
+    stats_path = os.path.join(sink.get_dir('workers'), f'{worker_name}.json')
+    stats = {
+        'worker': worker_name, 'device': str(device), 'threads': torch.get_num_threads(),
+        'tiles': 0, 'inference_seconds': 0.0, 'start': time.time(), 'end': time.time(),
+    }
+    try:
+        for img_id in img_ids:
+            if os.path.exists(get_done_path(output_dir, img_id)):
+                continue
+            if not claim_tile(output_dir, img_id, worker_name, args.stale_seconds):
+                continue
+            # finished and released since the check above
+            if os.path.exists(get_done_path(output_dir, img_id)):
+                release_tile(output_dir, img_id)
+                continue
+            try:
+                img = read_rgb_img(rgb_pattern.format(img_id))
+                start_seconds = time.time()
+                pred_nodes, pred_edges, itsc_mask, road_mask = inferencer.infer_one_img(net, img, config)
+                seconds = time.time() - start_seconds
+                futures = inferencer.save_img_results(
+                    sink, img_id, img, pred_nodes, pred_edges, itsc_mask, road_mask,
+                    gt_graph_pattern.format(img_id), config)
+            except BaseException:
+                release_tile(output_dir, img_id)
+                raise
+            marker_future = sink.mark_done(
+                futures, get_done_path(output_dir, img_id), json.dumps({'worker': worker_name, 'seconds': seconds}))
+            # once done, or failed so that others retry it without waiting for stale_seconds
+            marker_future.add_done_callback(lambda _, img_id=img_id: release_tile(output_dir, img_id))
+            stats['tiles'] += 1
+            stats['inference_seconds'] += seconds
+            stats['end'] = time.time()
+            write_json(stats_path, stats)
+            print(f'[{worker_name}] {img_id} took {seconds:.2f} seconds.')
+    finally:
+        sink.close()
+    stats['end'] = time.time()
+    write_json(stats_path, stats)
+    print(f'[{worker_name}] {sink.stats}')
+
+
+def merge_worker_stats(output_dir, img_ids, config_path):
+    # Writes inference_time.txt of all workers that ever ran on output_dir.
+    all_stats = []
+    for path in sorted(glob.glob(os.path.join(output_dir, 'workers', '*.json'))):
+        with open(path) as f:
+            all_stats.append(json.load(f))
+    done_num = sum(os.path.exists(get_done_path(output_dir, img_id)) for img_id in img_ids)
+    total_inference_seconds = sum(stats['inference_seconds'] for stats in all_stats)
+    total_tiles = sum(stats['tiles'] for stats in all_stats)
+    wall_seconds = max([stats['end'] for stats in all_stats], default=0.0) - min([stats['start'] for stats in all_stats], default=0.0)
+
+    time_txt = f'Inference completed for {config_path} in {total_inference_seconds} seconds.'
+    time_txt += f'\n{done_num} / {len(img_ids)} tiles done by {len(all_stats)} workers, {total_tiles / max(total_inference_seconds, 1e-6):.4f} tiles/sec per worker.'
+    time_txt += f'\nWorkers ran for {wall_seconds} seconds from the first start to the last end, {total_tiles / max(wall_seconds, 1e-6):.4f} tiles/sec.'
+    for stats in all_stats:
+        worker_seconds = stats['end'] - stats['start']
+        time_txt += (
+            f"\n{stats['worker']} on {stats['device']} with {stats['threads']} threads: {stats['tiles']} tiles, "
+            f"{stats['inference_seconds']:.1f} inference seconds, {stats['tiles'] / max(stats['inference_seconds'], 1e-6):.4f} tiles/sec, "
+            f"{stats['tiles'] / max(worker_seconds, 1e-6):.4f} tiles/sec end-to-end.")
+    print(time_txt)
+    with open(os.path.join(output_dir, 'inference_time.txt'), 'w') as f:
+        f.write(time_txt)
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model to test."
+)
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument(
+    "--output_dir", default=None, help="name of the shared output dir under ./save."
+)
+parser.add_argument("--workers", default=1, type=int, help="worker processes on this machine.")
+parser.add_argument("--threads", default=0, type=int, help="torch / opencv threads per worker, 0 splits the cpus evenly.")
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+parser.add_argument("--devices", nargs='*', default=[], help="devices assigned round robin to the workers, e.g. cuda:0 cuda:1.")
+parser.add_argument("--img_ids", nargs='*', default=[], help="tiles to infer, defaults to the test split.")
+parser.add_argument("--stale_seconds", default=3600.0, type=float, help="age after which the claim of an unfinished tile is taken over.")
+parser.add_argument("--merge_only", action='store_true', help="only merges the worker stats into inference_time.txt.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    output_dir = create_output_dir_and_save_config('./save/infer_', config, specified_dir=f'./save/{args.output_dir}')
+    os.makedirs(os.path.join(output_dir, 'claims'), exist_ok=True)
+    if args.threads <= 0:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    if not args.merge_only:
+        if args.workers == 1:
+            run_worker(0, args)
+        else:
+            # spawned so the workers don't share the parent's device context
+            context = multiprocessing.get_context('spawn')
+            workers = [context.Process(target=run_worker, args=(i, args)) for i in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+            if failed:
+                print(f'Workers {failed} failed, re-run to finish their tiles.')
+
+    img_ids, _, _ = get_img_ids(args, config)
+    merge_worker_stats(output_dir, img_ids, args.config)
@@ -11,10 +11,13 @@ for i in "${arr[@]}"
 do
     # gt_graph=${i}__gt_graph_dense_spacenet.p
     gt_graph=${i}__gt_graph.p
-    if test -f "../${dir}/graph/${i}.p"; then
+    # the .graph output of the inferencer, or the .p pickle
+    prop="../${dir}/graph/${i}.graph"
+    if ! test -f "$prop"; then prop="../${dir}/graph/${i}.p"; fi
+    if test -f "$prop"; then
         echo "========================$i======================"
         python ./apls/convert.py "../${data_dir}/RGB_1.0_meter/${gt_graph}" gt.json
-        python ./apls/convert.py "../${dir}/graph/${i}.p" prop.json
+        python ./apls/convert.py "$prop" prop.json
         
           (cd apls && go run main.go ../gt.json ../prop.json ../..//results/apls/.txt spacenet)    fi
 done
@@ -1,7 +1,11 @@
 import pickle 
 import sys 
+import os
 import math
 import json 
+# graph_io of the repo root reads the .graph outputs of the inferencer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import graph_io
 
 lat_top_left = 41.0 
 lon_top_left = -71.0 
@@ -19,10 +23,13 @@ f_in = sys.argv[1]
 f_out = sys.argv[2] 
 
 
-try:
-	neighbors = pickle.load(open(f_in, "r"))
-except:
-	neighbors = pickle.load(open(f_in, "rb"))
+if f_in.endswith(graph_io.GRAPH_SUFFIX):
+	neighbors = graph_io.load_sat2graph(f_in)
+else:
+	try:
+		neighbors = pickle.load(open(f_in, "r"))
+	except:
+		neighbors = pickle.load(open(f_in, "rb"))
 
 
 nodes = []
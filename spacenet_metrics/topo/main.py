@@ -7,6 +7,9 @@ import topo as topo
 import json
 #import TOPORender
 import os
+# graph_io of the repo root reads the .graph outputs of the inferencer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import graph_io
 
 import argparse
 parser = argparse.ArgumentParser()
@@ -42,7 +45,8 @@ with open('../spacenet/data_split.json','r') as jf:
 
 for tile_idx in tile_list:
 
-    graph_prop = '../%s/graph/%s.p'%(args.savedir,tile_idx)
+    # .graph, or the .p pickle
+    graph_prop = '../%s/graph/%s'%(args.savedir,tile_idx)
     graph_gt = '../spacenet/RGB_1.0_meter/%s__gt_graph.p'%tile_idx
     # graph_gt = '../spacenet/RGB_1.0_meter/%s__gt_graph_dense_spacenet.p'%tile_idx
     args.output = '../%s/results/topo/%s.txt'%(args.savedir,tile_idx)
@@ -51,7 +55,7 @@ for tile_idx in tile_list:
         os.makedirs(output_dir)
 
     map1 = pickle.load(open(graph_gt, "rb"))
-    map2 = pickle.load(open(graph_prop, "rb"))
+    map2 = graph_io.load_sat2graph(graph_prop)
 
 
     def xy2latlon(x,y):
@@ -0,0 +1,108 @@
+import os
+import pickle
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from utils import load_config, create_output_dir_and_save_config
+from infer_utils import load_inference_net
+from raster_io import open_raster
+from sweep_inference import BandSweep, GraphFragments, get_reference_patch_stride, get_stream_patch_grid
+import graph_utils
+import graph_io
+import profile_utils
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model to test."
+)
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument(
+    "--input", default=None, help="raster to infer: .npy, .raw/.bin (with --raw_shape), a dir of {row}_{col}.png tiles, or an image."
+)
+parser.add_argument(
+    "--raw_shape", default=None, help="H,W,C of a headerless uint8 .raw/.bin raster."
+)
+parser.add_argument(
+    "--patch_stride", default=None, type=float,
+    help="max stride between patches in pixels, defaults to the stride of the config's grid on its dataset tiles."
+)
+parser.add_argument(
+    "--output_dir", default=None, help="Name of the output dir, if not specified will use timestamp"
+)
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.enabled = True
+    net = load_inference_net(config, args.checkpoint, device)
+    profiler = profile_utils.configure(config)
+
+    raw_shape = [int(x) for x in args.raw_shape.split(',')] if args.raw_shape else None
+    raster = open_raster(args.input, raw_shape=raw_shape)
+    name = os.path.splitext(os.path.basename(os.path.normpath(args.input)))[0]
+    print(f'Streaming {args.input}: {raster.width} x {raster.height}')
+
+    output_dir_prefix = './save/stream_'
+    if args.output_dir:
+        output_dir = create_output_dir_and_save_config(output_dir_prefix, config, specified_dir=f'./save/{args.output_dir}')
+    else:
+        output_dir = create_output_dir_and_save_config(output_dir_prefix, config)
+
+    patch_stride = args.patch_stride or get_reference_patch_stride(config)
+    x_begins = get_stream_patch_grid(raster.width, config.SAMPLE_MARGIN, config.PATCH_SIZE, patch_stride)
+    y_begins = get_stream_patch_grid(raster.height, config.SAMPLE_MARGIN, config.PATCH_SIZE, patch_stride)
+    print(f'{len(x_begins)} x {len(y_begins)} patches')
+
+    # masks are written to disk row by row
+    mask_save_dir = os.path.join(output_dir, 'mask')
+    if not os.path.exists(mask_save_dir):
+        os.makedirs(mask_save_dir)
+    keypoint_mask = np.lib.format.open_memmap(
+        os.path.join(mask_save_dir, f'{name}_itsc.npy'), mode='w+', dtype=np.uint8, shape=(raster.height, raster.width))
+    road_mask = np.lib.format.open_memmap(
+        os.path.join(mask_save_dir, f'{name}_road.npy'), mode='w+', dtype=np.uint8, shape=(raster.height, raster.width))
+    graph_fragments = GraphFragments(fragment_dir=os.path.join(output_dir, 'fragments', name))
+
+    start_seconds = time.time()
+    sweep = BandSweep(net, config, raster, keypoint_mask, road_mask, graph_fragments, x_begins, y_begins)
+    with profile_utils.tile(name):
+        sweep.run()
+    keypoint_mask.flush()
+    road_mask.flush()
+    end_seconds = time.time()
+
+    # Saves the large map
+    points, edges, edge_scores = graph_fragments.merge()
+    pred_nodes = points[:, ::-1]  # to rc
+    graph_save_dir = os.path.join(output_dir, 'graph')
+    if not os.path.exists(graph_save_dir):
+        os.makedirs(graph_save_dir)
+    unique_edges, unique_edge_scores = graph_io.unique_undirected_edges(edges, edge_scores)
+    graph_io.save_graph(
+        os.path.join(graph_save_dir, f'{name}{graph_io.GRAPH_SUFFIX}'), pred_nodes, unique_edges, unique_edge_scores)
+    if config.get('INFER_SAVE_SAT2GRAPH', True):
+        large_map_sat2graph_format = graph_utils.convert_to_sat2graph_format(pred_nodes, edges)
+        with open(os.path.join(graph_save_dir, f'{name}.p'), 'wb') as file:
+            pickle.dump(large_map_sat2graph_format, file)
+
+    time_txt = f'Inference completed for {args.config} in {end_seconds - start_seconds} seconds.'
+    print(time_txt)
+    print(f'{points.shape[0]} nodes, {edges.shape[0]} edges.')
+    with open(os.path.join(output_dir, 'inference_time.txt'), 'w') as f:
+        f.write(time_txt)
+
+    if profiler.enabled:
+        print(profiler.format_summary())
+        profiler.write_json(os.path.join(output_dir, 'profile.json'))
+        profiler.write_csv(os.path.join(output_dir, 'profile.csv'))
@@ -0,0 +1,344 @@
+import math
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import scipy
+import torch
+
+import graph_extraction
+import graph_utils
+import profile_utils
+from dataset import get_patch_grid
+from feature_store import FeatureStore
+from raster_io import ArrayRaster
+from infer_utils import upload_img, PatchBatchLoader, fuse_batch_masks, get_axis_coverage
+from infer_utils import prepare_topo_queries, infer_topo_batch, get_points_in_box
+
+
+# Tile sizes the INFER_PATCHES_PER_EDGE configs were tuned on.
+REFERENCE_IMAGE_SIZE = {
+    'cityscale': 2048,
+    'spacenet': 400,
+}
+
+
+def get_reference_patch_stride(config):
+    # Patch stride of the regular grid on the tiles of config.DATASET, pixels.
+    image_size = REFERENCE_IMAGE_SIZE[config.DATASET]
+    span = image_size - 2 * config.SAMPLE_MARGIN - config.PATCH_SIZE
+    return span / max(config.INFER_PATCHES_PER_EDGE - 1, 1)
+
+
+def get_stream_patch_grid(length, sample_margin, patch_size, max_stride):
+    # Patch begins along one axis of arbitrary length, spaced at most max_stride apart.
+    span = length - 2 * sample_margin - patch_size
+    assert span >= 0, f'raster of size {length} is smaller than a patch'
+    patch_num = max(1, math.ceil(span / max(max_stride, 1.0)) + 1)
+    return get_patch_grid(length, sample_margin, patch_size, patch_num)
+
+
+class GraphFragments:
+    """Collects graph fragments produced by a sweep.
+
+    Points carry global ids assigned in commit order, edges refer to these ids.
+    With fragment_dir, each fragment is written to its own npz instead of being
+    kept in memory.
+    """
+
+    def __init__(self, fragment_dir=None):
+        self.fragment_dir = fragment_dir
+        self.fragments = []
+        self.fragment_num = 0
+        if fragment_dir and not os.path.exists(fragment_dir):
+            os.makedirs(fragment_dir)
+
+    def write(self, point_ids, points, edges, edge_scores):
+        # point_ids: [N, ], points: [N, 2] (x, y), edges: [M, 2] global ids, edge_scores: [M, ]
+        fragment = {
+            'point_ids': point_ids,
+            'points': points,
+            'edges': edges,
+            'edge_scores': edge_scores,
+        }
+        if self.fragment_dir:
+            np.savez(os.path.join(self.fragment_dir, f'{self.fragment_num:05d}.npz'), **fragment)
+        else:
+            self.fragments.append(fragment)
+        self.fragment_num += 1
+
+    def load(self):
+        if not self.fragment_dir:
+            return self.fragments
+        return [
+            dict(np.load(os.path.join(self.fragment_dir, f'{i:05d}.npz')))
+            for i in range(self.fragment_num)
+        ]
+
+    def merge(self):
+        # Returns points [N, 2] (x, y) ordered by id, edges [M, 2], edge_scores [M, ].
+        fragments = self.load()
+        point_ids = np.concatenate([np.zeros((0, ), dtype=np.int64)] + [f['point_ids'] for f in fragments])
+        points = np.concatenate([np.zeros((0, 2), dtype=np.int64)] + [f['points'] for f in fragments])
+        edges = np.concatenate([np.zeros((0, 2), dtype=np.int64)] + [f['edges'] for f in fragments])
+        edge_scores = np.concatenate([np.zeros((0, ), dtype=np.float32)] + [f['edge_scores'] for f in fragments])
+        # ids are assigned consecutively, so ordering by id gives a dense index
+        points = points[np.argsort(point_ids, kind='stable'), :]
+        return points, edges, edge_scores
+
+
+class BandSweep:
+    """Runs the two-pass inference over a raster one row of patches at a time.
+
+    After the encoder pass over patch row r, mask rows that no later patch touches
+    are normalized and written out, and graph points are committed for the rows
+    whose NMS neighborhood is final. TopoNet then runs for every pending patch row
+    whose points are all committed, and its img features are freed. Edges that no
+    later patch can score are averaged, thresholded and flushed as a fragment.
+    Peak memory is bounded by PATCH_SIZE + stride rows of the raster.
+
+    Points are extracted on overlapping bands of the fused masks. Along band seams,
+    a new point within ROAD_NMS_RADIUS of an already committed one is dropped, so the
+    points may differ slightly from a whole-image NMS there.
+    """
+
+    def __init__(self, net, config, raster, keypoint_mask, road_mask, graph_fragments, x_begins, y_begins):
+        # raster: exposes height, width, read_window(x0, y0, x1, y1), see raster_io.
+        # keypoint_mask, road_mask: [H, W] uint8 outputs, can be np.memmap.
+        # x_begins, y_begins: patch grid along each axis.
+        self.net = net
+        self.config = config
+        self.raster = raster
+        self.keypoint_mask = keypoint_mask
+        self.road_mask = road_mask
+        self.graph_fragments = graph_fragments
+        self.x_begins = list(x_begins)
+        self.y_begins = list(y_begins)
+        self.device = net.device
+        self.patch_size = config.PATCH_SIZE
+        self.height, self.width = raster.height, raster.width
+        # mask rows above the finalized ones that point extraction looks back at
+        self.nms_radius = max(config.ITSC_NMS_RADIUS, config.ROAD_NMS_RADIUS)
+        self.halo = 2 * self.nms_radius
+        self.overlap = config.get('INFER_SWEEP_OVERLAP', True)
+
+    def run(self):
+        patch_size = self.patch_size
+        self.x_coverage = torch.tensor(get_axis_coverage(self.width, self.x_begins, patch_size), device=self.device)
+        self.y_coverage = torch.tensor(get_axis_coverage(self.height, self.y_begins, patch_size), device=self.device)
+
+        # [rows, IMG_W, 2] fused masks of rows [done_y, done_y + rows)
+        self.canvas = torch.zeros((0, self.width, 2), dtype=torch.float32, device=self.device)
+        self.done_y = 0
+        # finalized uint8 masks of rows [tail_y0, done_y), for point extraction
+        self.keypoint_tail = np.zeros((0, self.width), dtype=np.uint8)
+        self.road_tail = np.zeros((0, self.width), dtype=np.uint8)
+        self.tail_y0 = 0
+        # points of rows below commit_y are final
+        self.commit_y = 0
+        self.next_point_id = 0
+        # committed points that pending patches or seams may still need
+        self.active_points = np.zeros((0, 2), dtype=np.int64)
+        self.active_ids = np.zeros((0, ), dtype=np.int64)
+        # committed but not yet flushed
+        self.new_points = np.zeros((0, 2), dtype=np.int64)
+        self.new_ids = np.zeros((0, ), dtype=np.int64)
+        # (row_patch_info, FeatureStore) waiting for toponet
+        self.pending_rows = deque()
+        # queried edges (global ids) and scores not flushed yet
+        self.pending_edges = [np.zeros((0, 2), dtype=np.int64)]
+        self.pending_edge_scores = [np.zeros((0, ), dtype=np.float32)]
+
+        # with overlap, points of a band are extracted on a worker thread while the
+        # encoder runs on the next patch row
+        executor = ThreadPoolExecutor(max_workers=1) if self.overlap else None
+        # (future of extracted points, new_commit_y, is_last) not committed yet
+        pending_commit = None
+        try:
+            for row_index, y in enumerate(self.y_begins):
+                is_last = row_index + 1 == len(self.y_begins)
+                self.infer_mask_row(y)
+                if pending_commit is not None:
+                    self.finish_commit(*pending_commit)
+                    pending_commit = None
+                final_y = self.height if is_last else self.y_begins[row_index + 1]
+                self.finalize_masks(final_y)
+                new_commit_y = self.height if is_last else max(self.commit_y, final_y - self.halo)
+                pending_commit = (self.start_commit(new_commit_y, executor), new_commit_y, is_last)
+                if executor is None:
+                    self.finish_commit(*pending_commit)
+                    pending_commit = None
+            if pending_commit is not None:
+                self.finish_commit(*pending_commit)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def infer_mask_row(self, y):
+        # Pass 1 over the patch row starting at y.
+        patch_size = self.patch_size
+        # [P, IMG_W, C]
+        window = self.raster.read_window(0, y, self.width, y + patch_size)
+        img_tensor = upload_img(window, self.device)
+        window_patch_info = [(0, (x, 0), (x + patch_size, patch_size)) for x in self.x_begins]
+        self.extend_canvas(y + patch_size)
+        canvas_y = y - self.done_y
+
+        features = FeatureStore(
+            mode=self.config.get('INFER_FEATURE_STORE', 'fp32'), spill_dir=self.config.get('INFER_FEATURE_SPILL_DIR', None))
+        patch_loader = PatchBatchLoader(
+            img_tensor, window_patch_info, self.config.INFER_BATCH_SIZE, prefetch=self.config.get('INFER_PREFETCH_BATCHES', 1))
+        for batch_patch_info, batch_img_patches in patch_loader:
+            with torch.no_grad(), profile_utils.span('encoder'):
+                mask_scores, patch_img_features = self.net.infer_masks_and_img_features(batch_img_patches)
+                features.append(patch_img_features)
+                canvas_patch_info = [(i, (x0, canvas_y), (x1, canvas_y + patch_size)) for i, (x0, _), (x1, _) in batch_patch_info]
+                fuse_batch_masks(self.canvas, mask_scores, canvas_patch_info)
+        row_patch_info = [(0, (x, y), (x + patch_size, y + patch_size)) for x in self.x_begins]
+        self.pending_rows.append((row_patch_info, features))
+
+    def extend_canvas(self, end_y):
+        rows = end_y - self.done_y - self.canvas.shape[0]
+        if rows > 0:
+            padding = torch.zeros((rows, self.width, 2), dtype=torch.float32, device=self.device)
+            self.canvas = torch.cat([self.canvas, padding], dim=0)
+
+    def finalize_masks(self, final_y):
+        # Normalizes and writes out mask rows [done_y, final_y).
+        if final_y <= self.done_y:
+            return
+        self.extend_canvas(final_y)
+        row_num = final_y - self.done_y
+        # [rows, IMG_W]
+        pixel_counter = self.y_coverage[self.done_y:final_y, None] * self.x_coverage[None, :]
+        # uncovered pixels stay 0
+        fused_masks = self.canvas[:row_num] / pixel_counter.clamp(min=1.0).unsqueeze(-1)
+        fused_masks = (fused_masks * 255).to(torch.uint8).cpu().numpy()
+        keypoint_rows, road_rows = fused_masks[:, :, 0], fused_masks[:, :, 1]
+        self.keypoint_mask[self.done_y:final_y] = keypoint_rows
+        self.road_mask[self.done_y:final_y] = road_rows
+        self.keypoint_tail = np.concatenate([self.keypoint_tail, keypoint_rows], axis=0)
+        self.road_tail = np.concatenate([self.road_tail, road_rows], axis=0)
+        self.canvas = self.canvas[row_num:].clone()
+        self.done_y = final_y
+
+    def start_commit(self, new_commit_y, executor=None):
+        # Starts extracting points on the finalized rows, returns a future or the points.
+        if new_commit_y <= self.commit_y:
+            return None
+        # the tails are replaced, never modified in place, so the worker can read them
+        args = (self.keypoint_tail, self.road_tail, self.tail_y0, profile_utils.current_tile())
+        if executor is None:
+            return self.extract_band_points(*args)
+        return executor.submit(self.extract_band_points, *args)
+
+    def extract_band_points(self, keypoint_tail, road_tail, tail_y0, profile_tile=None):
+        # Returns [N, 2] (x, y) points of a band of finalized mask rows starting at tail_y0.
+        with profile_utils.span('point_extraction', tile=profile_tile):
+            points = graph_extraction.extract_graph_points(keypoint_tail, road_tail, self.config)
+        points = points.astype(np.int64).reshape(-1, 2)
+        points[:, 1] += tail_y0
+        return points
+
+    def finish_commit(self, points, new_commit_y, is_last):
+        # Commits the points of start_commit, then runs toponet on the patch rows they complete.
+        if isinstance(points, Future):
+            points = points.result()
+        if points is not None:
+            self.commit_points(points, new_commit_y)
+        while self.pending_rows:
+            row_patch_info, _ = self.pending_rows[0]
+            _, (_, row_y0), (_, row_y1) = row_patch_info[0]
+            if row_y1 >= self.commit_y and not is_last:
+                break
+            self.infer_topo_row(*self.pending_rows.popleft())
+        self.flush_graph()
+
+    def commit_points(self, points, new_commit_y):
+        # Commits the extracted points in [commit_y, new_commit_y).
+        keep = (points[:, 1] >= self.commit_y) & (points[:, 1] < new_commit_y)
+        points = points[keep, :]
+        # seam: the other side was already NMSed
+        seam_points = self.active_points[self.active_points[:, 1] >= self.commit_y - self.nms_radius]
+        if points.shape[0] > 0 and seam_points.shape[0] > 0:
+            seam_dists, _ = scipy.spatial.KDTree(seam_points).query(points, k=1)
+            points = points[seam_dists > self.config.ROAD_NMS_RADIUS, :]
+
+        point_ids = np.arange(self.next_point_id, self.next_point_id + points.shape[0], dtype=np.int64)
+        self.next_point_id += points.shape[0]
+        self.active_points = np.concatenate([self.active_points, points], axis=0)
+        self.active_ids = np.concatenate([self.active_ids, point_ids], axis=0)
+        self.new_points = np.concatenate([self.new_points, points], axis=0)
+        self.new_ids = np.concatenate([self.new_ids, point_ids], axis=0)
+        self.commit_y = new_commit_y
+
+        # only keeps the rows the next extraction looks back at
+        trim = max(0, self.commit_y - self.halo - self.tail_y0)
+        self.keypoint_tail = self.keypoint_tail[trim:]
+        self.road_tail = self.road_tail[trim:]
+        self.tail_y0 += trim
+
+    def infer_topo_row(self, row_patch_info, features):
+        # Pass 2 over one patch row, batched the same way as pass 1.
+        batch_size = self.config.INFER_BATCH_SIZE
+        for batch_index, offset in enumerate(range(0, len(row_patch_info), batch_size)):
+            batch_patch_info = row_patch_info[offset : offset + batch_size]
+            batch_point_indices = [
+                get_points_in_box(self.active_points, (x0, y0, x1, y1))
+                for _, (x0, y0), (x1, y1) in batch_patch_info
+            ]
+            collated, idx_maps = prepare_topo_queries(self.active_points, batch_point_indices, batch_patch_info, self.config)
+            if collated['points'].shape[1] == 0:
+                continue
+            with profile_utils.span('toponet'):
+                batch_edges, batch_edge_scores = infer_topo_batch(
+                    self.net, features[batch_index], collated, idx_maps, self.device)
+            # active idx -> global ids
+            self.pending_edges.append(self.active_ids[batch_edges])
+            self.pending_edge_scores.append(batch_edge_scores)
+        features.close()
+
+    def flush_graph(self):
+        # Flushes new points and the edges no pending patch row can score anymore.
+        if self.pending_rows:
+            _, (_, next_row_y), _ = self.pending_rows[0][0][0]
+        else:
+            next_row_y = math.inf
+        edges = np.concatenate(self.pending_edges, axis=0)
+        edge_scores = np.concatenate(self.pending_edge_scores, axis=0)
+        # a later patch contains both endpoints only if both are at or below its top
+        endpoint_y = self.active_points[np.searchsorted(self.active_ids, edges), 1]
+        is_final = np.min(endpoint_y, axis=1) < next_row_y
+        final_edges, final_scores = graph_utils.aggregate_edge_scores(
+            edges[is_final], edge_scores[is_final], max(self.next_point_id, 1))
+        keep = final_scores > self.config.TOPO_THRESHOLD
+        self.graph_fragments.write(self.new_ids, self.new_points, final_edges[keep], final_scores[keep])
+        self.new_points = np.zeros((0, 2), dtype=np.int64)
+        self.new_ids = np.zeros((0, ), dtype=np.int64)
+        self.pending_edges = [edges[~is_final]]
+        self.pending_edge_scores = [edge_scores[~is_final]]
+
+        # drops points no pending edge, patch or seam needs
+        min_y = min(next_row_y, self.commit_y - self.nms_radius)
+        needed = self.active_points[:, 1] >= min_y
+        self.active_points = self.active_points[needed]
+        self.active_ids = self.active_ids[needed]
+
+
+def infer_one_img_sweep(net, img, config):
+    # Same inputs and outputs as inferencer.infer_one_img, but interleaves the mask
+    # and topology passes on the regular patch grid with a BandSweep, so img features
+    # only live until the patch row they belong to has its points.
+    image_height, image_width = img.shape[0:2]
+    x_begins = get_patch_grid(image_width, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+    y_begins = get_patch_grid(image_height, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+    fused_keypoint_mask = np.zeros((image_height, image_width), dtype=np.uint8)
+    fused_road_mask = np.zeros((image_height, image_width), dtype=np.uint8)
+    graph_fragments = GraphFragments()
+    sweep = BandSweep(
+        net, config, ArrayRaster(img), fused_keypoint_mask, fused_road_mask, graph_fragments, x_begins, y_begins)
+    sweep.run()
+    graph_points, pred_edges, _ = graph_fragments.merge()
+    pred_nodes = graph_points[:, ::-1]  # to rc
+    return pred_nodes, pred_edges, fused_keypoint_mask, fused_road_mask
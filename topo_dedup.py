@@ -0,0 +1,184 @@
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from utils import load_config
+from dataset import read_rgb_img
+
+
+# Deduplicated TopoNet queries: with overlapping patches every point is a query source
+# in all the patches holding it, and aggregate_edge_scores averages the repeats. With
+# TOPO_QUERY_PATCHES: K > 0, a point is only a source in K of its patches, it stays a
+# target everywhere. Patches holding both endpoints of all its pairs, its
+# MAX_NEIGHBOR_QUERIES nearest points within NEIGHBOR_RADIUS, go first, then the ones
+# where it's farthest from the border. So every pair is queried with both endpoints
+# inside a patch. A point no patch holds with all its neighbors stays a source in all
+# its patches, like without dedup.
+#
+# TOPO_SYMMETRIC_FOLD also folds (a, b) and (b, a) of a patch into one query, whose
+# score is used for both directions. TopoNet isn't symmetric (src / tgt features and
+# the offset sign), so check the edge agreement before enabling it. Run this file to
+# compare against the exhaustive queries.
+
+
+class TopoQueryStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.pairs = 0
+        self.flops = 0
+
+    def add(self, collated):
+        self.samples += int(np.sum(np.any(collated['valid'], axis=-1)))
+        self.pairs += int(np.sum(collated['valid']))
+        self.flops += estimate_toponet_flops(collated)
+
+    def __repr__(self):
+        return f'TopoNet queried {self.pairs} pairs in {self.samples} samples, about {self.flops / 1e9:.3f} GFLOPs'
+
+
+STATS = TopoQueryStats()
+
+
+def estimate_toponet_flops(collated, feature_dim=256, hidden_dim=128, layers=3):
+    # Multiply-adds x2 of TopoNet on the queries of prepare_topo_queries. The projections
+    # run on the padded [B, N_samples, N_pairs] pairs, the transformer only on the valid
+    # pairs of each sample like its nested tensor path. Skips the feature sampling and
+    # the softmax.
+    batch_size, point_num = collated['points'].shape[0:2]
+    padded_pairs = collated['valid'].size
+    # [B * N_samples, ]
+    sample_pairs = np.sum(collated['valid'], axis=-1).reshape(-1).astype(np.int64)
+    flops = 2 * batch_size * point_num * feature_dim * hidden_dim  # feature_proj
+    flops += 2 * padded_pairs * (2 * hidden_dim + 2) * hidden_dim  # pair_proj
+    # qkv, out proj and the two feedforward linears, dim_feedforward is hidden_dim
+    layer_flops = 2 * int(np.sum(sample_pairs)) * (3 + 1 + 2) * hidden_dim * hidden_dim
+    # attention scores and weighted sum within each sample
+    layer_flops += 2 * 2 * int(np.sum(sample_pairs ** 2)) * hidden_dim
+    flops += layers * layer_flops
+    flops += 2 * padded_pairs * hidden_dim  # output_proj
+    return flops
+
+
+def get_point_centrality(points, patch_info):
+    # Distance of points [N, 2] (x, y) to the border of the patch.
+    _, (x0, y0), (x1, y1) = patch_info
+    return np.min(np.stack([
+        points[:, 0] - x0, x1 - points[:, 0],
+        points[:, 1] - y0, y1 - points[:, 1],
+    ], axis=-1), axis=-1)
+
+
+def assign_query_patches(graph_points, all_patch_point_indices, all_patch_info, k, knn_idx, max_neighbors):
+    # graph_points: [N_points, 2] (x, y) of the full graph.
+    # all_patch_point_indices: list of sorted [N_points_i, ] indices of the points in each patch.
+    # knn_idx: [N_points, N_nbr] neighbors of each point by distance, N_points if missing,
+    # like PointIndex.knn_idx.
+    # Returns the list of sorted indices of the query sources of each patch: every point
+    # is a source in k patches, the ones holding its first max_neighbors neighbors
+    # first, then the ones where it's farthest from the border, ties go to the earlier
+    # patch. Points without a patch holding their neighbors are sources in all their
+    # patches.
+    if len(all_patch_info) == 0:
+        return []
+    point_num = graph_points.shape[0]
+    point_indices = np.concatenate(all_patch_point_indices)
+    patch_indices = np.concatenate([
+        np.full((len(indices), ), patch_index, dtype=np.int64)
+        for patch_index, indices in enumerate(all_patch_point_indices)
+    ])
+    centrality = np.concatenate([
+        get_point_centrality(graph_points[indices], patch_info)
+        for indices, patch_info in zip(all_patch_point_indices, all_patch_info)
+    ])
+    # whether each (point, patch) holds both endpoints of all pairs of the point
+    all_complete = []
+    for indices in all_patch_point_indices:
+        in_patch = np.zeros((point_num + 1, ), dtype=bool)
+        in_patch[indices] = True
+        in_patch[point_num] = True
+        all_complete.append(np.all(in_patch[knn_idx[indices, :max_neighbors]], axis=1))
+    complete = np.concatenate(all_complete)
+    # groups by point, complete patches first, best-centred first, then by patch
+    order = np.lexsort((patch_indices, -centrality, ~complete, point_indices))
+    point_indices, patch_indices, complete = point_indices[order], patch_indices[order], complete[order]
+    # rank of each (point, patch) within its point
+    group_starts = np.flatnonzero(np.r_[True, point_indices[1:] != point_indices[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, point_indices.shape[0]])
+    ranks = np.arange(point_indices.shape[0]) - np.repeat(group_starts, group_sizes)
+    # the first of a group is complete if the point has any complete patch
+    has_complete = np.repeat(complete[group_starts], group_sizes)
+    keep = np.where(has_complete, ranks < k, True)
+    point_indices, patch_indices = point_indices[keep], patch_indices[keep]
+    # back to patch order, points sorted
+    order = np.lexsort((point_indices, patch_indices))
+    point_indices, patch_indices = point_indices[order], patch_indices[order]
+    splits = np.searchsorted(patch_indices, np.arange(1, len(all_patch_info)))
+    return np.split(point_indices, splits)
+
+
+def fold_symmetric_pairs(pairs, valid):
+    # pairs: [N_samples, N_nbr, 2] patch-local (src, tgt), valid: [N_samples, N_nbr].
+    # Drops (b, a) when (a, b) with a < b is queried too.
+    # Returns valid and folded [N_samples, N_nbr], the pairs standing for both directions.
+    point_num = int(pairs.max()) + 1 if pairs.size > 0 else 0
+    codes = pairs[..., 0] * point_num + pairs[..., 1]
+    reverse_codes = pairs[..., 1] * point_num + pairs[..., 0]
+    has_reverse = valid & np.isin(reverse_codes, codes[valid])
+    folded = has_reverse & (pairs[..., 0] < pairs[..., 1])
+    valid = valid & ~(has_reverse & (pairs[..., 0] > pairs[..., 1]))
+    return valid, folded
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--checkpoint", default=None, help="checkpoint of the model."
+)
+parser.add_argument(
+    "--config", default=None, help="model config, TOPO_QUERY_PATCHES and TOPO_SYMMETRIC_FOLD select the dedup mode."
+)
+parser.add_argument("--images", nargs='+', default=[], help="images to compare on.")
+parser.add_argument("--tolerance", default=4.0, type=float, help="max distance in pixels of matching nodes.")
+parser.add_argument("--device", default="cuda", help="device to use for inference")
+
+
+if __name__ == "__main__":
+    # Compares the deduplicated queries of the config against the exhaustive ones.
+    args = parser.parse_args()
+    config = load_config(args.config)
+    from infer_utils import load_inference_net
+    from inferencer import infer_one_img
+    from cpu_backend import compare_inference_results
+    # the stats updated by inferencer, not the ones of __main__
+    import topo_dedup
+
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    net = load_inference_net(config, args.checkpoint, device)
+    exhaustive_config = config.copy()
+    exhaustive_config.TOPO_QUERY_PATCHES = 0
+    exhaustive_config.TOPO_SYMMETRIC_FOLD = False
+
+    all_metrics = []
+    for path in args.images:
+        img = read_rgb_img(path)
+        topo_dedup.STATS.reset()
+        start_seconds = time.time()
+        reference = infer_one_img(net, img, exhaustive_config)
+        reference_seconds = time.time() - start_seconds
+        reference_flops = topo_dedup.STATS.flops
+        topo_dedup.STATS.reset()
+        start_seconds = time.time()
+        result = infer_one_img(net, img, config)
+        dedup_seconds = time.time() - start_seconds
+        metrics = compare_inference_results(reference, result, config, tolerance=args.tolerance)
+        metrics['flops_saved'] = 1.0 - topo_dedup.STATS.flops / max(reference_flops, 1)
+        metrics['speedup'] = reference_seconds / max(dedup_seconds, 1e-6)
+        print(path, topo_dedup.STATS)
+        print(path, ', '.join(f'{k}={v:.4f}' for k, v in metrics.items()))
+        all_metrics.append(metrics)
+    if all_metrics:
+        print('mean', ', '.join(f'{k}={np.mean([m[k] for m in all_metrics]):.4f}' for k in all_metrics[0]))